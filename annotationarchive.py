@@ -0,0 +1,215 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+import numpy as np
+
+from annotationstore import AnnotationStore
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Columnar archive: one file with flat float32 vertices, per polygon vertex offsets and class ids,
+# #   per image polygon offsets and an image name table; every column is 16 byte aligned so numpy can
+# #   map it straight out of the file
+# # -----------------------------------------------------------------------------------------------------------------------
+
+MAGIC = b'PARCELA1'
+# magic, images, polygons, vertices (points), then offset/length of the six columns
+HEADER = struct.Struct('<8sQQQ12Q')
+COLUMNS = ('vertices', 'polygonOffsets', 'classIds', 'imageOffsets', 'nameOffsets', 'names')
+DTYPES = {'vertices': np.float32, 'polygonOffsets': np.uint64, 'classIds': np.int32,
+          'imageOffsets': np.uint64, 'nameOffsets': np.uint64, 'names': np.uint8}
+
+
+def align(f):
+    padding = -f.tell() % 16
+    if padding:
+        f.write(b'\0' * padding)
+
+
+def writeArchive(path, entries):
+    # entries: (image key, colorDict) pairs as streamed by AnnotationStore.items(); vertices are streamed to
+    # the file, only the offset columns are kept in memory
+    polygonOffsets = array('Q', [0])
+    classIds = array('i')
+    imageOffsets = array('Q', [0])
+    nameOffsets = array('Q', [0])
+    names = bytearray()
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+        f.write(b'\0' * HEADER.size)
+        align(f)
+        verticesStart = f.tell()
+        vertexCount = 0
+        for key, colorDict in entries:
+            for classId in sorted(colorDict):
+                for points in colorDict[classId]:
+                    if len(points) < 2:
+                        continue
+                    f.write(points.tobytes())
+                    vertexCount += len(points) // 2
+                    polygonOffsets.append(vertexCount)
+                    classIds.append(classId)
+            imageOffsets.append(len(classIds))
+            names.extend(key.encode('utf-8'))
+            nameOffsets.append(len(names))
+        layout = [(verticesStart, vertexCount * 8)]
+        for column in (polygonOffsets, classIds, imageOffsets, nameOffsets, names):
+            align(f)
+            start = f.tell()
+            f.write(bytes(column) if isinstance(column, bytearray) else column.tobytes())
+            layout.append((start, f.tell() - start))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(imageOffsets) - 1, len(classIds), vertexCount,
+                            *[value for column in layout for value in column]))
+    os.replace(f.name, path)
+    return len(imageOffsets) - 1, len(classIds), vertexCount
+
+
+class AnnotationArchive(object):
+    fileName = 'annotations.parcels'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.map, 0)
+        if header[0] != MAGIC:
+            raise ValueError('%s is not an annotation archive' % path)
+        self.imageCount, self.polygonCount, self.vertexCount = header[1:4]
+        layout = header[4:]
+        for i, column in enumerate(COLUMNS):
+            start, length = layout[2 * i], layout[2 * i + 1]
+            dtype = np.dtype(DTYPES[column])
+            setattr(self, column, np.frombuffer(self.map, dtype=dtype, count=length // dtype.itemsize, offset=start))
+        self.vertices = self.vertices.reshape(-1, 2)
+        self.keys = None
+
+    @classmethod
+    def forDirectory(cls, directory):
+        path = os.path.join(directory, cls.fileName)
+        return cls(path) if os.path.exists(path) else None
+
+    def __len__(self):
+        return self.imageCount
+
+    def name(self, index):
+        return bytes(self.names[self.nameOffsets[index]:self.nameOffsets[index + 1]]).decode('utf-8')
+
+    def index(self, key):
+        # the name table is only decoded on the first lookup
+        if self.keys is None:
+            self.keys = {self.name(i): i for i in range(self.imageCount)}
+        return self.keys.get(key)
+
+    def __contains__(self, key):
+        return self.index(key) is not None
+
+    def polygons(self, key):
+        # (classId, (n, 2) float32 view into the mapped file) per polygon, nothing is copied
+        index = self.index(key)
+        if index is None:
+            return []
+        first, last = int(self.imageOffsets[index]), int(self.imageOffsets[index + 1])
+        offsets = self.polygonOffsets[first:last + 1]
+        return [(int(self.classIds[i]), self.vertices[int(offsets[i - first]):int(offsets[i - first + 1])])
+                for i in range(first, last)]
+
+    def classCounts(self, key):
+        index = self.index(key)
+        if index is None:
+            return {}
+        classIds, counts = np.unique(self.classIds[int(self.imageOffsets[index]):int(self.imageOffsets[index + 1])],
+                                     return_counts=True)
+        return dict(zip(classIds.tolist(), counts.tolist()))
+
+    def colorDict(self, key):
+        # editable float32 buffers for the editor, one memcpy per polygon
+        colorDict = {}
+        for classId, xy in self.polygons(key):
+            points = array('f')
+            points.frombytes(xy.tobytes())
+            colorDict.setdefault(classId, []).append(points)
+        return colorDict
+
+    def polygonAreas(self, blockVertices=1 << 22):
+        # area of every polygon, computed block-wise over the mapped columns
+        sizes = np.diff(self.polygonOffsets.astype(np.int64))
+        areas = np.zeros(self.polygonCount)
+        first = 0
+        while first < self.polygonCount:
+            start = int(self.polygonOffsets[first])
+            last = int(np.searchsorted(self.polygonOffsets, start + blockVertices, side='right')) - 1
+            last = min(max(last, first + 1), self.polygonCount)
+            offsets = self.polygonOffsets[first:last + 1].astype(np.int64) - start
+            xy = self.vertices[start:start + int(offsets[-1])].astype(np.float64)
+            # shoelace terms with the successor of each polygon's last vertex being its first vertex
+            successor = np.arange(1, len(xy) + 1)
+            successor[offsets[1:] - 1] = offsets[:-1]
+            cross = xy[:, 0] * xy[successor, 1] - xy[successor, 0] * xy[:, 1]
+            sums = np.add.reduceat(cross, offsets[:-1]) if len(cross) else np.zeros(last - first)
+            # reduceat returns the element itself for empty polygons, they have no area
+            sums[sizes[first:last] == 0] = 0.0
+            areas[first:last] = 0.5 * np.abs(sums)
+            first = last
+        return areas
+
+    def classStatistics(self, blockVertices=1 << 22):
+        # polygon count, vertex count and summed area per class
+        counts = np.bincount(self.classIds.clip(0)) if self.polygonCount else np.zeros(0, np.int64)
+        sizes = np.diff(self.polygonOffsets.astype(np.int64))
+        vertices = np.bincount(self.classIds.clip(0), weights=sizes) if self.polygonCount else np.zeros(0)
+        areas = np.bincount(self.classIds.clip(0), weights=self.polygonAreas(blockVertices), minlength=len(counts))
+        return {int(classId): {'polygons': int(counts[classId]), 'vertices': int(vertices[classId]),
+                               'area': float(areas[classId])}
+                for classId in np.nonzero(counts)[0]}
+
+    def imageStatistics(self):
+        # (image key, classId, polygon count, summed area) per image and class, grouped without a Python loop
+        if not self.polygonCount:
+            return []
+        images = np.repeat(np.arange(self.imageCount), np.diff(self.imageOffsets.astype(np.int64)))
+        classIds = self.classIds.clip(0).astype(np.int64)
+        width = int(classIds.max()) + 1
+        groups, inverse = np.unique(images * width + classIds, return_inverse=True)
+        counts = np.bincount(inverse)
+        areas = np.bincount(inverse, weights=self.polygonAreas())
+        return [(self.name(int(group // width)), int(group % width), int(count), float(area))
+                for group, count, area in zip(groups.tolist(), counts.tolist(), areas.tolist())]
+
+    def close(self):
+        for column in COLUMNS:
+            setattr(self, column, None)
+        self.map.close()
+        self.file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or inspect a columnar annotation archive')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='write the annotations of a directory to an archive')
+    build.add_argument('directory', help='image directory containing the annotation store')
+    build.add_argument('archive', nargs='?', help='archive file (default: <directory>/%s)' % AnnotationArchive.fileName)
+    stats = commands.add_parser('stats', help='print per class statistics of an archive as JSON')
+    stats.add_argument('archive', help='archive file')
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        path = args.archive or os.path.join(args.directory, AnnotationArchive.fileName)
+        store = AnnotationStore.forDirectory(args.directory)
+        images, polygons, vertices = writeArchive(path, store.items())
+        store.close()
+        print('archived %d vertices of %d polygons in %d images to %s' % (vertices, polygons, images, path))
+    else:
+        archive = AnnotationArchive(args.archive)
+        print(json.dumps({'images': len(archive), 'polygons': archive.polygonCount, 'vertices': archive.vertexCount,
+                          'classes': archive.classStatistics()}, indent=2))
+        archive.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
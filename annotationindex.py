@@ -0,0 +1,200 @@
+import re
+
+import numpy as np
+
+from annotationstore import summarize
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Filter expressions: whitespace separated terms that all have to hold, "!" negates a term
+# #
+# #       Arm                 images with at least one Arm polygon
+# #       Box>20  arm.area>=5000  polygons<3
+# #       unannotated  annotated  unreviewed  reviewed
+# # -----------------------------------------------------------------------------------------------------------------------
+
+TERM = re.compile(r'^(!?)([^\s<>=!.]+)(?:\.(area))?(?:(>=|<=|!=|==|=|>|<)(\d+(?:\.\d*)?))?$')
+COMPARISONS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+               '=': np.equal, '==': np.equal, '!=': np.not_equal}
+STATES = ('unannotated', 'annotated', 'unreviewed', 'reviewed')
+
+
+def categoryKey(name):
+    return re.sub(r'\s+', '', name.lower())
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   AnnotationIndex, per image columns aligned with the rows of the image list
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class AnnotationIndex(object):
+    # polygon count and summed area per class of the reviewed annotations, their total and the number of
+    # unreviewed proposals, one row per image; every column is contiguous and filters are evaluated on whole
+    # columns, a million rows take a few milliseconds
+    def __init__(self, classes, aliases=None):
+        self.classIds = sorted(category.id for category in classes)
+        self.columns = {classId: column for column, classId in enumerate(self.classIds)}
+        self.names = {}
+        for category in classes:
+            self.names[categoryKey(category.name)] = category.id
+            self.names.setdefault(categoryKey(category.name.split()[0]), category.id)
+            self.names[str(category.id)] = category.id
+        for name, classId in (aliases or {}).items():
+            self.names.setdefault(categoryKey(name), classId)
+        # bumped on every change, views of a query know when to run it again
+        self.version = 0
+        self.keys = []
+        self.rows = {}
+        self.size = 0
+        # counts[column] and areas[column] per class, column = self.columns[classId]
+        self.counts = np.zeros((len(self.classIds), 0), np.int32)
+        self.areas = np.zeros((len(self.classIds), 0), np.float32)
+        self.polygons = np.zeros(0, np.int32)
+        self.proposals = np.zeros(0, np.int32)
+        # summaries of images the list does not show yet, they move into the columns when the image is appended
+        self.detached = {}
+        # annotations committed since the last read, summarized by the next query instead of on every commit
+        self.changed = {}
+
+    def __len__(self):
+        return self.size
+
+    def insertImages(self, row, keys):
+        # the scanner inserts between existing rows batch after batch; the columns follow on the next read,
+        # moving them once per insert would copy every column for each run of rows
+        self.keys[row:row] = keys
+        self.size += len(keys)
+        self.version += 1
+
+    def placeRows(self):
+        # rows[key] and the columns in the order of keys, the images new to the list take their detached summary
+        previous = np.array([self.rows.get(key, -1) for key in self.keys], np.int64)
+        known = previous >= 0
+        for name in ('counts', 'areas', 'polygons', 'proposals'):
+            column = getattr(self, name)
+            placed = np.zeros(column.shape[:-1] + (self.size,), column.dtype)
+            placed[..., known] = column[..., previous[known]]
+            setattr(self, name, placed)
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        for row in np.flatnonzero(~known):
+            summary = self.detached.pop(self.keys[row], None)
+            if summary is not None:
+                self.assign(row, *summary)
+
+    def assign(self, row, reviewed, proposals):
+        # reviewed: {classId: (polygons, area)} or None to keep them, proposals: polygon count or None
+        if reviewed is not None:
+            self.counts[:, row] = 0
+            self.areas[:, row] = 0.0
+            for classId, (count, area) in reviewed.items():
+                column = self.columns.get(classId)
+                if column is not None:
+                    self.counts[column, row] = count
+                    self.areas[column, row] = area
+            self.polygons[row] = self.counts[:, row].sum()
+        if proposals is not None:
+            self.proposals[row] = proposals
+
+    def setImage(self, key, reviewed, proposals=None):
+        self.version += 1
+        row = self.rows.get(key)
+        if row is not None:
+            self.assign(row, reviewed, proposals)
+            return
+        previous = self.detached.get(key, ({}, 0))
+        self.detached[key] = (previous[0] if reviewed is None else reviewed,
+                              previous[1] if proposals is None else proposals)
+
+    def update(self, key, colorDict, proposals=None):
+        # called on every commit with what is written to the store; the class lists are copied, the editor
+        # reuses its dictionaries for the next image
+        self.changed[key] = ({classId: list(polygons) for classId, polygons in colorDict.items()},
+                             None if proposals is None else
+                             {classId: list(polygons) for classId, polygons in proposals.items()})
+        self.version += 1
+
+    def settle(self):
+        if len(self.rows) != self.size:
+            self.placeRows()
+        changed, self.changed = self.changed, {}
+        for key, (colorDict, proposals) in changed.items():
+            self.setImage(key, summarize(colorDict),
+                          None if proposals is None else sum(count for count, _ in summarize(proposals).values()))
+
+    def load(self, statistics, fallback=()):
+        # statistics: (key, classId, reviewed, polygons, area) rows of the store; fallback: (key, classId,
+        # polygons, area) rows of the archive, used for images the store knows nothing about
+        self.settle()
+        summaries = {}
+        for key, classId, reviewed, count, area in statistics:
+            summary = summaries.setdefault(key, [{}, 0])
+            if reviewed:
+                summary[0][classId] = (count, area)
+            else:
+                summary[1] += count
+        stored = set(summaries)
+        for key, classId, count, area in fallback:
+            if key not in stored:
+                summaries.setdefault(key, [{}, 0])[0][classId] = (count, area)
+        for key, (reviewed, proposals) in summaries.items():
+            self.setImage(key, reviewed, proposals)
+
+    def classCounts(self, key):
+        self.settle()
+        row = self.rows.get(key)
+        if row is None:
+            summary = self.detached.get(key)
+            return {classId: count for classId, (count, _) in summary[0].items() if count} if summary else {}
+        return {classId: int(count) for classId, count in zip(self.classIds, self.counts[:, row]) if count}
+
+    # #-------------------------------------------------------------------------------------------------------------------
+    # #   Queries
+    # # -----------------------------------------------------------------------------------------------------------------
+
+    def classColumn(self, name):
+        classId = self.names.get(categoryKey(name))
+        if classId is None:
+            raise ValueError('unknown class %r' % name)
+        return self.columns[classId]
+
+    def termMask(self, term):
+        match = TERM.match(term)
+        if match is None:
+            raise ValueError('cannot parse %r' % term)
+        negate, name, area, operator, value = match.groups()
+        name = name.lower()
+        polygons, proposals = self.polygons[:self.size], self.proposals[:self.size]
+        if name in STATES and not area and not operator:
+            if name == 'unannotated':
+                mask = (polygons == 0) & (proposals == 0)
+            elif name == 'annotated':
+                mask = polygons > 0
+            elif name == 'unreviewed':
+                mask = proposals > 0
+            else:
+                mask = (polygons > 0) & (proposals == 0)
+        else:
+            if name == 'polygons':
+                column = polygons
+            elif name == 'proposals':
+                column = proposals
+            elif name == 'area':
+                column = self.areas[:, :self.size].sum(axis=0)
+            elif area:
+                column = self.areas[self.classColumn(name), :self.size]
+            else:
+                column = self.counts[self.classColumn(name), :self.size]
+            if operator is None:
+                mask = column > 0
+            else:
+                threshold = float(value)
+                # an integer threshold keeps count columns from being converted to float
+                mask = COMPARISONS[operator](column, int(threshold) if threshold.is_integer() else threshold)
+        return ~mask if negate else mask
+
+    def query(self, text):
+        # sorted rows of the images matching every term; raises ValueError for an expression it cannot parse
+        self.settle()
+        mask = np.ones(self.size, bool)
+        for term in text.split():
+            mask &= self.termMask(term)
+        return np.flatnonzero(mask)
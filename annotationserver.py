@@ -0,0 +1,616 @@
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import deque
+
+from annotationstore import AnnotationStore
+
+log = logging.getLogger('annotationserver')
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Protocol: one JSON object per line in both directions over a persistent TCP connection,
+# #   polygon points travel as base64 encoded float32 buffers
+# # -----------------------------------------------------------------------------------------------------------------------
+
+DEFAULT_PORT = 8765
+
+
+def encodePoints(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def decodePoints(text):
+    return base64.b64decode(text)
+
+
+def applyOps(polygons, ops):
+    # polygons: {polygon id: (classId, bytes)}, changed in place
+    for op in ops:
+        if op['op'] == 'put':
+            polygons[op['id']] = (op['class'], decodePoints(op['points']))
+        elif op['op'] == 'delete':
+            polygons.pop(op['id'], None)
+
+
+class ImageState(object):
+    # server side state of one image: polygons by id, a version and the ops of the last versions
+    def __init__(self, polygons):
+        self.polygons = polygons
+        self.version = 1
+        self.journal = deque(maxlen=64)
+        self.dirty = False
+
+    def apply(self, ops):
+        applyOps(self.polygons, ops)
+        self.version += 1
+        self.journal.append((self.version, ops))
+        self.dirty = True
+
+    def opsSince(self, version):
+        # None when the journal no longer reaches back to that version
+        if version == self.version:
+            return []
+        if not self.journal or self.journal[0][0] > version + 1:
+            return None
+        return [op for journalVersion, ops in self.journal if journalVersion > version for op in ops]
+
+    def colorDict(self):
+        colorDict = {}
+        for classId, data in self.polygons.values():
+            colorDict.setdefault(classId, []).append(array('f', data))
+        return colorDict
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   AnnotationServer, owns the store of the directory and hands out image leases
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class AnnotationServer(object):
+    def __init__(self, directory, leaseSeconds=120.0, flushInterval=0.5):
+        self.store = AnnotationStore.forDirectory(directory)
+        self.session = uuid.uuid4().hex
+        self.leaseSeconds = leaseSeconds
+        self.flushInterval = flushInterval
+        self.images = {}
+        # image key -> [client, expiry]
+        self.leases = {}
+        self.clients = {}
+        self.server = None
+
+    def state(self, key):
+        state = self.images.get(key)
+        if state is None:
+            polygons = {}
+            for classId, points in sorted(self.store.load(key).items()):
+                for index, data in enumerate(points):
+                    polygons['s%d-%d' % (classId, index)] = (classId, data.tobytes())
+            state = self.images[key] = ImageState(polygons)
+        return state
+
+    def leaseHolder(self, key):
+        lease = self.leases.get(key)
+        if lease is None or lease[1] < time.monotonic():
+            return None
+        return lease[0]
+
+    def renew(self, client):
+        expiry = time.monotonic() + self.leaseSeconds
+        for lease in self.leases.values():
+            if lease[0] == client:
+                lease[1] = expiry
+
+    def releaseAll(self, client):
+        for key in [key for key, lease in self.leases.items() if lease[0] == client]:
+            del self.leases[key]
+
+    def handle(self, client, request):
+        command = request.get('command')
+        key = request.get('image')
+        if command == 'hello':
+            return {'session': self.session, 'leaseSeconds': self.leaseSeconds}
+        if command == 'ping':
+            return {}
+        if command == 'lease':
+            holder = self.leaseHolder(key)
+            if holder is not None and holder != client:
+                return {'granted': False, 'holder': self.clients.get(holder, holder)}
+            self.leases[key] = [client, time.monotonic() + self.leaseSeconds]
+            return {'granted': True}
+        if command == 'release':
+            if self.leaseHolder(key) == client:
+                del self.leases[key]
+            return {}
+        if command == 'load':
+            state = self.state(key)
+            ops = None if request.get('session') != self.session else state.opsSince(request.get('version', 0))
+            if ops is not None:
+                return {'version': state.version, 'ops': ops}
+            return {'version': state.version,
+                    'polygons': {pid: [classId, encodePoints(data)] for pid, (classId, data) in state.polygons.items()}}
+        if command == 'apply':
+            holder = self.leaseHolder(key)
+            if holder is not None and holder != client:
+                return {'error': 'image is leased by %s' % self.clients.get(holder, holder)}
+            state = self.state(key)
+            state.apply(request['ops'])
+            return {'version': state.version}
+        if command == 'flush':
+            self.flush()
+            return {}
+        return {'error': 'unknown command %r' % command}
+
+    def flush(self):
+        # all images changed since the last flush go to SQLite in one transaction
+        dirty = [(key, state) for key, state in self.images.items() if state.dirty]
+        if not dirty:
+            return
+        self.store.saveMany((key, state.colorDict()) for key, state in dirty)
+        for key, state in dirty:
+            state.dirty = False
+
+    async def serveClient(self, reader, writer):
+        client = uuid.uuid4().hex
+        self.clients[client] = str(writer.get_extra_info('peername'))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if request.get('command') == 'hello' and request.get('name'):
+                    self.clients[client] = request['name']
+                self.renew(client)
+                try:
+                    response = self.handle(client, request)
+                except Exception as error:
+                    response = {'error': str(error)}
+                response['id'] = request.get('id')
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.releaseAll(client)
+            self.clients.pop(client, None)
+            writer.close()
+
+    async def flushPeriodically(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            self.flush()
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        # a line carries a whole image diff, well above the default 64 KiB stream limit
+        self.server = await asyncio.start_server(self.serveClient, host, port, limit=1 << 28)
+        flusher = asyncio.ensure_future(self.flushPeriodically())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            flusher.cancel()
+            self.flush()
+            self.store.close()
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   RemoteAnnotationStore, the client: same interface as AnnotationStore for the editor, reviewed annotations
+# #   live on the server and are synced as per image diffs, proposals stay in the local store
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class RemoteAnnotationStore(object):
+    # the editor only waits for loads and leases, with interactiveTimeout, and works on the cached snapshots
+    # while the server is unreachable; diffs, releases and pings are queued for a sender thread that keeps
+    # the connection up, reconnecting with exponential backoff. Diffs are journaled in the outbox of the local
+    # store until the server has applied them and are sent again after a restart; diffs the server refuses
+    # move to its conflict table and are reported through conflictHandler(image key, reason), on the sender
+    minBackoff = 0.5
+    maxBackoff = 30.0
+
+    def __init__(self, address, local, name=None, timeout=10.0, interactiveTimeout=5.0):
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port or DEFAULT_PORT))
+        self.local = local
+        self.root = local.root
+        self.name = name or '%s@%s' % (os.environ.get('USER', 'annotator'), socket.gethostname())
+        self.timeout = timeout
+        self.interactiveTimeout = interactiveTimeout
+        # the connection serves one request at a time, from the editor or from the sender
+        self.lock = threading.RLock()
+        self.connection = None
+        self.buffer = bytearray()
+        self.connected = threading.Event()
+        # False once the sender failed to connect, the editor then stops waiting for it
+        self.reachable = True
+        self.requestId = 0
+        self.session = None
+        self.conflictHandler = None
+        # guards everything below, shared with the sender thread
+        self.condition = threading.Condition()
+        # image key -> (version, {polygon id: (classId, bytes)}, {polygon id: array handed to the editor})
+        self.snapshots = {}
+        # [command, arguments, outbox row id] not seen by the sender yet, and those it journaled and sends next
+        self.incoming = []
+        self.queue = deque()
+        # image key -> ops queued or journaled but not applied by the server yet, in order
+        self.unsent = {}
+        # leases are given up with the connection, the sender asks for them again when it reconnects
+        self.leased = set()
+        self.closing = False
+        # refused diffs of a store without an outbox, (image key, reason)
+        self.refused = []
+        # ids of new polygons are unique per client, the server never has to rename them
+        self.clientId = uuid.uuid4().hex[:12]
+        self.counter = 0
+        self.journaled = local.database != ':memory:'
+        if self.journaled:
+            for rowId, key, ops in local.outbox():
+                self.queue.append(['apply', {'image': key, 'ops': ops}, rowId])
+                self.unsent.setdefault(key, []).append(ops)
+            if self.queue:
+                log.warning('sending %d annotation diffs left over from the last session', len(self.queue))
+        self.sender = threading.Thread(target=self.sendLoop, name='annotation sender', daemon=True)
+        self.sender.start()
+
+    def connect(self):
+        # on the sender thread only
+        connection = socket.create_connection(self.address, self.timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.connection = connection
+            self.buffer = bytearray()
+            session = self.request('hello', name=self.name)['session']
+            with self.condition:
+                if session != self.session:
+                    # a restarted server numbers its versions from scratch
+                    self.snapshots.clear()
+                    self.session = session
+                leased = sorted(self.leased)
+            for key in leased:
+                response = self.request('lease', image=key)
+                if not response['granted']:
+                    log.warning('%s was leased by %s while the connection was down', key, response.get('holder'))
+            self.connected.set()
+
+    def disconnect(self):
+        with self.lock:
+            self.connected.clear()
+            if self.connection is not None:
+                try:
+                    self.connection.close()
+                except OSError:
+                    pass
+                self.connection = None
+        # the sender reconnects
+        with self.condition:
+            self.condition.notify_all()
+
+    def request(self, command, timeout=None, interactive=False, **arguments):
+        # the whole round trip takes at most timeout (default self.timeout); interactive requests of the
+        # editor wait within it for the sender to connect. Raises OSError or ValueError when the connection
+        # is down or breaks, RuntimeError when the server refuses
+        deadline = time.monotonic() + (timeout or self.timeout)
+        if interactive and not (self.reachable and self.connected.wait(self.remaining(deadline))):
+            raise ConnectionError('not connected to the annotation server')
+        if not self.lock.acquire(timeout=self.remaining(deadline)):
+            raise ConnectionError('annotation server busy')
+        try:
+            if self.connection is None:
+                raise ConnectionError('not connected to the annotation server')
+            self.requestId += 1
+            arguments.update(command=command, id=self.requestId)
+            try:
+                self.connection.settimeout(self.remaining(deadline))
+                self.connection.sendall(json.dumps(arguments).encode('utf-8') + b'\n')
+                response = json.loads(self.readLine(deadline))
+            except (OSError, ValueError):
+                # a late answer would be taken for the answer to the next request
+                self.disconnect()
+                raise
+        finally:
+            self.lock.release()
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    @staticmethod
+    def remaining(deadline):
+        return max(0.001, deadline - time.monotonic())
+
+    def readLine(self, deadline):
+        # only the bytes received since the last look are searched for the end of the line
+        searched = 0
+        end = self.buffer.find(b'\n')
+        while end < 0:
+            if time.monotonic() >= deadline:
+                raise socket.timeout('annotation server did not answer in time')
+            self.connection.settimeout(self.remaining(deadline))
+            data = self.connection.recv(1 << 16)
+            if not data:
+                raise ConnectionError('annotation server closed the connection')
+            searched = len(self.buffer)
+            self.buffer += data
+            end = self.buffer.find(b'\n', searched)
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+        return line
+
+    def post(self, command, **arguments):
+        item = [command, arguments, None]
+        with self.condition:
+            self.incoming.append(item)
+            self.condition.notify_all()
+        return item
+
+    def isQueued(self, item):
+        return any(queued is item for queued in itertools.chain(self.incoming, self.queue))
+
+    def sendLoop(self):
+        # keeps the connection up, journals what was posted and sends the queue in order; on close it journals
+        # what is left and sends as much of it as the open connection takes
+        outbox = AnnotationStore(self.local.database, self.local.root) if self.journaled else None
+        backoff, retryAt = self.minBackoff, 0.0
+        try:
+            while True:
+                with self.condition:
+                    while not (self.closing or self.incoming or
+                               ((self.queue or self.connection is None) and time.monotonic() >= retryAt)):
+                        busy = self.queue or self.connection is None
+                        self.condition.wait(max(0.0, retryAt - time.monotonic()) if busy else None)
+                    closing = self.closing
+                    received, self.incoming = self.incoming, []
+                for item in received:
+                    if item[0] == 'apply' and outbox is not None:
+                        item[2] = outbox.appendOutbox(item[1]['image'], item[1]['ops'])
+                with self.condition:
+                    self.queue.extend(received)
+                while closing or time.monotonic() >= retryAt:
+                    try:
+                        if self.connection is None:
+                            if closing:
+                                break
+                            self.connect()
+                            self.reachable = True
+                            backoff = self.minBackoff
+                        with self.condition:
+                            if not self.queue:
+                                break
+                            command, arguments, rowId = self.queue[0]
+                        refused = None
+                        try:
+                            response = self.request(command, **arguments)
+                        except RuntimeError as error:
+                            refused, response = str(error), None
+                    except (OSError, ValueError) as error:
+                        self.disconnect()
+                        self.reachable = False
+                        if closing:
+                            break
+                        log.warning('annotation server %s:%d unreachable (%s), retrying in %.1f s', self.address[0],
+                                    self.address[1], error, backoff)
+                        retryAt = time.monotonic() + backoff
+                        backoff = min(2 * backoff, self.maxBackoff)
+                        break
+                    if command == 'apply':
+                        self.applied(arguments['image'], response)
+                        if refused is not None:
+                            self.refuse(outbox, rowId, arguments['image'], refused)
+                        elif rowId is not None:
+                            outbox.removeOutbox(rowId)
+                    elif refused is not None:
+                        log.error('the annotation server refused %s of %s: %s', command, arguments.get('image'),
+                                  refused)
+                    with self.condition:
+                        self.queue.popleft()
+                        self.condition.notify_all()
+                if closing:
+                    return
+        finally:
+            if outbox is not None:
+                outbox.close()
+
+    def refuse(self, outbox, rowId, key, reason):
+        # the diff is kept, the operator decides what happens to it
+        log.error('the annotation server refused the changes to %s: %s', key, reason)
+        if rowId is not None:
+            outbox.refuseOutbox(rowId, reason)
+        else:
+            with self.condition:
+                self.refused.append((key, reason))
+        if self.conflictHandler is not None:
+            self.conflictHandler(key, reason)
+
+    def conflicts(self):
+        # (image key, reason) of the refused diffs, oldest first
+        if self.journaled:
+            return self.local.conflicts()
+        with self.condition:
+            return list(self.refused)
+
+    def applied(self, key, response):
+        with self.condition:
+            self.unsent[key].pop(0)
+            if not self.unsent[key]:
+                del self.unsent[key]
+            snapshot = self.snapshots.get(key)
+            if snapshot is None:
+                return
+            if response is None:
+                # refused: the snapshot holds changes the server does not have, the next load fetches it whole
+                self.snapshots[key] = (0,) + snapshot[1:]
+            else:
+                self.snapshots[key] = (max(snapshot[0], response['version']),) + snapshot[1:]
+
+    def key(self, filename):
+        return self.local.key(filename)
+
+    def lease(self, filename):
+        key = self.key(filename)
+        try:
+            response = self.request('lease', timeout=self.interactiveTimeout, interactive=True, image=key)
+        except (OSError, ValueError) as error:
+            # changes the server refuses later end up in the conflict table
+            log.warning('leasing %s failed (%s), working on it offline', key, error)
+            response = {'granted': True}
+        if response['granted']:
+            with self.condition:
+                self.leased.add(key)
+        return response['granted'], response.get('holder')
+
+    def release(self, filename):
+        if filename:
+            key = self.key(filename)
+            with self.condition:
+                self.leased.discard(key)
+            self.post('release', image=key)
+
+    def ping(self):
+        # renews the leases
+        with self.condition:
+            if any(item[0] == 'ping' for item in itertools.chain(self.incoming, self.queue)):
+                return
+        self.post('ping')
+
+    def flush(self):
+        # the server writes its store once the diffs queued before have arrived, waits at most timeout
+        item = self.post('flush')
+        with self.condition:
+            self.condition.wait_for(lambda: not self.isQueued(item), self.timeout)
+
+    def __contains__(self, filename):
+        return bool(filename)
+
+    def __getitem__(self, filename):
+        return self.load(filename)
+
+    def load(self, filename, reviewed=True):
+        if not reviewed:
+            return self.local.load(filename, reviewed=False)
+        key = self.key(filename)
+        with self.condition:
+            cached = key in self.snapshots
+            version, polygons, arrays = self.snapshots.get(key, (0, {}, {}))
+            session = self.session
+        try:
+            response = self.request('load', timeout=self.interactiveTimeout, interactive=True, image=key,
+                                    version=version, session=session)
+        except (OSError, ValueError) as error:
+            log.warning('loading %s from the annotation server failed (%s), showing the cached annotations', key,
+                        error)
+            response = None
+        with self.condition:
+            if response is not None and 'ops' in response:
+                # only what changed since the cached version crosses the wire
+                polygons = dict(polygons)
+                applyOps(polygons, response['ops'])
+            elif response is not None:
+                polygons = {pid: (classId, decodePoints(data))
+                            for pid, (classId, data) in response['polygons'].items()}
+            if response is not None or not cached:
+                # diffs still on their way to the server
+                polygons = dict(polygons)
+                for ops in self.unsent.get(key, ()):
+                    applyOps(polygons, ops)
+            colorDict = {}
+            arrays = {}
+            for pid, (classId, data) in sorted(polygons.items()):
+                points = array('f')
+                points.frombytes(data)
+                arrays[pid] = points
+                colorDict.setdefault(classId, []).append(points)
+            self.snapshots[key] = (version if response is None else response['version'], polygons, arrays)
+        return colorDict
+
+    def save(self, filename, colorDict, proposals=None):
+        # never waits for the server: the diff against the snapshot is queued for the sender
+        if not filename:
+            return
+        if proposals is not None:
+            # the reviewed rows of the shared store belong to the server, only the proposals are written here
+            self.local.saveLater(filename, None, proposals)
+        key = self.key(filename)
+        with self.condition:
+            version, polygons, arrays = self.snapshots.get(key, (0, {}, {}))
+            known = {id(points): pid for pid, points in arrays.items()}
+            current, currentArrays, ops = {}, {}, []
+            for classId, classPolygons in colorDict.items():
+                for points in classPolygons:
+                    if not len(points):
+                        continue
+                    pid = known.get(id(points))
+                    if pid is None:
+                        self.counter += 1
+                        pid = '%s-%d' % (self.clientId, self.counter)
+                    data = points.tobytes()
+                    current[pid] = (classId, data)
+                    currentArrays[pid] = points
+                    if polygons.get(pid) != (classId, data):
+                        ops.append({'op': 'put', 'id': pid, 'class': classId, 'points': encodePoints(data)})
+            ops.extend({'op': 'delete', 'id': pid} for pid in polygons if pid not in current)
+            self.snapshots[key] = (version, current, currentArrays)
+            if ops:
+                self.unsent.setdefault(key, []).append(ops)
+                self.incoming.append(['apply', {'image': key, 'ops': ops}, None])
+                self.condition.notify_all()
+
+    def saveLater(self, filename, colorDict, proposals=None):
+        self.save(filename, colorDict, proposals)
+
+    def classCounts(self):
+        # counts of the other annotators' images are not mirrored, only images opened here are counted
+        return {}
+
+    def statistics(self):
+        # same for the annotation index: the local proposals are indexed, the shared annotations are not
+        return (row for row in self.local.statistics() if not row[2])
+
+    def isEmptied(self, filename):
+        # every image is loaded from the server, never from the archive
+        return False
+
+    def isPreannotated(self, filename):
+        return self.local.isPreannotated(filename)
+
+    def setPreannotated(self, filename, model):
+        self.local.setPreannotated(filename, model)
+
+    def path(self, key):
+        return self.local.path(key)
+
+    def close(self):
+        # what the server did not take before the connection closes stays journaled for the next start
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.sender.join()
+        self.disconnect()
+        self.local.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a directory of parcel annotations to several editors')
+    parser.add_argument('directory', help='image directory containing the annotation store')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--lease', type=float, default=120.0, help='seconds an image lease lasts without activity')
+    parser.add_argument('--flush-interval', type=float, default=0.5, help='seconds between batched store writes')
+    args = parser.parse_args(argv)
+    server = AnnotationServer(args.directory, args.lease, args.flush_interval)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
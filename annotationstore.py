@@ -0,0 +1,454 @@
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from array import array
+
+from geometry import toPolygon, polygonArea, polygonAreas
+
+log = logging.getLogger('annotationstore')
+
+# classId of the imageStats row marking an image whose annotations were all deleted, the archive must not
+# bring them back
+EMPTY_IMAGE = -1
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Point conversion
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def pointsToArray(points):
+    # flat float32 buffer x0, y0, x1, y1, ... instead of a list of QPointF objects
+    if isinstance(points, array):
+        return points
+    flat = array('f')
+    for p in points:
+        flat.append(p.x())
+        flat.append(p.y())
+    return flat
+
+
+def arrayToPairs(flat):
+    return [(flat[i], flat[i + 1]) for i in range(0, len(flat) - 1, 2)]
+
+
+def copyPolygons(colorDict):
+    # the editor keeps mutating its point buffers in place, a queued write needs its own copy
+    return {classId: [array('f', points) for points in polygons] for classId, polygons in colorDict.items()}
+
+
+def summarize(colorDict):
+    # {classId: (polygons, summed area)}, empty polygons are not stored and not counted
+    summary = {}
+    for classId, polygons in colorDict.items():
+        polygons = [points for points in polygons if len(points)]
+        if polygons:
+            summary[classId] = (len(polygons), float(polygonAreas(polygons).sum()))
+    return summary
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   AnnotationJournal, append-only write-ahead log of the background writes for crash recovery
+# # -----------------------------------------------------------------------------------------------------------------------
+
+RECORD = struct.Struct('<II')
+
+
+class AnnotationJournal(object):
+    # record: payload length, crc32, payload = JSON header line + the raw float32 point buffers
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+
+    def append(self, snapshots):
+        # (key, colorDict, proposals) snapshots of one batch, made durable with a single fsync
+        for key, colorDict, proposals in snapshots:
+            polygons, blobs = [], []
+            for reviewed, classPolygons in ((1, colorDict), (0, proposals)):
+                for classId, points in (classPolygons or {}).items():
+                    for data in points:
+                        blob = pointsToArray(data).tobytes()
+                        polygons.append((reviewed, classId, len(blob)))
+                        blobs.append(blob)
+            payload = json.dumps({'image': key, 'reviewed': colorDict is not None, 'proposals': proposals is not None,
+                                  'polygons': polygons}).encode('utf-8') + b'\n' + b''.join(blobs)
+            self.file.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def size(self):
+        return self.file.tell()
+
+    def records(self):
+        # (key, colorDict, proposals) in write order, up to the first torn or corrupt record
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, offset)
+            payload = data[offset + RECORD.size:offset + RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                log.warning('%s: dropping a torn record at byte %d', self.path, offset)
+                return
+            offset += RECORD.size + length
+            header, _, blobs = payload.partition(b'\n')
+            header = json.loads(header.decode('utf-8'))
+            colorDict, proposals, position = {}, {}, 0
+            for reviewed, classId, size in header['polygons']:
+                points = array('f')
+                points.frombytes(blobs[position:position + size])
+                position += size
+                (colorDict if reviewed else proposals).setdefault(classId, []).append(points)
+            yield (header['image'], colorDict if header.get('reviewed', True) else None,
+                   proposals if header['proposals'] else None)
+
+    def truncate(self):
+        self.file.truncate(0)
+        self.file.seek(0)
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   AnnotationStore
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class AnnotationStore(object):
+    # SQLite (WAL) backed polygons, one row per polygon, loaded per image on demand
+    fileName = '.annotations.sqlite'
+    journalName = '.annotations.journal'
+    # the journal is folded into the database (and emptied) once it grows past this
+    maxJournalBytes = 8 * 1024 * 1024
+
+    def __init__(self, path=':memory:', root=None, journal=False):
+        self.connection = None
+        self.journal = None
+        self.root = root
+        # background writes: image key -> queued snapshot, the keys being written and the writer thread
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.writing = set()
+        self.writer = None
+        self.open(path, root, journal)
+
+    def open(self, path, root=None, journal=False):
+        self.close()
+        self.root = root
+        self.database = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL only fsyncs on checkpoints, a committed image survives an application crash
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS polygons ('
+                                'image TEXT NOT NULL, '
+                                'classId INTEGER NOT NULL, '
+                                'polyIndex INTEGER NOT NULL, '
+                                'points BLOB NOT NULL, '
+                                'reviewed INTEGER NOT NULL DEFAULT 1)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(polygons)')]
+        if 'reviewed' not in columns:
+            self.connection.execute('ALTER TABLE polygons ADD COLUMN reviewed INTEGER NOT NULL DEFAULT 1')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS polygonsImage ON polygons (image)')
+        # per image and class summary of the polygons, kept in step by write() for the annotation index
+        summarized = self.connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'imageStats'").fetchone()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS imageStats ('
+                                'image TEXT NOT NULL, '
+                                'classId INTEGER NOT NULL, '
+                                'reviewed INTEGER NOT NULL, '
+                                'polygons INTEGER NOT NULL, '
+                                'area REAL NOT NULL, '
+                                'PRIMARY KEY (image, classId, reviewed)) WITHOUT ROWID')
+        if summarized is None:
+            self.summarizeAll()
+        # images that already received model proposals, deleting them must not bring them back
+        self.connection.execute('CREATE TABLE IF NOT EXISTS preannotated ('
+                                'image TEXT PRIMARY KEY, '
+                                'model TEXT NOT NULL)')
+        # diffs of a RemoteAnnotationStore that the server has not applied yet, in the order they were made
+        self.connection.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'image TEXT NOT NULL, '
+                                'ops TEXT NOT NULL)')
+        # diffs the server refused, kept for the operator
+        self.connection.execute('CREATE TABLE IF NOT EXISTS conflicts ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'image TEXT NOT NULL, '
+                                'ops TEXT NOT NULL, '
+                                'reason TEXT NOT NULL)')
+        self.connection.commit()
+        if journal and path != ':memory:':
+            self.journal = AnnotationJournal(os.path.join(os.path.dirname(os.path.abspath(path)), self.journalName))
+            self.recover()
+
+    def summarizeAll(self):
+        # one pass over a store written before imageStats existed
+        summaries = {}
+        for key, classId, reviewed, blob in self.connection.execute('SELECT image, classId, reviewed, points '
+                                                                    'FROM polygons'):
+            count, area = summaries.get((key, classId, reviewed), (0, 0.0))
+            if len(blob) >= 24:
+                area += polygonArea(toPolygon(blob))
+            summaries[(key, classId, reviewed)] = (count + 1, area)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO imageStats (image, classId, reviewed, polygons, area) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        (group + summary for group, summary in summaries.items()))
+        if summaries:
+            log.info('summarized the annotations of %d image classes', len(summaries))
+
+    def recover(self):
+        # snapshots journaled before a crash are replayed, a write that did reach the database is repeated
+        records = list(self.journal.records())
+        if records:
+            with self.connection:
+                for key, colorDict, proposals in records:
+                    self.write(key, colorDict, proposals)
+            log.warning('recovered %d annotation snapshots from %s', len(records), self.journal.path)
+        self.checkpoint(self.connection)
+
+    def checkpoint(self, connection):
+        # the journal can only go once the database file itself is synced
+        busy = connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[0]
+        if not busy:
+            self.journal.truncate()
+
+    @classmethod
+    def forDirectory(cls, directory, journal=False):
+        return cls(os.path.join(directory, cls.fileName), directory, journal)
+
+    def key(self, filename):
+        if self.root and os.path.dirname(filename) == self.root.rstrip('/'):
+            return os.path.basename(filename)
+        return filename
+
+    def __contains__(self, filename):
+        self.wait(filename)
+        row = self.connection.execute('SELECT 1 FROM polygons WHERE image = ? LIMIT 1',
+                                      (self.key(filename),)).fetchone()
+        return row is not None
+
+    def __getitem__(self, filename):
+        return self.load(filename)
+
+    def __setitem__(self, filename, colorDict):
+        self.save(filename, colorDict)
+
+    def load(self, filename, reviewed=True):
+        # reviewed=False loads the unreviewed model proposals instead of the annotations
+        self.wait(filename)
+        colorDict = {}
+        rows = self.connection.execute('SELECT classId, points FROM polygons WHERE image = ? AND reviewed = ? '
+                                       'ORDER BY classId, polyIndex', (self.key(filename), int(reviewed)))
+        for classId, blob in rows:
+            points = array('f')
+            points.frombytes(blob)
+            colorDict.setdefault(classId, []).append(points)
+        return colorDict
+
+    def save(self, filename, colorDict, proposals=None):
+        # without proposals the stored proposals of the image are left untouched, without colorDict (None) its
+        # annotations
+        if not filename:
+            return
+        if self.journal is not None:
+            # journaled stores write everything on the writer thread, so the journal keeps the write order
+            self.saveLater(filename, colorDict, proposals)
+            self.wait(filename)
+            return
+        self.wait(filename)
+        with self.connection:
+            self.write(filename, colorDict, proposals)
+
+    def saveLater(self, filename, colorDict, proposals=None):
+        # same as save, but written by a background thread on its own connection; a newer snapshot of an
+        # image replaces one that is still queued, reads of that image wait until it is written
+        if not filename:
+            return
+        if self.database == ':memory:':
+            self.save(filename, colorDict, proposals)
+            return
+        snapshot = (filename, None if colorDict is None else copyPolygons(colorDict),
+                    None if proposals is None else copyPolygons(proposals))
+        with self.condition:
+            queued = self.pending.get(self.key(filename))
+            if queued is not None:
+                # what the newer snapshot leaves untouched is still written from the queued one
+                snapshot = (filename, queued[1] if snapshot[1] is None else snapshot[1],
+                            queued[2] if snapshot[2] is None else snapshot[2])
+            self.pending[self.key(filename)] = snapshot
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.writeLoop, name='annotation writer', daemon=True)
+                self.writer.start()
+            self.condition.notify_all()
+
+    def writeLoop(self):
+        # everything queued since the last round is one batch: one journal fsync and one transaction
+        store = AnnotationStore(self.database, self.root)
+        try:
+            while True:
+                with self.condition:
+                    while not self.pending and self.writer is not None:
+                        self.condition.wait()
+                    if not self.pending:
+                        return
+                    batch = [(key,) + snapshot[1:] for key, snapshot in self.pending.items()]
+                    self.writing = set(self.pending)
+                    self.pending = {}
+                try:
+                    if self.journal is not None:
+                        self.journal.append(batch)
+                    store.saveMany(batch)
+                    if self.journal is not None and self.journal.size() > self.maxJournalBytes:
+                        self.checkpoint(store.connection)
+                except (sqlite3.Error, OSError):
+                    log.exception('writing the annotations of %d images failed', len(batch))
+                finally:
+                    with self.condition:
+                        self.writing = set()
+                        self.condition.notify_all()
+        finally:
+            if self.journal is not None:
+                try:
+                    self.checkpoint(store.connection)
+                except (sqlite3.Error, OSError):
+                    log.exception('folding the journal into the database failed')
+            store.close()
+
+    def wait(self, filename=None):
+        # blocks until the queued writes of filename (or of every image) are in the database
+        key = None if filename is None else self.key(filename)
+        with self.condition:
+            while (key in self.pending or key in self.writing) if key is not None else (self.pending or self.writing):
+                self.condition.wait()
+
+    def flush(self):
+        self.wait()
+
+    def saveMany(self, entries):
+        # (filename, colorDict[, proposals]) entries written in a single transaction
+        with self.connection:
+            for entry in entries:
+                self.write(*entry)
+
+    def write(self, filename, colorDict, proposals=None):
+        # colorDict None leaves the annotations alone, proposals None the proposals
+        key = self.key(filename)
+        replaced = [(reviewed, polygons) for reviewed, polygons in ((1, colorDict), (0, proposals))
+                    if polygons is not None]
+        rows = [(key, classId, polyIndex, pointsToArray(points).tobytes(), reviewed)
+                for reviewed, polygons in replaced
+                for classId, classPolygons in polygons.items()
+                for polyIndex, points in enumerate(classPolygons)
+                if len(points)]
+        for reviewed, _ in replaced:
+            self.connection.execute('DELETE FROM polygons WHERE image = ? AND reviewed = ?', (key, reviewed))
+            self.connection.execute('DELETE FROM imageStats WHERE image = ? AND reviewed = ?', (key, reviewed))
+        self.connection.executemany('INSERT INTO polygons (image, classId, polyIndex, points, reviewed) '
+                                    'VALUES (?, ?, ?, ?, ?)', rows)
+        stats = [(key, classId, reviewed, count, area)
+                 for reviewed, polygons in replaced
+                 for classId, (count, area) in summarize(polygons).items()]
+        if colorDict is not None and not any(row[4] for row in rows):
+            stats.append((key, EMPTY_IMAGE, 1, 0, 0.0))
+        self.connection.executemany('INSERT INTO imageStats (image, classId, reviewed, polygons, area) '
+                                    'VALUES (?, ?, ?, ?, ?)', stats)
+
+    def classCounts(self):
+        # {image key: {classId: polygons}} for the whole store in one grouped scan
+        self.wait()
+        counts = {}
+        for key, classId, count in self.connection.execute('SELECT image, classId, polygons FROM imageStats '
+                                                           'WHERE reviewed = 1 AND polygons > 0'):
+            counts.setdefault(key, {})[classId] = count
+        return counts
+
+    def statistics(self):
+        # (image key, classId, reviewed, polygons, area) for every image and class in the store, emptied images
+        # have a single EMPTY_IMAGE row
+        self.wait()
+        return self.connection.execute('SELECT image, classId, reviewed, polygons, area FROM imageStats')
+
+    def isEmptied(self, filename):
+        # True once every annotation of the image was deleted here, whatever the archive holds
+        self.wait(filename)
+        row = self.connection.execute('SELECT 1 FROM imageStats WHERE image = ? AND classId = ?',
+                                      (self.key(filename), EMPTY_IMAGE)).fetchone()
+        return row is not None
+
+    def isPreannotated(self, filename):
+        row = self.connection.execute('SELECT 1 FROM preannotated WHERE image = ?', (self.key(filename),)).fetchone()
+        return row is not None
+
+    def setPreannotated(self, filename, model):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO preannotated (image, model) VALUES (?, ?)',
+                                    (self.key(filename), model))
+
+    def appendOutbox(self, key, ops):
+        with self.connection:
+            return self.connection.execute('INSERT INTO outbox (image, ops) VALUES (?, ?)',
+                                           (key, json.dumps(ops))).lastrowid
+
+    def removeOutbox(self, rowId):
+        with self.connection:
+            self.connection.execute('DELETE FROM outbox WHERE id = ?', (rowId,))
+
+    def refuseOutbox(self, rowId, reason):
+        with self.connection:
+            self.connection.execute('INSERT INTO conflicts (image, ops, reason) '
+                                    'SELECT image, ops, ? FROM outbox WHERE id = ?', (reason, rowId))
+            self.connection.execute('DELETE FROM outbox WHERE id = ?', (rowId,))
+
+    def conflicts(self):
+        # (image key, reason) of the refused diffs, oldest first
+        return self.connection.execute('SELECT image, reason FROM conflicts ORDER BY id').fetchall()
+
+    def outbox(self):
+        # (row id, image key, ops) in order
+        return [(rowId, key, json.loads(ops))
+                for rowId, key, ops in self.connection.execute('SELECT id, image, ops FROM outbox ORDER BY id')]
+
+    def items(self):
+        # streams (image, colorDict) for the whole store in one ordered scan, one image in memory at a time;
+        # unreviewed proposals are not annotations and never reach the exporter or the validator
+        self.wait()
+        rows = self.connection.execute('SELECT image, classId, points FROM polygons WHERE reviewed = 1 '
+                                       'ORDER BY image, classId, polyIndex')
+        image, colorDict = None, {}
+        for key, classId, blob in rows:
+            if key != image:
+                if image is not None:
+                    yield image, colorDict
+                image, colorDict = key, {}
+            points = array('f')
+            points.frombytes(blob)
+            colorDict.setdefault(classId, []).append(points)
+        if image is not None:
+            yield image, colorDict
+
+    def path(self, key):
+        if self.root:
+            return os.path.join(self.root, key)
+        return key
+
+    def images(self):
+        self.wait()
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT image FROM polygons')]
+
+    def close(self):
+        # the writer finishes the queued snapshots before it stops
+        with self.condition:
+            writer, self.writer = self.writer, None
+            self.condition.notify_all()
+        if writer is not None:
+            writer.join()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,358 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from PySide2 import QtCore, QtGui, QtWidgets
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Synthetic data, everything is derived from the seed so runs are comparable
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def makePolygon(random, cx, cy, radius, vertices):
+    angles = np.sort(random.uniform(0, 2 * np.pi, vertices))
+    radii = radius * random.uniform(0.6, 1.0, vertices)
+    xy = np.stack((cx + radii * np.cos(angles), cy + radii * np.sin(angles)), axis=1)
+    return array('f', xy.astype(np.float32).ravel().tobytes())
+
+
+def makeColorDict(random, classIds, polygonsPerClass, width, height, vertices):
+    colorDict = {}
+    radius = max(4.0, min(width, height) / (2.0 * np.sqrt(polygonsPerClass * len(classIds))))
+    for classId in classIds:
+        centers = random.uniform((radius, radius), (width - radius, height - radius), (polygonsPerClass, 2))
+        colorDict[classId] = [makePolygon(random, cx, cy, radius, vertices) for cx, cy in centers]
+    return colorDict
+
+
+def makeDataset(directory, store, images, polygonsPerClass, width=1600, height=1200, vertices=12, seed=0):
+    from categories import classRegistry
+    random = np.random.RandomState(seed)
+    classIds = [category.id for category in classRegistry]
+    filenames = []
+    for i in range(images):
+        filename = os.path.join(directory, 'bench%05d.png' % i)
+        image = QtGui.QImage(width, height, QtGui.QImage.Format_RGB32)
+        image.fill(QtGui.QColor(*[int(v) for v in random.randint(0, 256, 3)]))
+        image.save(filename)
+        store.save(filename, makeColorDict(random, classIds, polygonsPerClass, width, height, vertices))
+        filenames.append(filename)
+    return filenames
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Measurements
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def spin(app, seconds=0.0):
+    end = time.perf_counter() + seconds
+    app.processEvents()
+    while time.perf_counter() < end:
+        app.processEvents()
+
+
+def timings(samples, **params):
+    return {'params': params,
+            'rounds': len(samples),
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'mean': statistics.mean(samples),
+            'max': max(samples)}
+
+
+def benchSceneLoad(app, main, filename, image, repeat):
+    scene = main.ImageScene()
+    loads, teardowns = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        scene.load_image(filename, image)
+        loads.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        scene.removePolygon()
+        teardowns.append(time.perf_counter() - start)
+        app.processEvents()
+    # Python heap only, Qt allocations are covered by the process high-water mark
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    scene.load_image(filename, image)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    items = len(scene.polygonItems)
+    scene.removePolygon()
+    memory = {'params': {'polygons': items}, 'rounds': 1, 'peakBytes': peak,
+              'maxRssGrowthKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxRss}
+    return timings(loads, polygons=items), timings(teardowns, polygons=items), memory
+
+
+def benchNavigation(app, main, directory, images, steps):
+    window = main.MainWindow(directory=directory)
+    window.resize(1280, 800)
+    window.show()
+    deadline = time.perf_counter() + 30
+    while len(window.realpathImages) < images and time.perf_counter() < deadline:
+        spin(app, 0.01)
+    samples = []
+    for imageNavigation in [1] * steps + [0] * steps:
+        start = time.perf_counter()
+        window.load_image(imageNavigation)
+        # includes the repaint of the new image
+        app.processEvents()
+        samples.append(time.perf_counter() - start)
+    window.close()
+    app.processEvents()
+    return timings(samples, images=images, steps=2 * steps)
+
+
+def benchDrawing(app, main, filename, image, moves, clickEvery, repeat):
+    scene = main.ImageScene()
+    view = QtWidgets.QGraphicsView(scene)
+    view.resize(1280, 800)
+    view.show()
+    scene.load_image(filename, image)
+    rect = scene.sceneRect()
+    random = np.random.RandomState(1)
+    path = random.uniform((rect.left(), rect.top()), (rect.right(), rect.bottom()), (moves, 2))
+    moveEvent = QtWidgets.QGraphicsSceneMouseEvent(QtCore.QEvent.GraphicsSceneMouseMove)
+    samples = []
+    for _ in range(repeat):
+        scene.setCurrentInstruction(main.Instructions.PolygonInstruction, 0)
+        start = time.perf_counter()
+        for i, (x, y) in enumerate(path):
+            position = QtCore.QPointF(x, y)
+            moveEvent.setScenePos(position)
+            scene.mouseMoveEvent(moveEvent)
+            if i % clickEvery == 0:
+                scene.positionAddPoint(scene.snapPosition(position))
+            app.processEvents()
+        samples.append((time.perf_counter() - start) / moves)
+        scene.setCurrentInstruction(main.Instructions.NoInstruction, 0)
+    scene.removePolygon()
+    view.close()
+    return timings(samples, moves=moves, clickEvery=clickEvery)
+
+def benchRapidAnnotation(app, main, filename, image, polygons, repeat):
+    # keyboard flow of rapid mode: class key, four clicks, Enter; includes queueing the image write
+    scene = main.ImageScene()
+    view = QtWidgets.QGraphicsView(scene)
+    view.resize(1280, 800)
+    view.show()
+    classIds = [category.id for category in main.classRegistry]
+    samples = []
+    for _ in range(repeat):
+        scene.load_image(filename, image)
+        rect = scene.sceneRect()
+        random = np.random.RandomState(2)
+        corners = random.uniform((rect.left(), rect.top()), (rect.right() - 40, rect.bottom() - 40), (polygons, 2))
+        start = time.perf_counter()
+        for i, (x, y) in enumerate(corners):
+            scene.setDrawClass(classIds[i % len(classIds)])
+            for dx, dy in ((0, 0), (40, 0), (40, 30), (0, 30)):
+                scene.positionAddPoint(QtCore.QPointF(x + dx, y + dy))
+            scene.closePolygon()
+            app.processEvents()
+        samples.append((time.perf_counter() - start) / polygons)
+        scene.removePolygon()
+    main.imagePolygon.flush()
+    view.close()
+    return timings(samples, polygons=polygons)
+
+def benchRender(app, main, filename, image, layer, frames, repeat):
+    # synchronous repaints of a pan and zoom sweep over the whole image, with the polygon layer or with items
+    scene = main.ImageScene()
+    scene.setLayerMode(layer)
+    view = QtWidgets.QGraphicsView(scene)
+    view.setRenderHints(QtGui.QPainter.Antialiasing | QtGui.QPainter.SmoothPixmapTransform)
+    view.setViewportUpdateMode(QtWidgets.QGraphicsView.MinimalViewportUpdate)
+    view.setOptimizationFlag(QtWidgets.QGraphicsView.DontAdjustForAntialiasing, True)
+    if os.environ.get('PARCEL_OPENGL') == '1':
+        # on CI machines without a GPU: xvfb-run with LIBGL_ALWAYS_SOFTWARE=1 renders through llvmpipe
+        view.setViewport(QtWidgets.QOpenGLWidget())
+        view.setViewportUpdateMode(QtWidgets.QGraphicsView.FullViewportUpdate)
+    view.resize(1280, 800)
+    view.show()
+    scene.load_image(filename, image)
+    rect = scene.sceneRect()
+    app.processEvents()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in range(frames):
+            # zoom between 0.5 and 2 while the center circles the image
+            phase = 2.0 * np.pi * frame / frames
+            view.resetTransform()
+            view.scale(2.0 ** np.sin(phase), 2.0 ** np.sin(phase))
+            view.centerOn(rect.center().x() + 0.3 * rect.width() * np.cos(phase),
+                          rect.center().y() + 0.3 * rect.height() * np.sin(phase))
+            view.viewport().repaint()
+        samples.append((time.perf_counter() - start) / frames)
+    scene.removePolygon()
+    view.close()
+    return timings(samples, frames=frames, layer=layer)
+
+def benchIndexQuery(main, frames, repeat, seed):
+    # filter queries over the annotation index of a synthetic directory of frames, built straight in its columns
+    index = main.AnnotationIndex(main.classRegistry)
+    index.insertImages(0, ['frame%07d' % i for i in range(frames)])
+    index.settle()
+    random = np.random.RandomState(seed)
+    index.counts[:, :frames] = random.poisson(3.0, (len(index.classIds), frames)) * (random.rand(frames) < 0.7)
+    index.areas[:, :frames] = index.counts[:, :frames] * random.uniform(100.0, 5000.0, (len(index.classIds), frames))
+    index.polygons[:frames] = index.counts[:, :frames].sum(axis=0)
+    index.proposals[:frames] = random.poisson(0.5, frames)
+    names = [category.name.split()[0] for category in main.classRegistry]
+    queries = [names[0], '%s>5' % names[1], 'unannotated', 'unreviewed', '%s %s.area>=2000 !%s' % tuple(names[:3])]
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for query in queries:
+            index.query(query)
+        samples.append((time.perf_counter() - start) / len(queries))
+    return timings(samples, frames=frames, queries=len(queries))
+
+def checkHandles(app, main, directory):
+    # the vertex handles of a committed polygon have to reach the screen in both render modes, rendering is
+    # only worth timing when it draws the right thing
+    image = QtGui.QImage(400, 300, QtGui.QImage.Format_RGB32)
+    image.fill(QtGui.QColor('white'))
+    failures = []
+    for mode, layer in (('items', False), ('layer', True)):
+        # an image per mode, the polygon committed in one must not show up in the other
+        filename = os.path.join(directory, 'handles-%s.png' % mode)
+        image.save(filename)
+        scene = main.ImageScene()
+        scene.setLayerMode(layer)
+        view = QtWidgets.QGraphicsView(scene)
+        view.resize(400, 300)
+        view.show()
+        scene.load_image(filename, image)
+        scene.setDrawClass(next(iter(main.classRegistry)).id)
+        corner = QtCore.QPointF(150, 100)
+        for dx, dy in ((0, 0), (80, 0), (80, 60), (0, 60)):
+            scene.positionAddPoint(corner + QtCore.QPointF(dx, dy))
+        scene.closePolygon()
+        view.resetTransform()
+        view.scale(2.0, 2.0)
+        view.centerOn(corner)
+        app.processEvents()
+        shot = view.viewport().grab().toImage()
+        # outside the outline and the fill, inside the round handle of the corner vertex
+        color = QtGui.QColor(shot.pixel(view.mapFromScene(corner - QtCore.QPointF(2.0, 2.0))))
+        if not (color.blue() > 200 and color.red() < 80 and color.green() < 80):
+            failures.append('%s mode: no vertex handle on screen (%s)' % (mode, color.name()))
+        scene.removePolygon()
+        view.close()
+    if failures:
+        raise AssertionError('; '.join(failures))
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Suite and baselines
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def runSuite(polygonCounts, images, steps, moves, repeat, seed, frames):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    import main
+    results = {}
+    root = tempfile.mkdtemp(prefix='editor-bench-')
+    try:
+        directory = os.path.join(root, 'handles')
+        os.makedirs(directory)
+        main.imagePolygon.open(os.path.join(directory, main.AnnotationStore.fileName), directory)
+        checkHandles(app, main, directory)
+        main.imagePolygon.close()
+        for count in polygonCounts:
+            directory = os.path.join(root, 'scene%d' % count)
+            os.makedirs(directory)
+            main.imagePolygon.open(os.path.join(directory, main.AnnotationStore.fileName), directory)
+            filename = makeDataset(directory, main.imagePolygon, 1, count, seed=seed)[0]
+            image = QtGui.QImage(filename)
+            load, teardown, memory = benchSceneLoad(app, main, filename, image, repeat)
+            results['scene.load_image[%d]' % count] = load
+            results['scene.removePolygon[%d]' % count] = teardown
+            results['memory.load_image[%d]' % count] = memory
+            results['scene.mouseMove[%d]' % count] = benchDrawing(app, main, filename, image, moves, 20, repeat)
+            results['scene.rapidPolygon[%d]' % count] = benchRapidAnnotation(app, main, filename, image, 50, repeat)
+            for mode, layer in (('items', False), ('layer', True)):
+                results['view.paint[%s,%d]' % (mode, count)] = benchRender(app, main, filename, image, layer, 60,
+                                                                          repeat)
+            main.imagePolygon.close()
+
+        directory = os.path.join(root, 'navigation')
+        os.makedirs(directory)
+        store = main.AnnotationStore.forDirectory(directory)
+        makeDataset(directory, store, images, polygonCounts[0], seed=seed)
+        store.close()
+        results['window.load_image[%d]' % polygonCounts[0]] = benchNavigation(app, main, directory, images, steps)
+        results['index.query[%d]' % frames] = benchIndexQuery(main, frames, repeat, seed)
+    finally:
+        main.imagePolygon.close()
+        shutil.rmtree(root, ignore_errors=True)
+    return {'meta': {'python': platform.python_version(),
+                     'qt': QtCore.qVersion(),
+                     'opengl': os.environ.get('PARCEL_OPENGL') == '1',
+                     'platform': platform.platform(),
+                     'seed': seed,
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(report, baseline, threshold):
+    # a benchmark regresses when its median (or peak memory) grew by more than threshold
+    regressions = []
+    for name, result in sorted(report['results'].items()):
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        key = 'peakBytes' if 'peakBytes' in result else 'median'
+        if reference[key] > 0 and result[key] > reference[key] * (1.0 + threshold):
+            regressions.append({'name': name, 'metric': key, 'baseline': reference[key], 'current': result[key],
+                                'ratio': result[key] / reference[key]})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark scene building, navigation and drawing (offscreen Qt)')
+    parser.add_argument('--polygons', default='10,100,1000', help='polygons per class, comma separated')
+    parser.add_argument('--images', type=int, default=20, help='images in the navigation directory')
+    parser.add_argument('--steps', type=int, default=10, help='next/back steps in the navigation loop')
+    parser.add_argument('--moves', type=int, default=2000, help='mouse moves in the drawing stream')
+    parser.add_argument('--frames', type=int, default=1000000, help='frames in the annotation index queries')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--output', help='write the results as a JSON baseline')
+    parser.add_argument('--baseline', help='compare against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+    report = runSuite([int(count) for count in args.polygons.split(',')], args.images, args.steps,
+                      args.moves, args.repeat, args.seed, args.frames)
+    for name, result in sorted(report['results'].items()):
+        if 'peakBytes' in result:
+            print('%-32s peak %10.1f KiB' % (name, result['peakBytes'] / 1024.0))
+        else:
+            print('%-32s median %9.3f ms  min %9.3f ms' % (name, result['median'] * 1000.0, result['min'] * 1000.0))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION %(name)s %(metric)s %(baseline).6g -> %(current).6g (x%(ratio).2f)' % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
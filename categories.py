@@ -0,0 +1,90 @@
+import json
+import os
+
+from PySide2 import QtGui
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Parcel class registry, loaded from categories.json (or the file named by $PARCEL_CATEGORIES)
+# # -----------------------------------------------------------------------------------------------------------------------
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'categories.json')
+
+
+class Category(object):
+    def __init__(self, classId, name, color, shortcut=None):
+        self.id = classId
+        self.name = name
+        self.color = tuple(color)
+        self.shortcut = shortcut
+        self._brush = None
+        self._pen = None
+
+    # Qt objects are created on first use, the headless tools only need id, name and color
+    @property
+    def brush(self):
+        if self._brush is None:
+            self._brush = QtGui.QBrush(QtGui.QColor(*self.color))
+        return self._brush
+
+    @property
+    def pen(self):
+        if self._pen is None:
+            self._pen = QtGui.QPen(QtGui.QColor(*self.color[:3]), 2)
+        return self._pen
+
+    def styleSheet(self):
+        return 'color: #%02X%02X%02X' % self.color[:3]
+
+
+class ClassRegistry(object):
+    def __init__(self, categories=()):
+        self.categories = []
+        self.byId = {}
+        self.byColor = {}
+        self.byShortcut = {}
+        for category in categories:
+            self.add(category)
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or os.environ.get('PARCEL_CATEGORIES') or DEFAULT_CONFIG
+        with open(path) as f:
+            entries = json.load(f)
+        return cls(Category(entry['id'], entry['name'], entry['color'], entry.get('shortcut')) for entry in entries)
+
+    def add(self, category):
+        if category.id in self.byId:
+            raise ValueError('duplicate class id %d' % category.id)
+        if category.color in self.byColor:
+            raise ValueError('class %d reuses the color of class %d' % (category.id, self.byColor[category.color].id))
+        self.categories.append(category)
+        self.byId[category.id] = category
+        self.byColor[category.color] = category
+        if category.shortcut:
+            self.byShortcut[category.shortcut] = category
+
+    def __contains__(self, classId):
+        return classId in self.byId
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def get(self, classId):
+        return self.byId.get(classId)
+
+    def name(self, classId):
+        category = self.byId.get(classId)
+        return category.name if category is not None else str(classId)
+
+    def classForColor(self, color):
+        # accepts a QColor or an (r, g, b, a) tuple
+        if isinstance(color, QtGui.QColor):
+            color = color.getRgb()
+        category = self.byColor.get(tuple(color))
+        return category.id if category is not None else None
+
+
+classRegistry = ClassRegistry.load()
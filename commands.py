@@ -0,0 +1,133 @@
+from PySide2 import QtWidgets
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Undo commands, each one only stores what it changes
+# # -----------------------------------------------------------------------------------------------------------------------
+
+MoveVertexId = 1
+
+
+class AddPointCommand(QtWidgets.QUndoCommand):
+    def __init__(self, scene, item, point):
+        super(AddPointCommand, self).__init__('add point')
+        self.scene = scene
+        self.item = item
+        self.point = point
+
+    def redo(self):
+        self.item.addPoint(self.point)
+        if self.item is self.scene.polygonItem:
+            self.scene.polygonPoints.append(self.point)
+        self.scene.syncPolygon(self.item)
+
+    def undo(self):
+        self.item.removeLastPoint()
+        if self.item is self.scene.polygonItem and self.scene.polygonPoints:
+            self.scene.polygonPoints.pop()
+        self.scene.syncPolygon(self.item)
+        self.scene.updateRubberBand()
+
+
+class MoveVertexCommand(QtWidgets.QUndoCommand):
+    # all moves of one drag collapse into a single command holding the start and end position
+    def __init__(self, scene, item, index, old, new, dragId):
+        super(MoveVertexCommand, self).__init__('move vertex')
+        self.scene = scene
+        self.item = item
+        self.index = index
+        self.old = old
+        self.new = new
+        self.dragId = dragId
+
+    def id(self):
+        return MoveVertexId
+
+    def mergeWith(self, other):
+        if other.item is not self.item or other.index != self.index or other.dragId != self.dragId:
+            return False
+        self.new = other.new
+        return True
+
+    def redo(self):
+        self.item.setPoint(self.index, self.new)
+        self.scene.syncPolygon(self.item)
+
+    def undo(self):
+        self.item.setPoint(self.index, self.old)
+        self.scene.syncPolygon(self.item)
+
+
+class MovePolygonCommand(QtWidgets.QUndoCommand):
+    def __init__(self, scene, item, old, new):
+        super(MovePolygonCommand, self).__init__('move polygon')
+        self.scene = scene
+        self.item = item
+        self.old = old
+        self.new = new
+
+    def redo(self):
+        self.item.setPos(self.new)
+        self.scene.syncPolygon(self.item)
+
+    def undo(self):
+        self.item.setPos(self.old)
+        self.scene.syncPolygon(self.item)
+
+
+class DeletePolygonCommand(QtWidgets.QUndoCommand):
+    def __init__(self, scene, item, parent=None):
+        super(DeletePolygonCommand, self).__init__('delete polygon', parent)
+        self.scene = scene
+        self.item = item
+
+    def redo(self):
+        self.scene.detachPolygon(self.item)
+
+    def undo(self):
+        self.scene.attachPolygon(self.item)
+
+
+class ChangeClassCommand(QtWidgets.QUndoCommand):
+    def __init__(self, scene, item, old, new, parent=None):
+        super(ChangeClassCommand, self).__init__('change class', parent)
+        self.scene = scene
+        self.item = item
+        self.old = old
+        self.new = new
+
+    def redo(self):
+        self.scene.setPolygonClass(self.item, self.new)
+
+    def undo(self):
+        self.scene.setPolygonClass(self.item, self.old)
+
+
+class InsertPointCommand(QtWidgets.QUndoCommand):
+    def __init__(self, scene, item, index, point):
+        super(InsertPointCommand, self).__init__('insert point')
+        self.scene = scene
+        self.item = item
+        self.index = index
+        self.point = point
+
+    def redo(self):
+        self.item.insertPoint(self.index, self.point)
+        self.scene.syncPolygon(self.item)
+
+    def undo(self):
+        self.item.removePoint(self.index)
+        self.scene.syncPolygon(self.item)
+
+
+class ReviewPolygonCommand(QtWidgets.QUndoCommand):
+    # turns a model proposal into a regular annotation
+    def __init__(self, scene, item, parent=None):
+        super(ReviewPolygonCommand, self).__init__('accept proposal', parent)
+        self.scene = scene
+        self.item = item
+
+    def redo(self):
+        self.scene.setPolygonReviewed(self.item, True)
+
+    def undo(self):
+        self.scene.setPolygonReviewed(self.item, False)
@@ -0,0 +1,262 @@
+import bisect
+import logging
+import os
+
+import numpy as np
+from PySide2 import QtCore
+
+from framesource import isImageFile, isFrameContainer, framePath, openSource, naturalKey
+
+log = logging.getLogger('directoryindex')
+
+# where exporter.py writes the masks by default, they are not images to annotate
+EXPORT_DIRECTORY = 'truth'
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   DirectoryScanner
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class DirectoryScanner(QtCore.QThread):
+    batchReady = QtCore.Signal(list)
+
+    def __init__(self, directory, known=frozenset(), batchSize=512, parent=None):
+        super(DirectoryScanner, self).__init__(parent)
+        self.directory = directory
+        # the model's own set, not a copy: only read here, names it gains meanwhile are skipped as well and
+        # insertFilenames drops any name that is reported twice
+        self.known = known
+        self.batchSize = batchSize
+
+    def run(self):
+        # every scan lists the whole directory, the name lookup is what keeps known entries cheap; neither the
+        # watcher nor scandir can tell which entries are new, and comparing modification times would cost
+        # a stat per entry on POSIX
+        batch = []
+        sentFirst = False
+        try:
+            # the names are sorted before any entry is looked at: the first image handed over is the first of
+            # the list, and the batches of a first scan only ever go to its end
+            with os.scandir(self.directory) as entries:
+                entries = sorted((entry for entry in entries if entry.name not in self.known),
+                                 key=lambda entry: naturalKey(entry.name))
+        except OSError:
+            return
+        for entry in entries:
+            if self.isInterruptionRequested():
+                return
+            # is_file() is answered from the directory entry itself, no extra stat per file
+            if isImageFile(entry.name) and entry.is_file():
+                names = [entry.name]
+            elif self.isSequence(entry):
+                names = self.frames(entry)
+            else:
+                continue
+            for name in names:
+                batch.append(name)
+                # hand the first image over immediately so the window can show it while scanning
+                if len(batch) >= self.batchSize or not sentFirst:
+                    # frame paths need not sort like the name of their container
+                    batch.sort(key=naturalKey)
+                    self.batchReady.emit(batch)
+                    batch = []
+                    sentFirst = True
+        if batch:
+            batch.sort(key=naturalKey)
+            self.batchReady.emit(batch)
+
+    def isSequence(self, entry):
+        # videos, archives and image sequence directories are listed frame by frame, once
+        if entry.name.startswith('.') or entry.name == EXPORT_DIRECTORY or framePath(entry.name, 0) in self.known:
+            return False
+        if isFrameContainer(entry.name):
+            return entry.is_file()
+        return entry.is_dir() and self.containsImages(entry.path)
+
+    def containsImages(self, path):
+        try:
+            with os.scandir(path) as entries:
+                return any(isImageFile(entry.name) for entry in entries)
+        except OSError:
+            return False
+
+    def frames(self, entry):
+        try:
+            count = len(openSource(entry.path))
+        except (OSError, ValueError) as error:
+            log.warning('skipping %s: %s', entry.path, error)
+            return []
+        return [framePath(entry.name, index) for index in range(count)]
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   ImageListModel
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class ImageListModel(QtCore.QAbstractListModel):
+    def __init__(self, directory, parent=None):
+        super(ImageListModel, self).__init__(parent)
+        self.directory = directory
+        self.filenames = []
+        self.realpathImages = []
+        self.knownFilenames = set()
+        # naturalKey of every row, the list is kept in that order
+        self.keys = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.filenames)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self.filenames):
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.filenames[index.row()]
+        if role == QtCore.Qt.ToolTipRole:
+            return self.realpathImages[index.row()]
+        return None
+
+    def insertFilenames(self, names):
+        # names: a batch sorted by naturalKey, inserted as runs of rows that go between the same two rows
+        names = [name for name in names if name not in self.knownFilenames]
+        if not names:
+            return
+        self.knownFilenames.update(names)
+        keys = [naturalKey(name) for name in names]
+        runs = []
+        for name, key in zip(names, keys):
+            row = bisect.bisect_right(self.keys, key)
+            if runs and runs[-1][0] == row:
+                runs[-1][1].append(name)
+                runs[-1][2].append(key)
+            else:
+                runs.append((row, [name], [key]))
+        # from the end, so the rows found for the earlier runs stay valid
+        for row, runNames, runKeys in reversed(runs):
+            self.beginInsertRows(QtCore.QModelIndex(), row, row + len(runNames) - 1)
+            self.filenames[row:row] = runNames
+            self.realpathImages[row:row] = [self.directory + '/' + name for name in runNames]
+            self.keys[row:row] = runKeys
+            self.endInsertRows()
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   FilteredImageModel
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class FilteredImageModel(QtCore.QAbstractProxyModel):
+    # the rows of an ImageListModel that match a filter, given as a sorted array of source rows; without a
+    # filter it passes every row through and follows the scanner
+    def __init__(self, source, parent=None):
+        super(FilteredImageModel, self).__init__(parent)
+        self.rows = None
+        self.setSourceModel(source)
+        source.rowsAboutToBeInserted.connect(self.onRowsAboutToBeInserted)
+        source.rowsInserted.connect(self.onRowsInserted)
+
+    def setRows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self.endResetModel()
+
+    @QtCore.Slot(QtCore.QModelIndex, int, int)
+    def onRowsAboutToBeInserted(self, parent, first, last):
+        if self.rows is None:
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+
+    @QtCore.Slot(QtCore.QModelIndex, int, int)
+    def onRowsInserted(self, parent, first, last):
+        if self.rows is None:
+            self.endInsertRows()
+        else:
+            # the filter keeps its images, only their source rows move; shifted in place, the window navigates
+            # on the same array
+            self.rows[self.rows >= first] += last - first + 1
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.sourceModel().rowCount() if self.rows is None else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else 1
+
+    def index(self, row, column=0, parent=QtCore.QModelIndex()):
+        if parent.isValid() or column != 0 or not 0 <= row < self.rowCount():
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=QtCore.QModelIndex()):
+        return QtCore.QModelIndex()
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        row = index.row() if self.rows is None else int(self.rows[index.row()])
+        return self.sourceModel().index(row)
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        if self.rows is None:
+            return self.index(index.row())
+        position = int(np.searchsorted(self.rows, index.row()))
+        if position < len(self.rows) and self.rows[position] == index.row():
+            return self.index(position)
+        return QtCore.QModelIndex()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        return self.sourceModel().data(self.mapToSource(index), role)
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   DirectoryIndex
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class DirectoryIndex(QtCore.QObject):
+    # streams the directory into an ImageListModel and keeps it up to date while frames keep arriving
+    def __init__(self, directory, parent=None):
+        super(DirectoryIndex, self).__init__(parent)
+        self.directory = directory
+        self.model = ImageListModel(directory, self)
+        self.scanner = None
+        self.rescanPending = False
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.onDirectoryChanged)
+        # a camera dumping frames fires directoryChanged for every file, coalesce them
+        self.changeTimer = QtCore.QTimer(self)
+        self.changeTimer.setSingleShot(True)
+        self.changeTimer.setInterval(250)
+        self.changeTimer.timeout.connect(self.scan)
+
+    def start(self):
+        if os.path.isdir(self.directory):
+            self.watcher.addPath(self.directory)
+        self.scan()
+
+    @QtCore.Slot()
+    def scan(self):
+        if self.scanner is not None and self.scanner.isRunning():
+            self.rescanPending = True
+            return
+        self.rescanPending = False
+        self.scanner = DirectoryScanner(self.directory, self.model.knownFilenames, parent=self)
+        self.scanner.batchReady.connect(self.model.insertFilenames)
+        self.scanner.finished.connect(self.onScanFinished)
+        self.scanner.start()
+
+    @QtCore.Slot()
+    def onScanFinished(self):
+        if self.rescanPending:
+            self.scan()
+
+    @QtCore.Slot(str)
+    def onDirectoryChanged(self, path):
+        self.changeTimer.start()
+
+    def stop(self):
+        self.changeTimer.stop()
+        if self.scanner is not None:
+            self.scanner.requestInterruption()
+            self.scanner.wait()
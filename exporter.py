@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from annotationstore import AnnotationStore
+from categories import classRegistry
+from framesource import imageSize, frameStem
+from geometry import polygonArea, toPolygon
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Rasterizer
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def fillPolygon(mask, xy, color):
+    # even-odd scanline fill, all edge/row intersections of the polygon computed at once
+    height, width = mask.shape[:2]
+    x0, y0 = xy[:, 0], xy[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    top = max(int(np.floor(y0.min())), 0)
+    bottom = min(int(np.ceil(y0.max())), height)
+    left = max(int(np.floor(x0.min())), 0)
+    right = min(int(np.ceil(x0.max())), width)
+    if bottom <= top or right <= left:
+        return
+    ys = np.arange(top, bottom, dtype=np.float64)[:, None] + 0.5
+    crosses = (ys >= np.minimum(y0, y1)) & (ys < np.maximum(y0, y1))
+    rows, edges = np.nonzero(crosses)
+    if not len(rows):
+        return
+    t = (ys[rows, 0] - y0[edges]) / (y1[edges] - y0[edges])
+    xs = x0[edges] + t * (x1[edges] - x0[edges])
+    # first pixel whose center lies right of the crossing, relative to the bounding box
+    cols = np.clip(np.ceil(xs - 0.5).astype(np.int64) - left, 0, right - left)
+    toggles = np.zeros((bottom - top, right - left + 1), dtype=np.int32)
+    np.add.at(toggles, (rows, cols), 1)
+    inside = (np.cumsum(toggles, axis=1)[:, :-1] & 1).astype(bool)
+    mask[top:bottom, left:right][inside] = color
+
+
+def writePng(filename, rgb):
+    height, width = rgb.shape[:2]
+    # filter type 0 in front of every scanline
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def exportImage(imagePath, polygons, maskPath):
+    # runs in a worker process, returns the image size and the COCO annotation data of its polygons
+    size = imageSize(imagePath)
+    width, height = size.width(), size.height()
+    mask = None
+    if maskPath and width > 0 and height > 0:
+        mask = np.zeros((height, width, 3), dtype=np.uint8)
+    annotations = []
+    for classId, blob in polygons:
+        xy = toPolygon(blob)
+        if len(xy) < 3:
+            continue
+        category = classRegistry.get(classId)
+        if mask is not None and category is not None:
+            fillPolygon(mask, xy, category.color[:3])
+        minimum, maximum = xy.min(axis=0), xy.max(axis=0)
+        annotations.append((classId,
+                            [round(float(v), 2) for v in xy.ravel()],
+                            round(polygonArea(xy), 2),
+                            [round(float(minimum[0]), 2), round(float(minimum[1]), 2),
+                             round(float(maximum[0] - minimum[0]), 2), round(float(maximum[1] - minimum[1]), 2)]))
+    if mask is not None:
+        writePng(maskPath, mask)
+    return imagePath, width, height, annotations
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Exporter
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def boundedMap(executor, fn, tasks, window):
+    # like executor.map, but keeps at most `window` tasks in flight instead of submitting everything up front
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, *task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def exportDataset(directory, outputDirectory, workers=None, masks=True):
+    store = AnnotationStore.forDirectory(directory)
+    maskDirectory = os.path.join(outputDirectory, 'masks')
+    os.makedirs(maskDirectory, exist_ok=True)
+
+    def tasks():
+        for key, colorDict in store.items():
+            maskPath = None
+            if masks:
+                maskPath = os.path.join(maskDirectory, frameStem(key) + '.png')
+            polygons = [(classId, points.tobytes())
+                        for classId in sorted(colorDict) for points in colorDict[classId]]
+            yield store.path(key), polygons, maskPath
+
+    imageCount = annotationCount = 0
+    jsonPath = os.path.join(outputDirectory, 'annotations.json')
+    # images and annotations are both streamed, annotations go to a spool file and are appended at the end
+    with open(jsonPath, 'w') as out, tempfile.TemporaryFile('w+', dir=outputDirectory) as spool:
+        out.write('{"info": %s, "categories": %s, "images": [' % (
+            json.dumps({'description': 'Truth data parcels', 'directory': directory}),
+            json.dumps([{'id': category.id, 'name': category.name}
+                        for category in sorted(classRegistry, key=lambda category: category.id)])))
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for imagePath, width, height, annotations in boundedMap(executor, exportImage, tasks(), 4 * workers):
+                imageCount += 1
+                out.write((',' if imageCount > 1 else '') + json.dumps(
+                    {'id': imageCount, 'file_name': os.path.basename(imagePath), 'width': width, 'height': height}))
+                for classId, segmentation, area, bbox in annotations:
+                    annotationCount += 1
+                    spool.write((',' if annotationCount > 1 else '') + json.dumps(
+                        {'id': annotationCount, 'image_id': imageCount, 'category_id': classId,
+                         'segmentation': [segmentation], 'area': area, 'bbox': bbox, 'iscrowd': 0}))
+        out.write('], "annotations": [')
+        spool.seek(0)
+        while True:
+            block = spool.read(1 << 20)
+            if not block:
+                break
+            out.write(block)
+        out.write(']}\n')
+    store.close()
+    return imageCount, annotationCount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export parcel annotations as COCO JSON and label masks')
+    parser.add_argument('directory', help='image directory containing the annotation store')
+    parser.add_argument('output', nargs='?', help='output directory (default: <directory>/truth)')
+    parser.add_argument('--workers', type=int, default=None, help='number of rasterizer processes')
+    parser.add_argument('--no-masks', action='store_true', help='only write the COCO JSON')
+    args = parser.parse_args(argv)
+    output = args.output or os.path.join(args.directory, 'truth')
+    images, annotations = exportDataset(args.directory, output, args.workers, not args.no_masks)
+    print('exported %d polygons of %d images to %s' % (annotations, images, output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
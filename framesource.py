@@ -0,0 +1,315 @@
+import bisect
+import logging
+import os
+import re
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from fractions import Fraction
+
+import numpy as np
+from PySide2 import QtCore, QtGui
+
+log = logging.getLogger('framesource')
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.ppm', '.pgm')
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm', '.m4v')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+def isImageFile(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def isFrameContainer(name):
+    return name.lower().endswith(VIDEO_EXTENSIONS + ARCHIVE_EXTENSIONS)
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Frame paths: frame i of a video, archive or image sequence is addressed as "<container path>#<i>",
+# #   so the annotation store keys it by (container, frame index) and nothing is extracted to disk
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def framePath(source, index):
+    return '%s#%06d' % (source, index)
+
+
+def splitFrame(path):
+    # (container, frame index), or (path, None) for a plain image file; a directory is an image sequence
+    source, separator, index = path.rpartition('#')
+    if separator and index.isdigit() and (isFrameContainer(source) or os.path.isdir(source)):
+        return source, int(index)
+    return path, None
+
+
+def frameStem(path):
+    # file name without extension, for files derived from a frame (masks, thumbnails)
+    source, index = splitFrame(path)
+    if index is None:
+        return os.path.splitext(os.path.basename(path))[0]
+    return '%s_%06d' % (os.path.basename(source).split('.')[0], index)
+
+
+def naturalKey(name):
+    # frame_9.png sorts before frame_10.png; text and numbers alternate, so keys always compare part by part
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def isNextFrame(previous, path):
+    # path directly follows previous: the next frame of the same container, or the next number of a run of
+    # numbered files (frame_0009.png -> frame_0010.png)
+    source, index = splitFrame(previous)
+    nextSource, nextIndex = splitFrame(path)
+    if index is not None or nextIndex is not None:
+        return source == nextSource and index is not None and nextIndex == index + 1
+    previousKey, key = naturalKey(previous), naturalKey(path)
+    if len(previousKey) != len(key):
+        return False
+    changed = [(a, b) for a, b in zip(previousKey, key) if a != b]
+    return len(changed) == 1 and isinstance(changed[0][0], int) and changed[0][1] == changed[0][0] + 1
+
+
+def statPath(path):
+    return os.stat(splitFrame(path)[0])
+
+
+def arrayToImage(rgb):
+    # (h, w, 3) uint8 -> QImage that owns its pixels, rows are copied into the padded scan lines
+    height, width = rgb.shape[:2]
+    image = QtGui.QImage(width, height, QtGui.QImage.Format_RGB888)
+    stride = image.bytesPerLine()
+    pixels = np.frombuffer(image.bits(), dtype=np.uint8, count=stride * height).reshape(height, stride)
+    pixels[:, :width * 3] = rgb.reshape(height, width * 3)
+    return image
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   FrameSource, random access by frame index with a ring buffer of the last decoded frames
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class FrameSource(object):
+    ringSize = 32
+
+    def __init__(self, path):
+        self.path = path
+        # decoders are not thread safe, the prefetcher and the thumbnail loader share a source
+        self.lock = threading.Lock()
+        self.ring = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return 0
+
+    def frame(self, index):
+        with self.lock:
+            image = self.ring.get(index)
+            if image is not None:
+                self.hits += 1
+                return image
+            self.misses += 1
+            image = self.decode(index)
+            self.remember(index, image)
+            return image
+
+    def remember(self, index, image):
+        if image is None or image.isNull():
+            return
+        self.ring[index] = image
+        while len(self.ring) > self.ringSize:
+            self.ring.popitem(last=False)
+
+    def decode(self, index):
+        raise NotImplementedError
+
+    def size(self, index):
+        return self.frame(index).size()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / total if total else 0.0,
+                'frames': len(self.ring)}
+
+    def close(self):
+        self.ring.clear()
+
+
+class DirectorySource(FrameSource):
+    # an image sequence, the stills of a directory in name order
+    def __init__(self, path):
+        super(DirectorySource, self).__init__(path)
+        self.names = sorted(name for name in os.listdir(path) if isImageFile(name))
+
+    def __len__(self):
+        return len(self.names)
+
+    def decode(self, index):
+        return QtGui.QImage(os.path.join(self.path, self.names[index]))
+
+    def size(self, index):
+        return QtGui.QImageReader(os.path.join(self.path, self.names[index])).size()
+
+
+class ArchiveSource(FrameSource):
+    # the stills of a zip or tar file in name order, members are read by offset without extracting them;
+    # compressed tars can only seek forward cheaply, use zip or plain tar for random access
+    def __init__(self, path):
+        super(ArchiveSource, self).__init__(path)
+        if zipfile.is_zipfile(path):
+            self.archive = zipfile.ZipFile(path)
+            self.members = sorted((info for info in self.archive.infolist()
+                                   if not info.is_dir() and isImageFile(info.filename)), key=lambda info: info.filename)
+            self.read = lambda info: self.archive.read(info)
+        else:
+            self.archive = tarfile.open(path)
+            self.members = sorted((info for info in self.archive.getmembers()
+                                   if info.isfile() and isImageFile(info.name)), key=lambda info: info.name)
+            self.read = lambda info: self.archive.extractfile(info).read()
+
+    def __len__(self):
+        return len(self.members)
+
+    def decode(self, index):
+        return QtGui.QImage.fromData(self.read(self.members[index]))
+
+    def size(self, index):
+        with self.lock:
+            image = self.ring.get(index)
+            if image is not None:
+                return image.size()
+            buffer = QtCore.QBuffer()
+            buffer.setData(self.read(self.members[index]))
+            return QtGui.QImageReader(buffer).size()
+
+    def close(self):
+        super(ArchiveSource, self).close()
+        self.archive.close()
+
+
+class VideoSource(FrameSource):
+    # decoded with PyAV (FFmpeg); a request behind the decoder or past a known keyframe seeks to the keyframe
+    # before the frame, anything else decodes forward and keeps the frames on the way in the ring
+    seekDistance = 120
+
+    def __init__(self, path):
+        super(VideoSource, self).__init__(path)
+        try:
+            import av
+        except ImportError:
+            raise OSError('reading %s needs PyAV (pip install av)' % path)
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+        self.timeBase = self.stream.time_base
+        self.rate = self.stream.average_rate or self.stream.guessed_rate or Fraction(25)
+        self.start = self.stream.start_time or 0
+        if self.stream.frames:
+            self.frames = self.stream.frames
+        elif self.stream.duration:
+            self.frames = int(self.stream.duration * self.timeBase * self.rate)
+        else:
+            self.frames = int(Fraction(self.container.duration or 0, 1000000) * self.rate)
+        self.decoder = None
+        self.position = -1
+        self.keyframes = []
+
+    def __len__(self):
+        return self.frames
+
+    def indexOf(self, frame):
+        if frame.pts is None:
+            return self.position + 1
+        return int(round((frame.pts - self.start) * self.timeBase * self.rate))
+
+    def needsSeek(self, index):
+        if self.decoder is None or index <= self.position:
+            return True
+        keyframe = bisect.bisect_right(self.keyframes, index) - 1
+        if keyframe >= 0 and self.keyframes[keyframe] > self.position + 1:
+            return True
+        return index - self.position > self.seekDistance
+
+    def decode(self, index):
+        if self.needsSeek(index):
+            self.container.seek(self.start + int(Fraction(index) / self.rate / self.timeBase), stream=self.stream,
+                                backward=True, any_frame=False)
+            self.decoder = self.container.decode(self.stream)
+            self.position = -1
+        for frame in self.decoder:
+            current = self.indexOf(frame)
+            self.position = current
+            if frame.key_frame and current not in self.keyframes:
+                bisect.insort(self.keyframes, current)
+            if current >= index:
+                return self.toImage(frame)
+            if index - current <= self.ringSize:
+                self.remember(current, self.toImage(frame))
+        self.decoder = None
+        return QtGui.QImage()
+
+    def toImage(self, frame):
+        return arrayToImage(frame.to_ndarray(format='rgb24'))
+
+    def size(self, index):
+        return QtCore.QSize(self.stream.codec_context.width, self.stream.codec_context.height)
+
+    def close(self):
+        super(VideoSource, self).close()
+        self.decoder = None
+        self.container.close()
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Open sources, one per container and process
+# # -----------------------------------------------------------------------------------------------------------------------
+
+sources = {}
+sourcesLock = threading.Lock()
+
+
+def openSource(path):
+    with sourcesLock:
+        source = sources.get(path)
+        if source is None:
+            if os.path.isdir(path):
+                source = DirectorySource(path)
+            elif path.lower().endswith(VIDEO_EXTENSIONS):
+                source = VideoSource(path)
+            else:
+                source = ArchiveSource(path)
+            sources[path] = source
+        return source
+
+
+def closeSources():
+    with sourcesLock:
+        for source in sources.values():
+            source.close()
+        sources.clear()
+
+
+def readImage(path, scaledSize=None):
+    source, index = splitFrame(path)
+    if index is None:
+        reader = QtGui.QImageReader(path)
+        if scaledSize is not None:
+            reader.setScaledSize(scaledSize)
+        return reader.read()
+    try:
+        image = openSource(source).frame(index)
+    except (OSError, ValueError, IndexError) as error:
+        log.warning('frame %d of %s: %s', index, source, error)
+        return QtGui.QImage()
+    if scaledSize is not None and not image.isNull():
+        return image.scaled(scaledSize, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+    return image
+
+
+def imageSize(path):
+    source, index = splitFrame(path)
+    if index is None:
+        return QtGui.QImageReader(path).size()
+    try:
+        return openSource(source).size(index)
+    except (OSError, ValueError, IndexError):
+        return QtCore.QSize()
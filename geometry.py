@@ -0,0 +1,149 @@
+import numpy as np
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Vectorized polygon geometry on (n, 2) float arrays
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def toPolygon(flat):
+    # float32 point buffer from the annotation store -> (n, 2) float64 vertex array
+    return np.frombuffer(flat, dtype=np.float32).reshape(-1, 2).astype(np.float64)
+
+
+def polygonArea(xy):
+    x, y = xy[:, 0], xy[:, 1]
+    return 0.5 * abs(float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))))
+
+
+def polygonAreas(buffers):
+    # areas of many float32 point buffers in one pass
+    sizes = np.fromiter((len(flat) // 2 for flat in buffers), np.int64, len(buffers))
+    areas = np.zeros(len(sizes))
+    if not sizes.any():
+        return areas
+    xy = np.frombuffer(b''.join(buffers), dtype=np.float32).reshape(-1, 2).astype(np.float64)
+    filled = sizes > 0
+    starts = (np.cumsum(sizes) - sizes)[filled]
+    # shoelace terms with the successor of each polygon's last vertex being its first vertex; the terms of
+    # one or two vertices cancel out exactly
+    successor = np.arange(1, len(xy) + 1)
+    successor[starts + sizes[filled] - 1] = starts
+    cross = xy[:, 0] * xy[successor, 1] - xy[successor, 0] * xy[:, 1]
+    areas[filled] = 0.5 * np.abs(np.add.reduceat(cross, starts))
+    return areas
+
+
+def orientation(ax, ay, bx, by, cx, cy):
+    return np.sign((bx - ax) * (cy - ay) - (by - ay) * (cx - ax))
+
+
+def segmentsCross(a0, a1, b0, b1):
+    # proper crossings only, segments that merely touch or overlap collinearly do not count
+    o1 = orientation(a0[..., 0], a0[..., 1], a1[..., 0], a1[..., 1], b0[..., 0], b0[..., 1])
+    o2 = orientation(a0[..., 0], a0[..., 1], a1[..., 0], a1[..., 1], b1[..., 0], b1[..., 1])
+    o3 = orientation(b0[..., 0], b0[..., 1], b1[..., 0], b1[..., 1], a0[..., 0], a0[..., 1])
+    o4 = orientation(b0[..., 0], b0[..., 1], b1[..., 0], b1[..., 1], a1[..., 0], a1[..., 1])
+    return (o1 * o2 < 0) & (o3 * o4 < 0)
+
+
+def selfIntersects(xy, blockSize=512):
+    n = len(xy)
+    if n < 4:
+        return False
+    start, end = xy, np.roll(xy, -1, axis=0)
+    indices = np.arange(n)
+    # compares a block of edges against all edges at a time to keep the pair matrix bounded
+    for first in range(0, n, blockSize):
+        rows = indices[first:first + blockSize]
+        crossing = segmentsCross(start[rows, None], end[rows, None], start[None, :], end[None, :])
+        # adjacent edges share a vertex and the pair (i, j) is the same as (j, i)
+        crossing &= indices[None, :] > rows[:, None] + 1
+        crossing[rows == 0, n - 1] = False
+        if crossing.any():
+            return True
+    return False
+
+
+def duplicateVertices(xy):
+    consecutive = int(np.all(xy == np.roll(xy, -1, axis=0), axis=1).sum()) if len(xy) > 1 else 0
+    repeated = len(xy) - len(np.unique(xy, axis=0))
+    return consecutive, repeated
+
+
+def pointsInPolygon(points, xy):
+    # even-odd ray casting for many points at once
+    x0, y0 = xy[:, 0], xy[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    px, py = points[:, 0, None], points[:, 1, None]
+    straddles = (y0 > py) != (y1 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossX = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+    return (np.count_nonzero(straddles & (px < crossX), axis=1) & 1).astype(bool)
+
+
+def boundingBox(xy):
+    return xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max()
+
+
+def interiorPoint(xy):
+    # centroid of the first triangle of the fan around vertex 0 that lies inside the polygon; unlike a
+    # vertex it is never on the boundary, so neighbours sharing an edge are not taken for nested ones
+    candidates = (xy[0] + xy[1:-1] + xy[2:]) / 3.0
+    inside = pointsInPolygon(candidates, xy)
+    if not inside.any():
+        return None
+    return candidates[np.argmax(inside)][None, :]
+
+
+def polygonsOverlap(a, b):
+    boxA, boxB = boundingBox(a), boundingBox(b)
+    if boxA[0] >= boxB[2] or boxB[0] >= boxA[2] or boxA[1] >= boxB[3] or boxB[1] >= boxA[3]:
+        return False
+    if segmentsCross(a[:, None], np.roll(a, -1, axis=0)[:, None], b[None, :], np.roll(b, -1, axis=0)[None, :]).any():
+        return True
+    # without crossing edges the polygons are either disjoint or one contains the other
+    for inner, outer in ((a, b), (b, a)):
+        point = interiorPoint(inner)
+        if point is not None and pointsInPolygon(point, outer)[0]:
+            return True
+    return False
+
+
+def simplifyChain(xy, tolerance):
+    # Douglas-Peucker on an open chain, the distances of each range are computed in one vectorized step
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    squaredTolerance = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = xy[first], xy[last]
+        points = xy[first + 1:last]
+        direction = b - a
+        length = float(np.dot(direction, direction))
+        if length == 0.0:
+            distances = np.sum((points - a) ** 2, axis=1)
+        else:
+            cross = direction[0] * (points[:, 1] - a[1]) - direction[1] * (points[:, 0] - a[0])
+            distances = cross * cross / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > squaredTolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def simplifyPolygon(xy, tolerance):
+    # a closed ring is split at vertex 0 and the vertex farthest from it, both halves are simplified as chains
+    if len(xy) < 4:
+        return xy
+    split = int(np.argmax(np.sum((xy - xy[0]) ** 2, axis=1)))
+    if split == 0:
+        return xy[:1]
+    ring = np.vstack((xy, xy[:1]))
+    keep = np.concatenate((simplifyChain(ring[:split + 1], tolerance)[:-1], simplifyChain(ring[split:], tolerance)[:-1]))
+    return xy[keep]
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+
+from PySide2 import QtCore, QtGui
+
+from framesource import readImage, imageSize
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   ImageCache
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class ImageCache(object):
+    # LRU cache of decoded QImages, bounded by the total number of pixel bytes
+    def __init__(self, maxBytes=512 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.images = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, filename):
+        return filename in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, filename):
+        image = self.images.get(filename)
+        if image is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.images.move_to_end(filename)
+        return image
+
+    def put(self, filename, image):
+        if image is None or image.isNull():
+            return
+        if filename in self.images:
+            self.currentBytes -= self.images.pop(filename).sizeInBytes()
+        self.images[filename] = image
+        self.currentBytes += image.sizeInBytes()
+        # always keep the most recent image, even if it alone exceeds the budget
+        while self.currentBytes > self.maxBytes and len(self.images) > 1:
+            _, evicted = self.images.popitem(last=False)
+            self.currentBytes -= evicted.sizeInBytes()
+
+    def clear(self):
+        self.images.clear()
+        self.currentBytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / total if total else 0.0,
+                'images': len(self.images),
+                'bytes': self.currentBytes}
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   ImagePrefetcher
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class ImageLoaderSignals(QtCore.QObject):
+    loaded = QtCore.Signal(str, QtGui.QImage)
+    tooLarge = QtCore.Signal(str)
+
+
+class ImageLoader(QtCore.QRunnable):
+    # decodes into a QImage, which unlike QPixmap may be created outside the GUI thread
+    def __init__(self, filename, maxPixels, signals):
+        super(ImageLoader, self).__init__()
+        self.filename = filename
+        self.maxPixels = maxPixels
+        self.signals = signals
+
+    def run(self):
+        # the size is read here as well, for a video frame it takes the source lock and may have to seek
+        size = imageSize(self.filename)
+        if size.width() * size.height() > self.maxPixels:
+            self.signals.tooLarge.emit(self.filename)
+            return
+        self.signals.loaded.emit(self.filename, readImage(self.filename))
+
+
+class ImagePrefetcher(QtCore.QObject):
+    def __init__(self, window=3, maxBytes=512 * 1024 * 1024, maxThreads=2, maxPixels=8192 * 8192, parent=None):
+        super(ImagePrefetcher, self).__init__(parent)
+        self.window = window
+        self.maxPixels = maxPixels
+        self.cache = ImageCache(maxBytes)
+        self.pending = set()
+        # images known to exceed maxPixels, never decoded whole
+        self.oversized = set()
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(maxThreads)
+        self.signals = ImageLoaderSignals()
+        self.signals.loaded.connect(self.onImageLoaded)
+        self.signals.tooLarge.connect(self.onTooLarge)
+
+    def isTooLarge(self, filename):
+        # huge images are never decoded whole, they are displayed through the tile pyramid
+        if filename in self.oversized:
+            return True
+        size = imageSize(filename)
+        if size.width() * size.height() > self.maxPixels:
+            self.oversized.add(filename)
+            return True
+        return False
+
+    def image(self, filename):
+        image = self.cache.get(filename)
+        if image is None:
+            if self.isTooLarge(filename):
+                return None
+            # not prefetched in time, decode on the calling thread
+            image = readImage(filename)
+            self.cache.put(filename, image)
+        return image
+
+    def prefetch(self, filenames, index):
+        # nearest neighbours first, so the next/back image is ready before the rest of the window
+        for distance in range(1, self.window + 1):
+            for i in (index + distance, index - distance):
+                if 0 <= i < len(filenames):
+                    self.schedule(filenames[i])
+
+    def schedule(self, filename):
+        # the loader checks the size, the GUI thread does not touch the neighbours at all
+        if filename in self.cache or filename in self.pending or filename in self.oversized:
+            return
+        self.pending.add(filename)
+        self.pool.start(ImageLoader(filename, self.maxPixels, self.signals))
+
+    @QtCore.Slot(str, QtGui.QImage)
+    def onImageLoaded(self, filename, image):
+        self.pending.discard(filename)
+        self.cache.put(filename, image)
+
+    @QtCore.Slot(str)
+    def onTooLarge(self, filename):
+        self.pending.discard(filename)
+        self.oversized.add(filename)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['pending'] = len(self.pending)
+        return stats
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Logging, the level comes from $PARCEL_LOG_LEVEL (DEBUG, INFO, WARNING, ...)
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def configureLogging(level=None):
+    level = level or os.environ.get('PARCEL_LOG_LEVEL', 'WARNING')
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.WARNING),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Profiler, aggregated timers and counters plus an optional Chrome trace of every timed section
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class Timer(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler(object):
+    def __init__(self, maxEvents=200000):
+        # name -> [count, total, maximum, last] in seconds
+        self.timers = {}
+        self.counters = {}
+        self.sources = {}
+        self.tracing = False
+        self.events = deque(maxlen=maxEvents)
+        self.origin = time.perf_counter()
+        self.open = {}
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def record(self, name, start, end):
+        duration = end - start
+        stats = self.timers.get(name)
+        if stats is None:
+            self.timers[name] = [1, duration, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            if duration > stats[2]:
+                stats[2] = duration
+            stats[3] = duration
+        if self.tracing:
+            self.events.append((name, start, duration, threading.get_ident()))
+
+    def begin(self, name):
+        # for sections that start and end in different callbacks
+        self.open[name] = time.perf_counter()
+
+    def end(self, name):
+        start = self.open.pop(name, None)
+        if start is not None:
+            self.record(name, start, time.perf_counter())
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def registerSource(self, name, stats):
+        # stats() returns a dict, shown in the overlay and included in the dump
+        self.sources[name] = stats
+
+    def last(self, name):
+        stats = self.timers.get(name)
+        return stats[3] if stats else 0.0
+
+    def mean(self, name):
+        stats = self.timers.get(name)
+        return stats[1] / stats[0] if stats else 0.0
+
+    def reset(self):
+        self.timers.clear()
+        self.counters.clear()
+        self.events.clear()
+
+    def summary(self):
+        return {'timers': {name: {'count': count, 'totalMs': total * 1000.0, 'meanMs': total * 1000.0 / count,
+                                  'maxMs': maximum * 1000.0}
+                           for name, (count, total, maximum, last) in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'sources': {name: stats() for name, stats in sorted(self.sources.items())}}
+
+    def dumpTrace(self, path):
+        # Chrome trace event format, open in chrome://tracing or Perfetto
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6}
+                  for name, start, duration, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'otherData': self.summary()}, f)
+
+
+def profiled(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.record(name, start, time.perf_counter())
+        return wrapper
+    return decorator
+
+
+profiler = Profiler()
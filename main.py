@@ -2,71 +2,66 @@ import sys
 from enum import Enum
 from functools import partial
 
-from PySide2.QtGui import QColor
 from PySide2 import QtWidgets, QtGui, QtCore
 from PySide2.QtCore import SIGNAL, QObject
 from PySide2.QtWidgets import QApplication, QMainWindow, QGraphicsView, QGraphicsScene, QPushButton
 from mainwindow import Ui_MainWindow
-from os import listdir
+from imagecache import ImagePrefetcher
+from directoryindex import DirectoryIndex, FilteredImageModel
+from framesource import readImage, closeSources, isNextFrame
+from annotationstore import AnnotationStore, pointsToArray, copyPolygons
+from annotationserver import RemoteAnnotationStore
+from annotationarchive import AnnotationArchive
+from annotationindex import AnnotationIndex
+from spatialindex import UniformGrid, projectOnSegment
+from geometry import simplifyPolygon
+from tiledimage import TiledImageItem
+from polygonlayer import PolygonLayerItem
+from thumbnails import ThumbnailDelegate
+from preannotate import Preannotator
+from propagate import Propagator
+from instrumentation import profiler, profiled, configureLogging
+from categories import classRegistry
+from commands import (AddPointCommand, MoveVertexCommand, MovePolygonCommand, DeletePolygonCommand,
+                      ChangeClassCommand, InsertPointCommand, ReviewPolygonCommand)
 import os
-from os.path import isfile, join
+from os.path import join
 import itertools
+import logging
+from array import array
+import math
+import time
+import numpy as np
 
-# #-----------------------------------------------------------------------------------------------------------------------
-# #   GetPolygonAnnotations
-# # -----------------------------------------------------------------------------------------------------------------------
-
-class PolygonItemsDisplay(QtWidgets.QGraphicsPathItem):
-    circle = QtGui.QPainterPath()
-    circle.addEllipse(QtCore.QRectF(-10, -10, 20, 20))
-    square = QtGui.QPainterPath()
-    square.addRect(QtCore.QRectF(-15, -15, 30, 30))
-
-    def __init__(self, annotationItem, index):
-        super(PolygonItemsDisplay, self).__init__()
-        self.mAnnotationItem = annotationItem
-        # print("ANNOTATIONITEM", self.mAnnotationItem)
-        self.mIndex = index
-        self.setPath(PolygonItemsDisplay.circle)
-        self.setBrush(QtGui.QColor("blue"))
-        self.setPen(QtGui.QPen(QtGui.QColor("blue"), 2))
-        self.setFlag(QtWidgets.QGraphicsItem.ItemIsSelectable, True)
-        self.setFlag(QtWidgets.QGraphicsItem.ItemIsMovable, True)
-        self.setFlag(QtWidgets.QGraphicsItem.ItemSendsGeometryChanges, True)
-        self.setAcceptHoverEvents(True)
-
-        self.setZValue(11)
-        self.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
-
-    def hoverEnterEvent(self, event):
-        self.setPath(PolygonItemsDisplay.square)
-        self.setBrush(QtGui.QColor("blue"))
-        super(PolygonItemsDisplay, self).hoverEnterEvent(event)
-
-    def hoverLeaveEvent(self, event):
-        self.setPath(PolygonItemsDisplay.circle)
-        self.setBrush(QtGui.QColor("blue"))
-        super(PolygonItemsDisplay, self).hoverLeaveEvent(event)
-
-    def mouseReleaseEvent(self, event):
-        self.setSelected(False)
-        super(PolygonItemsDisplay, self).mouseReleaseEvent(event)
-
-    def itemChange(self, change, value):
-        if change == QtWidgets.QGraphicsItem.ItemPositionChange and self.isEnabled():
-            self.mAnnotationItem.movePoint(self.mIndex, value)
-        return super(PolygonItemsDisplay, self).itemChange(change, value)
+log = logging.getLogger('editor')
 
 # #-----------------------------------------------------------------------------------------------------------------------
 # #   PolygonAnnotation
 # # -----------------------------------------------------------------------------------------------------------------------
 
 class PolygonAnnotation(QtWidgets.QGraphicsPolygonItem):
+    # vertex handles are painted by the polygon itself instead of being one scene item per vertex,
+    # sizes match the former handle items (circle r=10 / square 30x30 at scale 0.3)
+    handleRadius = 3.0
+    handleHoverSize = 4.5
+    handlePen = QtGui.QPen(QtGui.QColor("blue"), 2 * handleRadius + 0.6, QtCore.Qt.SolidLine, QtCore.Qt.RoundCap)
+    handleHoverPen = QtGui.QPen(QtGui.QColor("blue"), 0.6)
+    handleBrush = QtGui.QBrush(QtGui.QColor("blue"))
+    outlinePen = QtGui.QPen(QtGui.QColor("blue"), 2)
+    # model proposals that nobody has reviewed yet
+    proposalPen = QtGui.QPen(QtGui.QColor("blue"), 2, QtCore.Qt.DashLine)
+    # level of detail: below handleScale no vertex handles are drawn, below simplifyScale the outline is
+    # replaced by a Douglas-Peucker simplification with a tolerance of simplifyTolerance screen pixels
+    handleScale = 0.5
+    simplifyScale = 0.75
+    simplifyTolerance = 0.5
+    simplifyMinPoints = 16
+
     def __init__(self, parent=None):
         super(PolygonAnnotation, self).__init__(parent)
         self.mPoints = []
         self.setZValue(10)
-        self.setPen(QtGui.QPen(QtGui.QColor("blue"), 2))
+        self.setPen(self.outlinePen)
         self.setAcceptHoverEvents(True)
 
         self.setFlag(QtWidgets.QGraphicsItem.ItemIsSelectable, True)
@@ -76,46 +71,273 @@ class PolygonAnnotation(QtWidgets.QGraphicsPolygonItem):
         self.setCursor(QtGui.QCursor(QtCore.Qt.PointingHandCursor))
         # self.setBrush(QtGui.QColor(63, 136, 143, 100))
 
-        self.mItems = []
+        self.mHoverIndex = -1
+        self.mDragIndex = -1
+        self.mDragCount = 0
+        self.mPressPos = None
+        self.mIndexedCount = 0
+        self.mIndexPending = False
+        # class id and the point buffer in the scene's colorCodeDictonary this polygon was committed to
+        self.mClassId = None
+        self.mData = None
+        self.mReviewed = True
+        self.mSimplified = {}
+        # outline, fill and vertex handles are in the scene's polygon layer, the item itself only paints
+        # while the cursor is on one of its handles
+        self.mCached = False
+
+    def setCached(self, cached):
+        self.mCached = cached
+        self.setFlag(QtWidgets.QGraphicsItem.ItemHasNoContents, cached and self.mHoverIndex < 0)
+
+    def setReviewed(self, reviewed):
+        self.mReviewed = reviewed
+        self.setPen(self.outlinePen if reviewed else self.proposalPen)
 
     def number_of_points(self):
-        return len(self.mItems)
+        return len(self.mPoints)
+
+    def rebuildPolygon(self):
+        self.setPolygon(QtGui.QPolygonF(self.mPoints))
+        self.mSimplified = {}
 
     def addPoint(self, p):
         self.mPoints.append(p)
-        self.setPolygon(QtGui.QPolygonF(self.mPoints))
-        item = PolygonItemsDisplay(self, len(self.mPoints) - 1)
-        item.setScale(0.3)
-        self.scene().addItem(item)
-        self.mItems.append(item)
-        item.setPos(p)
+        self.rebuildPolygon()
+        self.updateSpatialIndex((len(self.mPoints) - 1,))
+
+    def setPoints(self, points):
+        self.mPoints = list(points)
+        self.rebuildPolygon()
+        scene = self.scene()
+        if hasattr(scene, 'deferSpatialIndex'):
+            scene.deferSpatialIndex(self)
+        else:
+            self.updateSpatialIndex(range(len(self.mPoints)))
+
+    def insertPoint(self, i, p):
+        self.mPoints.insert(i, p)
+        self.rebuildPolygon()
+        self.updateSpatialIndex(range(i, len(self.mPoints)))
+
+    def removePoint(self, i):
+        if 0 <= i < len(self.mPoints):
+            del self.mPoints[i]
+            self.rebuildPolygon()
+            self.updateSpatialIndex(range(i, len(self.mPoints)))
+
+    def clearPoints(self):
+        # drops the whole outline in one step, the scene clears the spatial index for all items at once
+        self.mPoints = []
+        self.mIndexedCount = 0
+        self.mIndexPending = False
+        self.mSimplified = {}
+        self.setPolygon(QtGui.QPolygonF())
+
+    def reset(self):
+        # back to the state of a new item, so a pooled item can be rebound to the next image
+        self.clearPoints()
+        self.mHoverIndex = -1
+        self.mDragIndex = -1
+        self.mPressPos = None
+        self.mClassId = None
+        self.mData = None
+        self.setReviewed(True)
+        if self.mCached:
+            self.setCached(False)
+        self.setPos(0, 0)
 
     def removeLastPoint(self):
         if self.mPoints:
             self.mPoints.pop()
-            self.setPolygon(QtGui.QPolygonF(self.mPoints))
-            it = self.mItems.pop()
-            self.scene().removeItem(it)
-            del it
+            self.rebuildPolygon()
+            self.updateSpatialIndex(())
 
     def movePoint(self, i, p):
+        self.setPoint(i, self.mapFromScene(p))
+
+    def setPoint(self, i, p):
         if 0 <= i < len(self.mPoints):
-            self.mPoints[i] = self.mapFromScene(p)
-            self.setPolygon(QtGui.QPolygonF(self.mPoints))
+            self.mPoints[i] = p
+            self.rebuildPolygon()
+            self.updateSpatialIndex((i,))
+
+    def scenePoints(self):
+        return [self.mapToScene(p) for p in self.mPoints]
 
-    def move_item(self, index, pos):
-        if 0 <= index < len(self.mItems):
-            item = self.mItems[index]
-            item.setEnabled(False)
-            item.setPos(pos)
-            item.setEnabled(True)
+    def pushCommand(self, command):
+        scene = self.scene()
+        if hasattr(scene, 'pushCommand'):
+            scene.pushCommand(command)
+        else:
+            command.redo()
+
+    def spatialIndex(self):
+        return getattr(self.scene(), 'spatialIndex', None)
+
+    def updateSpatialIndex(self, indices):
+        # re-registers the given vertices, their two adjacent edges and the closing edge in scene coordinates
+        grid = self.spatialIndex()
+        if grid is None or self.mIndexPending:
+            return
+        n = len(self.mPoints)
+        for i in range(n, self.mIndexedCount):
+            grid.remove((self, 'vertex', i))
+            grid.remove((self, 'edge', i))
+        self.mIndexedCount = n
+        if not n:
+            return
+        offset = self.pos()
+        ox, oy = offset.x(), offset.y()
+        edges = {n - 1}
+        for i in indices:
+            if 0 <= i < n:
+                p = self.mPoints[i]
+                x, y = p.x() + ox, p.y() + oy
+                grid.insert((self, 'vertex', i), x, y, x, y)
+                edges.add(i)
+                edges.add((i - 1) % n)
+        for i in edges:
+            a, b = self.mPoints[i], self.mPoints[(i + 1) % n]
+            grid.insert((self, 'edge', i), min(a.x(), b.x()) + ox, min(a.y(), b.y()) + oy,
+                        max(a.x(), b.x()) + ox, max(a.y(), b.y()) + oy)
+
+    def removeFromSpatialIndex(self):
+        scene = self.scene()
+        if self.mIndexPending and scene is not None:
+            scene.pendingIndex.discard(self)
+        self.mIndexPending = False
+        grid = self.spatialIndex()
+        if grid is not None:
+            for i in range(self.mIndexedCount):
+                grid.remove((self, 'vertex', i))
+                grid.remove((self, 'edge', i))
+        self.mIndexedCount = 0
 
     def itemChange(self, change, value):
         if change == QtWidgets.QGraphicsItem.ItemPositionHasChanged:
-            for i, point in enumerate(self.mPoints):
-                self.move_item(i, self.mapToScene(point))
+            self.updateSpatialIndex(range(len(self.mPoints)))
         return super(PolygonAnnotation, self).itemChange(change, value)
 
+    def handleAt(self, pos):
+        radius = self.handleHoverSize * self.handleHoverSize
+        for i in range(len(self.mPoints) - 1, -1, -1):
+            d = self.mPoints[i] - pos
+            if d.x() * d.x() + d.y() * d.y() <= radius:
+                return i
+        return -1
+
+    def boundingRect(self):
+        margin = self.handleHoverSize + 1
+        return super(PolygonAnnotation, self).boundingRect().adjusted(-margin, -margin, margin, margin)
+
+    def contains(self, point):
+        return super(PolygonAnnotation, self).contains(point) or self.handleAt(point) >= 0
+
+    def isEditing(self):
+        scene = self.scene()
+        return (self.isSelected() or self.mDragIndex >= 0 or self.mHoverIndex >= 0
+                or getattr(scene, 'polygonItem', None) is self)
+
+    def simplifiedPolygon(self, scale):
+        # cached per power-of-two zoom level, so zooming in and out again does not recompute anything
+        level = int(math.floor(math.log2(1.0 / scale)))
+        polygon = self.mSimplified.get(level)
+        if polygon is None:
+            xy = np.array([(p.x(), p.y()) for p in self.mPoints], dtype=np.float64)
+            simplified = simplifyPolygon(xy, self.simplifyTolerance * (1 << level))
+            polygon = QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in simplified])
+            self.mSimplified[level] = polygon
+        return polygon
+
+    def layerPolygon(self, scale):
+        if 0 < scale < self.simplifyScale and len(self.mPoints) >= self.simplifyMinPoints:
+            return self.simplifiedPolygon(scale)
+        return self.polygon()
+
+    def paintLayer(self, painter, level, handles):
+        # what the polygon layer draws for a cached polygon, handles being whether the view shows them
+        painter.setPen(self.pen())
+        painter.setBrush(self.brush())
+        painter.drawPolygon(self.layerPolygon(level))
+        if handles and self.mPoints:
+            painter.setPen(self.handlePen)
+            painter.drawPoints(self.polygon())
+
+    def paint(self, painter, option, widget=None):
+        profiler.count('polygon.paint')
+        scale = QtWidgets.QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        if self.mCached:
+            self.paintHandles(painter, scale)
+            return
+        if (0 < scale < self.simplifyScale and len(self.mPoints) >= self.simplifyMinPoints
+                and not self.isEditing()):
+            profiler.count('polygon.paint.simplified')
+            painter.setPen(self.pen())
+            painter.setBrush(self.brush())
+            painter.drawPolygon(self.simplifiedPolygon(scale))
+            return
+        super(PolygonAnnotation, self).paint(painter, option, widget)
+        self.paintHandles(painter, scale)
+
+    def paintHandles(self, painter, scale):
+        if not self.mPoints or scale < self.handleScale:
+            return
+        painter.setPen(self.handlePen)
+        painter.drawPoints(self.polygon())
+        if 0 <= self.mHoverIndex < len(self.mPoints):
+            p = self.mPoints[self.mHoverIndex]
+            size = self.handleHoverSize
+            painter.setPen(self.handleHoverPen)
+            painter.setBrush(self.handleBrush)
+            painter.drawRect(QtCore.QRectF(p.x() - size, p.y() - size, 2 * size, 2 * size))
+
+    def setHoverIndex(self, index):
+        if index != self.mHoverIndex:
+            self.mHoverIndex = index
+            if self.mCached:
+                self.setCached(True)
+            self.update()
+
+    def hoverMoveEvent(self, event):
+        self.setHoverIndex(self.handleAt(event.pos()))
+        super(PolygonAnnotation, self).hoverMoveEvent(event)
+
+    def hoverLeaveEvent(self, event):
+        self.setHoverIndex(-1)
+        super(PolygonAnnotation, self).hoverLeaveEvent(event)
+
+    def mousePressEvent(self, event):
+        self.mDragIndex = self.handleAt(event.pos()) if event.button() == QtCore.Qt.LeftButton else -1
+        if self.mDragIndex >= 0:
+            self.mDragCount += 1
+            # the dragged polygon is painted live, not from the layer
+            if hasattr(self.scene(), 'updateLayer'):
+                self.scene().updateLayer(self)
+            event.accept()
+            return
+        self.mPressPos = self.pos()
+        super(PolygonAnnotation, self).mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self.mDragIndex >= 0:
+            self.pushCommand(MoveVertexCommand(self.scene(), self, self.mDragIndex, self.mPoints[self.mDragIndex],
+                                               self.mapFromScene(event.scenePos()), self.mDragCount))
+            return
+        super(PolygonAnnotation, self).mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if self.mDragIndex >= 0:
+            self.mDragIndex = -1
+            self.setSelected(False)
+            if hasattr(self.scene(), 'updateLayer'):
+                self.scene().updateLayer(self)
+            return
+        super(PolygonAnnotation, self).mouseReleaseEvent(event)
+        if self.mPressPos is not None and self.mPressPos != self.pos():
+            self.pushCommand(MovePolygonCommand(self.scene(), self, self.mPressPos, self.pos()))
+        self.mPressPos = None
+
     # def mousePressEvent(self, event):
     #     print(self.mPoints)
     #     labelType.append(self.mPoints)
@@ -141,52 +363,137 @@ class Instructions(Enum):
 
 
 class ImageScene(QtWidgets.QGraphicsScene):
+    # class id of every polygon finished by the operator
+    polygonCommitted = QtCore.Signal(int)
+
     def __init__(self, parent=None):
         super(ImageScene, self).__init__(parent)
         self.imageItem = QtWidgets.QGraphicsPixmapItem()
         self.imageItem.setCursor(QtGui.QCursor(QtCore.Qt.CrossCursor))
+        # the smooth scaled image is kept in device pixels, a pan only translates it
+        self.imageItem.setCacheMode(QtWidgets.QGraphicsItem.DeviceCoordinateCache)
         self.addItem(self.imageItem)
+        self.tiledItem = TiledImageItem()
+        self.tiledItem.setCursor(QtGui.QCursor(QtCore.Qt.CrossCursor))
+        self.addItem(self.tiledItem)
+        # $PARCEL_RENDER=items paints every polygon item on every repaint instead of the cached layer
+        self.layerMode = os.environ.get('PARCEL_RENDER', 'layer') != 'items'
+        self.polygonLayer = PolygonLayerItem(PolygonAnnotation.handleScale)
+        self.addItem(self.polygonLayer)
         self.currentInstruction = Instructions.NoInstruction
+        # the polygon being drawn, only allocated on its first point, in the class drawClass
+        self.polygonItem = None
+        self.drawClass = None
         self.polygonItems = []
+        # annotation items of the previous image, rebound instead of reallocated on the next one
+        self.itemPool = []
         self.imageName = ''
         self.polygonPoints = []
         self.colorCodeDictonary = {}
-        self.getColorOfPoly = []
+        # unreviewed model proposals, same layout as colorCodeDictonary
+        self.proposalDictonary = {}
         self.categorizedPolys = {}
-
-    def load_image(self, filename):
-        self.imageItem.setPixmap(QtGui.QPixmap(filename))
-        self.setSceneRect(self.imageItem.boundingRect())
+        self.spatialIndex = UniformGrid(32)
+        # polygons loaded with an image are only indexed on the first snap query
+        self.pendingIndex = set()
+        self.snapDistance = 8
+        # the edge following the cursor while drawing is a separate overlay, the polygon itself only
+        # changes on click; cursor moves are coalesced to one overlay update per frame
+        self.rubberBand = QtWidgets.QGraphicsPathItem()
+        self.rubberBand.setPen(QtGui.QPen(QtGui.QColor("blue"), 2))
+        self.rubberBand.setAcceptedMouseButtons(QtCore.Qt.NoButton)
+        self.rubberBand.setZValue(12)
+        self.addItem(self.rubberBand)
+        self.rubberBandPos = None
+        self.rubberBandTimer = QtCore.QTimer(self)
+        self.rubberBandTimer.setSingleShot(True)
+        self.rubberBandTimer.setInterval(16)
+        self.rubberBandTimer.timeout.connect(self.updateRubberBand)
+        self.undoStack = QtWidgets.QUndoStack(self)
+        self.undoStack.setUndoLimit(500)
+        # autosave: every edit restarts the quiet period, a burst of edits becomes a single write
+        self.autosaveTimer = QtCore.QTimer(self)
+        self.autosaveTimer.setSingleShot(True)
+        self.autosaveTimer.setInterval(1500)
+        self.autosaveTimer.timeout.connect(self.autosave)
+        self.undoStack.indexChanged.connect(self.scheduleAutosave)
+        self.selectionChanged.connect(self.refreshPolygonLayer)
+        self.showOverlay = False
+        self.overlayFont = QtGui.QFont('monospace', 9)
+
+    def load_image(self, filename, image=None):
+        with profiler.timer('load_image.pixmap'):
+            if image is None and TiledImageItem.isLarge(filename):
+                self.imageItem.setPixmap(QtGui.QPixmap())
+                self.tiledItem.setSource(filename)
+                self.setSceneRect(self.tiledItem.boundingRect())
+            else:
+                self.tiledItem.clear()
+                if image is None:
+                    self.imageItem.setPixmap(QtGui.QPixmap.fromImage(readImage(filename)))
+                else:
+                    self.imageItem.setPixmap(QtGui.QPixmap.fromImage(image))
+                self.setSceneRect(self.imageItem.boundingRect())
+        self.polygonLayer.setRect(self.sceneRect())
         self.imageName = filename
+        with profiler.timer('load_image.rebuild'):
+            self.loadPolygons(filename)
+
+    def loadPolygons(self, filename):
         if filename in imagePolygon:
             imagePolyData = imagePolygon[filename]
             self.colorCodeDictonary = imagePolyData
-            if 0 in self.colorCodeDictonary:
-                self.createPoly(0)
-            if 1 in self.colorCodeDictonary:
-                self.createPoly(1)
-            if 2 in self.colorCodeDictonary:
-                self.createPoly(2)
-            if 3 in self.colorCodeDictonary:
-                self.createPoly(3)
-            if 4 in self.colorCodeDictonary:
-                self.createPoly(4)
-            if 5 in self.colorCodeDictonary:
-                self.createPoly(5)
-            if 6 in self.colorCodeDictonary:
-                self.createPoly(6)
-
-    def createPoly(self, colorCode):
+            for classId in sorted(self.colorCodeDictonary):
+                if classId in classRegistry:
+                    self.createPoly(classId)
+            self.proposalDictonary = imagePolygon.load(filename, reviewed=False)
+            for classId in sorted(self.proposalDictonary):
+                if classId in classRegistry:
+                    self.createPoly(classId, reviewed=False)
+        elif (imageArchive is not None and imagePolygon.key(filename) in imageArchive
+              and not imagePolygon.isEmptied(filename)):
+            # images without edits in the store come straight out of the mapped archive
+            self.colorCodeDictonary = imageArchive.colorDict(imagePolygon.key(filename))
+            for classId in sorted(self.colorCodeDictonary):
+                if classId in classRegistry:
+                    self.createPoly(classId)
+        # createPoly leaves the last loaded polygon here, drawing has to start a new one
+        self.polygonItem = None
+        self.refreshPolygonLayer()
+
+    def acquirePolygon(self):
+        item = self.itemPool.pop() if self.itemPool else PolygonAnnotation()
+        self.addItem(item)
+        self.polygonItems.append(item)
+        return item
+
+    def addProposals(self, polygons):
+        # [(classId, [x0, y0, x1, y1, ...]), ...] from the pre-annotation pipeline
+        added = set()
+        for classId, points in polygons:
+            if classId in classRegistry and len(points) >= 6:
+                self.proposalDictonary.setdefault(classId, []).append(array('f', points))
+                added.add(classId)
+        for classId in sorted(added):
+            self.createPoly(classId, reviewed=False)
+        self.polygonItem = None
+        self.refreshPolygonLayer()
+
+    @profiled('createPoly')
+    def createPoly(self, colorCode, reviewed=True):
         # print('COLORCOLORCOLOR', self.colorCodeList[colorCode])
         self.categorizedPolys = {}
-        for i in self.colorCodeDictonary[colorCode]:
-            print('III', i)
-            self.polygonItem = PolygonAnnotation()
+        polygons = self.colorCodeDictonary if reviewed else self.proposalDictonary
+        existing = set(id(item.mData) for item in self.polygonItems)
+        for i in polygons[colorCode]:
+            if id(i) in existing:
+                continue
+            self.polygonItem = self.acquirePolygon()
+            self.polygonItem.setReviewed(reviewed)
             self.setPolygonColor(colorCode)
-            self.addItem(self.polygonItem)
-            self.polygonItems.append(self.polygonItem)
-            for k in i:
-                self.positionAddPoint(k)
+            xy = np.frombuffer(i, dtype=np.float32).reshape(-1, 2).tolist()
+            self.polygonItem.setPoints([QtCore.QPointF(x, y) for x, y in xy])
+            self.polygonItem.mData = i
             if colorCode in self.categorizedPolys:
                 self.categorizedPolys[colorCode].append(i)
             else:
@@ -194,96 +501,405 @@ class ImageScene(QtWidgets.QGraphicsScene):
                 createTmpListCoord.append(i)
                 self.categorizedPolys[colorCode] = createTmpListCoord
             self.polygonPoints = []
-        print('KATEGORIEN', self.categorizedPolys)
+        profiler.count('polygons.created', len(self.categorizedPolys.get(colorCode, ())))
+        log.debug('class %s: %d polygons', colorCode, len(self.categorizedPolys.get(colorCode, ())))
 
     def setPolygonColor(self, colorcode):
-        if colorcode == 0:
-            self.polygonItem.setBrush(QtGui.QColor(255, 0, 0, 150))
-        elif colorcode == 1:
-            self.polygonItem.setBrush(QtGui.QColor(0, 0, 255, 150))
-        elif colorcode == 2:
-            self.polygonItem.setBrush(QtGui.QColor(0, 255, 0, 150))
-        elif colorcode == 3:
-            self.polygonItem.setBrush(QtGui.QColor(255, 127, 36, 150))
-        elif colorcode == 4:
-            self.polygonItem.setBrush(QtGui.QColor(155, 48, 255, 150))
-        elif colorcode == 5:
-            self.polygonItem.setBrush(QtGui.QColor(0, 191, 255, 150))
-        elif colorcode == 6:
-            self.polygonItem.setBrush(QtGui.QColor(255, 0, 255, 150))
+        category = classRegistry.get(colorcode)
+        if category is None:
+            return
+        self.polygonItem.mClassId = colorcode
+        # one brush per class, shared by all of its polygons
+        self.polygonItem.setBrush(category.brush)
 
     def setCurrentInstruction(self, instruction, colorcode):
-            self.currentInstruction = instruction
-            self.polygonItem = PolygonAnnotation()
+        # finishes the polygon being drawn, the next one is allocated by its first click
+        self.finishPolygon()
+        self.currentInstruction = instruction
+        self.drawClass = colorcode
+
+    def setDrawClass(self, colorcode):
+        # rapid mode: a class key recolors the polygon being drawn instead of finishing it
+        self.currentInstruction = Instructions.PolygonInstruction
+        self.drawClass = colorcode
+        if self.polygonItem is not None:
             self.setPolygonColor(colorcode)
-            self.addItem(self.polygonItem)
-            self.polygonItems.append(self.polygonItem)
 
-            if self.currentInstruction == Instructions.PolygonInstruction:
-                self.getColorOfPoly.append(self.polygonItem.brush().color())
-
-            if len(self.polygonPoints) != 0 and len(self.getColorOfPoly) > 0:
-                if self.getColorOfPoly[0].getRgb() == QColor(255, 0, 0, 150).getRgb():
-                    self.onCreateColorList(0)
-                elif self.getColorOfPoly[0].getRgb() == QColor(0, 0, 255, 150).getRgb():
-                    self.onCreateColorList(1)
-                elif self.getColorOfPoly[0].getRgb() == QColor(0, 255, 0, 150).getRgb():
-                    self.onCreateColorList(2)
-                elif self.getColorOfPoly[0].getRgb() == QColor(255, 127, 36, 150).getRgb():
-                    self.onCreateColorList(3)
-                elif self.getColorOfPoly[0].getRgb() == QColor(155, 48, 255, 150).getRgb():
-                    self.onCreateColorList(4)
-                elif self.getColorOfPoly[0].getRgb() == QColor(0, 191, 255, 150).getRgb():
-                    self.onCreateColorList(5)
-                elif self.getColorOfPoly[0].getRgb() == QColor(255, 0, 255, 150).getRgb():
-                    self.onCreateColorList(6)
-
-
-                print('CODELIST', self.colorCodeDictonary)
+    def finishPolygon(self):
+        item = self.polygonItem
+        committed = item is not None and len(self.polygonPoints) != 0 and item.mClassId in classRegistry
+        if committed:
+            self.onCreateColorList(item.mClassId)
+            log.debug('CODELIST %s', self.colorCodeDictonary)
+        self.polygonItem = None
+        self.polygonPoints = []
+        self.rubberBand.setPath(QtGui.QPainterPath())
+        if item is not None:
+            self.updateLayer(item)
+        if committed:
+            self.commitImage()
+            profiler.count('polygons.committed')
+            self.polygonCommitted.emit(item.mClassId)
+        return committed
+
+    def closePolygon(self):
+        # Enter: closes the polygon being drawn, the next click starts one of the same class
+        if self.polygonItem is None or len(self.polygonPoints) < 3:
+            return False
+        return self.finishPolygon()
+
+    # #-------------------------------------------------------------------------------------------------------------------
+    # #   Polygon layer: committed polygons that nobody is editing are painted from one cached pixmap
+    # # -----------------------------------------------------------------------------------------------------------------
+
+    def isLayered(self, item):
+        return (self.layerMode and item.mData is not None and item is not self.polygonItem
+                and not item.isSelected() and item.mDragIndex < 0)
+
+    def updateLayer(self, item):
+        layered = self.isLayered(item)
+        if layered == item.mCached:
+            return
+        item.setCached(layered)
+        item.update()
+        if layered:
+            self.polygonLayer.addPolygons([item])
+        else:
+            self.polygonLayer.removePolygon(item)
+
+    @QtCore.Slot()
+    def refreshPolygonLayer(self):
+        added = []
+        for item in self.polygonItems:
+            layered = self.isLayered(item)
+            if layered == item.mCached:
+                continue
+            item.setCached(layered)
+            item.update()
+            if layered:
+                added.append(item)
+            else:
+                self.polygonLayer.removePolygon(item)
+        if added:
+            self.polygonLayer.addPolygons(added)
+
+    def uncache(self, item):
+        # the layer cannot erase one polygon, it is rasterized again without it
+        if item.mCached:
+            item.setCached(False)
+            self.polygonLayer.removePolygon(item)
+
+    def setLayerMode(self, enabled):
+        self.layerMode = enabled
+        self.refreshPolygonLayer()
+
+    def toggleLayerMode(self):
+        self.setLayerMode(not self.layerMode)
+
+    @QtCore.Slot(int)
+    def scheduleAutosave(self, index):
+        self.autosaveTimer.start()
+
+    def autosave(self):
+        if self.undoStack.isClean():
+            return
+        # not in the middle of a polygon or a drag, the write would only be repeated when it ends
+        if self.polygonItem is not None or self.mouseGrabberItem() is not None:
+            self.autosaveTimer.start()
+            return
+        self.commitImage()
+
+    def commitImage(self):
+        # written in the background, the image stays clean until the next edit
+        addToImagePoly(self.colorCodeDictonary, self.imageName, self.proposalDictonary)
+        self.undoStack.setClean()
 
     def onCreateColorList(self, var):
+        polygonArray = pointsToArray(self.polygonPoints)
         if var not in self.colorCodeDictonary:
             polyTmpPointsCoord = []
-            polyTmpPointsCoord.append(self.polygonPoints)
+            polyTmpPointsCoord.append(polygonArray)
             self.colorCodeDictonary[var] = polyTmpPointsCoord
-        elif self.polygonPoints not in self.colorCodeDictonary[var]:
-            self.colorCodeDictonary[var].append(self.polygonPoints)
-        self.getColorOfPoly = []
+        elif polygonArray not in self.colorCodeDictonary[var]:
+            self.colorCodeDictonary[var].append(polygonArray)
+        else:
+            polygonArray = None
+        if polygonArray is not None and self.polygonItem is not None:
+            self.polygonItem.mClassId = var
+            self.polygonItem.mData = polygonArray
         self.polygonPoints = []
 
     def mousePressEvent(self, event):
         if self.currentInstruction == Instructions.PolygonInstruction:
-            self.positionAddPoint(event.scenePos())
+            self.positionAddPoint(self.snapPosition(event.scenePos()))
         super(ImageScene, self).mousePressEvent(event)
 
+    def mouseDoubleClickEvent(self, event):
+        if self.currentInstruction == Instructions.NoInstruction:
+            edge = self.nearestEdge(event.scenePos(), self.snapRadius())
+            if edge is not None:
+                item, index, x, y = edge
+                self.pushCommand(InsertPointCommand(self, item, index + 1, item.mapFromScene(QtCore.QPointF(x, y))))
+                return
+        super(ImageScene, self).mouseDoubleClickEvent(event)
+
+    def snapRadius(self):
+        # snapDistance is given in screen pixels, the index works in scene coordinates
+        views = self.views()
+        scale = views[0].transform().m11() if views else 1.0
+        return self.snapDistance / scale if scale > 0 else self.snapDistance
+
+    def deferSpatialIndex(self, item):
+        item.removeFromSpatialIndex()
+        item.mIndexPending = True
+        self.pendingIndex.add(item)
+
+    def flushSpatialIndex(self):
+        for item in self.pendingIndex:
+            item.mIndexPending = False
+            item.updateSpatialIndex(range(len(item.mPoints)))
+        self.pendingIndex.clear()
+
+    def nearestVertex(self, pos, radius, exclude=None):
+        self.flushSpatialIndex()
+        x, y = pos.x(), pos.y()
+        best, bestDistance = None, radius * radius
+        for key in self.spatialIndex.query(x - radius, y - radius, x + radius, y + radius):
+            if key[1] != 'vertex' or key == exclude:
+                continue
+            vx, vy = self.spatialIndex.bounds(key)[:2]
+            distance = (vx - x) * (vx - x) + (vy - y) * (vy - y)
+            if distance <= bestDistance:
+                best, bestDistance = (key[0], key[2], vx, vy), distance
+        return best
+
+    def nearestEdge(self, pos, radius):
+        self.flushSpatialIndex()
+        x, y = pos.x(), pos.y()
+        best, bestDistance = None, radius * radius
+        for key in self.spatialIndex.query(x - radius, y - radius, x + radius, y + radius):
+            if key[1] != 'edge':
+                continue
+            item, index = key[0], key[2]
+            n = len(item.mPoints)
+            a, b = item.mapToScene(item.mPoints[index]), item.mapToScene(item.mPoints[(index + 1) % n])
+            px, py, distance = projectOnSegment(x, y, a.x(), a.y(), b.x(), b.y())
+            if distance <= bestDistance:
+                best, bestDistance = (item, index, px, py), distance
+        return best
+
+    def snapPosition(self, pos):
+        vertex = self.nearestVertex(pos, self.snapRadius())
+        if vertex is None:
+            return pos
+        return QtCore.QPointF(vertex[2], vertex[3])
+
     def positionAddPoint(self, position):
-        self.polygonItem.removeLastPoint()
-        self.polygonItem.addPoint(position)
-        self.polygonItem.addPoint(position)
-        self.polygonPoints.append(position)
+        if self.polygonItem is None:
+            self.polygonItem = self.acquirePolygon()
+            self.setPolygonColor(self.drawClass)
+        self.pushCommand(AddPointCommand(self, self.polygonItem, position))
+        self.rubberBandPos = position
+        self.updateRubberBand()
+
+    def pushCommand(self, command):
+        self.undoStack.push(command)
+
+    # #-------------------------------------------------------------------------------------------------------------------
+    # #   Edits on committed polygons, kept in sync with colorCodeDictonary
+    # # -----------------------------------------------------------------------------------------------------------------
+
+    def syncPolygon(self, item):
+        if item.mData is not None:
+            item.mData[:] = pointsToArray(item.scenePoints())
+        if item.mCached:
+            self.polygonLayer.invalidate()
+
+    def polygonDictionary(self, item):
+        return self.colorCodeDictonary if item.mReviewed else self.proposalDictonary
+
+    def detachPolygon(self, item):
+        if item.mData is not None:
+            polygons = self.polygonDictionary(item).get(item.mClassId, [])
+            for i, data in enumerate(polygons):
+                if data is item.mData:
+                    del polygons[i]
+                    break
+        item.removeFromSpatialIndex()
+        self.uncache(item)
+        if item in self.polygonItems:
+            self.polygonItems.remove(item)
+        if item.scene() is self:
+            self.removeItem(item)
+
+    def attachPolygon(self, item):
+        if item.scene() is not self:
+            self.addItem(item)
+        self.polygonItems.append(item)
+        item.updateSpatialIndex(range(len(item.mPoints)))
+        if item.mData is not None:
+            self.polygonDictionary(item).setdefault(item.mClassId, []).append(item.mData)
+        self.updateLayer(item)
+
+    def setPolygonClass(self, item, classId):
+        committed = item.mData is not None
+        if committed:
+            self.detachPolygon(item)
+        previous, self.polygonItem = self.polygonItem, item
+        self.setPolygonColor(classId)
+        self.polygonItem = previous
+        if committed:
+            self.attachPolygon(item)
+
+    def setPolygonReviewed(self, item, reviewed):
+        self.detachPolygon(item)
+        item.setReviewed(reviewed)
+        self.attachPolygon(item)
+
+    def acceptProposals(self):
+        # accepts the selected proposals, or every proposal of the image when none is selected
+        proposals = [item for item in self.committedPolygons(False) if not item.mReviewed]
+        items = [item for item in proposals if item.isSelected()] or proposals
+        if not items:
+            return
+        self.undoStack.beginMacro('accept proposals')
+        for item in items:
+            self.pushCommand(ReviewPolygonCommand(self, item))
+        self.undoStack.endMacro()
+
+    def committedPolygons(self, selectedOnly):
+        return [item for item in self.polygonItems
+                if item.mData is not None and (item.isSelected() or not selectedOnly)]
+
+    def deletePolygons(self):
+        # deletes the selected polygons, or every polygon of the image when nothing is selected
+        items = self.committedPolygons(True) or self.committedPolygons(False)
+        if not items:
+            return
+        self.undoStack.beginMacro('delete polygons')
+        for item in items:
+            self.pushCommand(DeletePolygonCommand(self, item))
+        self.undoStack.endMacro()
+
+    def changeSelectedClass(self, classId):
+        # only outside of drawing, a click while drawing may select a neighbouring polygon by accident
+        if self.currentInstruction != Instructions.NoInstruction:
+            return False
+        items = [item for item in self.committedPolygons(True) if item.mClassId != classId]
+        if not items:
+            return False
+        self.undoStack.beginMacro('change class')
+        for item in items:
+            self.pushCommand(ChangeClassCommand(self, item, item.mClassId, classId))
+        self.undoStack.endMacro()
+        return True
+
+    def updateRubberBand(self):
+        path = QtGui.QPainterPath()
+        item = self.polygonItem
+        if (self.currentInstruction == Instructions.PolygonInstruction and item is not None and item.mPoints
+                and self.rubberBandPos is not None):
+            cursor = self.snapPosition(self.rubberBandPos)
+            path.moveTo(item.mapToScene(item.mPoints[-1]))
+            path.lineTo(cursor)
+            path.lineTo(item.mapToScene(item.mPoints[0]))
+        self.rubberBand.setPath(path)
 
     def mouseMoveEvent(self, event):
-        if self.currentInstruction == Instructions.PolygonInstruction:
-            self.polygonItem.movePoint(self.polygonItem.number_of_points() - 1, event.scenePos())
-        super(ImageScene, self).mouseMoveEvent(event)
+        with profiler.timer('scene.mouseMove'):
+            if self.currentInstruction == Instructions.PolygonInstruction:
+                self.rubberBandPos = event.scenePos()
+                if not self.rubberBandTimer.isActive():
+                    self.rubberBandTimer.start()
+            super(ImageScene, self).mouseMoveEvent(event)
+
+    # #-------------------------------------------------------------------------------------------------------------------
+    # #   Paint timing and the performance overlay
+    # # -----------------------------------------------------------------------------------------------------------------
+
+    def drawBackground(self, painter, rect):
+        # background and foreground bracket the items, together they time one scene paint
+        profiler.begin('scene.paint')
+        super(ImageScene, self).drawBackground(painter, rect)
+
+    def drawForeground(self, painter, rect):
+        super(ImageScene, self).drawForeground(painter, rect)
+        profiler.end('scene.paint')
+        if self.showOverlay:
+            self.drawOverlay(painter)
+
+    def overlayLines(self):
+        lines = ['frame %6.2f ms  mean %6.2f ms' % (profiler.last('scene.paint') * 1000.0,
+                                                    profiler.mean('scene.paint') * 1000.0),
+                 'items %d  polygons %d' % (len(self.items()), len(self.polygonItems))]
+        for name, stats in sorted(profiler.sources.items()):
+            values = stats()
+            lines.append('%s hit rate %3.0f%%  (%d/%d)' % (name, 100.0 * values['hitRate'], values['hits'],
+                                                           values['hits'] + values['misses']))
+        return lines
+
+    def drawOverlay(self, painter):
+        lines = self.overlayLines()
+        painter.save()
+        # viewport coordinates, the overlay does not zoom with the image
+        painter.resetTransform()
+        painter.setFont(self.overlayFont)
+        metrics = QtGui.QFontMetrics(self.overlayFont)
+        height = metrics.height()
+        width = max(metrics.horizontalAdvance(line) for line in lines)
+        painter.fillRect(QtCore.QRectF(4, 4, width + 12, height * len(lines) + 8), QtGui.QColor(0, 0, 0, 160))
+        painter.setPen(QtGui.QColor('white'))
+        for i, line in enumerate(lines):
+            painter.drawText(QtCore.QPointF(10, 8 + metrics.ascent() + i * height), line)
+        painter.restore()
+
+    def toggleOverlay(self):
+        self.showOverlay = not self.showOverlay
+        self.update()
 
     def removePolygon(self):
-        addToImagePoly(self.colorCodeDictonary, self.imageName)
+        # every edit goes through the undo stack, an image that is still clean has nothing to write
+        if not self.undoStack.isClean():
+            self.commitImage()
+        # the commands reference the items that are recycled below
+        self.undoStack.clear()
+        self.autosaveTimer.stop()
+        # an unfinished polygon is dropped with its image
+        self.currentInstruction = Instructions.NoInstruction
+        self.polygonItem = None
+        self.spatialIndex.clear()
+        self.pendingIndex.clear()
+        self.clearSelection()
         for k in self.polygonItems:
-            while len(k.mPoints) > 0:
-                k.removeLastPoint()
             self.removeItem(k)
+            k.reset()
+        self.polygonLayer.clear()
+        self.itemPool.extend(self.polygonItems)
         self.polygonItems = []
+        self.rubberBand.setPath(QtGui.QPainterPath())
         self.polygonPoints = []
         self.allPolygonPointsFromImg = []
         self.colorCodeDictonary = {}
+        self.proposalDictonary = {}
         for i in self.selectedItems():
             self.removeItem(i)
 
-imagePolygon = {}
+# annotations are persisted per image and only read back when that image is loaded
+imagePolygon = AnnotationStore()
+# read-only columnar archive of the directory (annotationarchive.py build), if there is one
+imageArchive = None
+
+def addToImagePoly(colorDict: dict, name: str, proposals: dict = None):
+    # queued, the store writes it on its background connection; the search index follows right away
+    imagePolygon.saveLater(name, colorDict, proposals)
+    if name:
+        annotationIndex.update(imagePolygon.key(name), colorDict, proposals)
 
-def addToImagePoly(colorDict: dict, name: str):
-    imagePolygon[name] = colorDict
+def connectAnnotationServer(address):
+    # annotations are shared through annotationserver.py from here on, proposals stay in the local store
+    global imagePolygon
+    imagePolygon = RemoteAnnotationStore(address, imagePolygon)
+    return imagePolygon
 
 
 class Categorization(Enum):
@@ -295,10 +911,16 @@ class Categorization(Enum):
     LightBlue = 5
     Pink = 6
 
+
+# per image class counts, areas and review state of the directory; the old color names work in filters
+annotationIndex = AnnotationIndex(classRegistry, {color.name: color.value for color in Categorization})
+
 class MainWindow(QMainWindow):
     factor = 2.0
+    # image key, reason; emitted on the sender thread of the remote store, delivered on the GUI thread
+    remoteConflict = QtCore.Signal(str, str)
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, directory=None):
         super(MainWindow, self).__init__(parent)
 
         self.ui = Ui_MainWindow()
@@ -311,45 +933,102 @@ class MainWindow(QMainWindow):
         self.mView = self.ui.imageView
         self.mScene = ImageScene(self)
         self.mView.setScene(self.mScene)
-        self.directory = '/Users/dominim/Desktop/TestData'
+        self.setupViewport()
+        self.imagePrefetcher = ImagePrefetcher(window=3, maxPixels=TiledImageItem.pixelThreshold, parent=self)
+        self.directory = directory or '/Users/dominim/Desktop/TestData'
         # self.directory = '/home/dominim/Desktop/Data/wa1122/wa1122/png_rgb/t000'
-        self.filenames = [f for f in listdir(self.directory) if isfile(join(os.path.realpath(self.directory), f))]
-        self.realpathImages = []
-        for index, filename in enumerate(self.filenames):
-            self.realpathImages.append(self.directory + '/' + filename)
-            self.ui.imageName.addItem(filename)
-        self.load_image(Instructions.BackItem)
+        # snapshots are journaled before they are written, a crash loses nothing that was queued
+        imagePolygon.open(join(self.directory, AnnotationStore.fileName), self.directory, journal=True)
+        global imageArchive
+        imageArchive = AnnotationArchive.forDirectory(self.directory)
+        # $PARCEL_SERVER=host:port shares the directory with other annotators, each image is leased to one of them
+        self.remoteStore = None
+        if os.environ.get('PARCEL_SERVER'):
+            self.remoteStore = connectAnnotationServer(os.environ['PARCEL_SERVER'])
+            self.leaseTimer = QtCore.QTimer(self)
+            self.leaseTimer.setInterval(30000)
+            self.leaseTimer.timeout.connect(self.remoteStore.ping)
+            self.leaseTimer.start()
+            # changes the server refused stay in the local store, the status bar keeps pointing at them
+            self.conflictLabel = QtWidgets.QLabel(self)
+            self.conflictLabel.setStyleSheet('color: red')
+            self.ui.statusbar.addPermanentWidget(self.conflictLabel)
+            self.remoteConflict.connect(self.onRemoteConflict)
+            self.remoteStore.conflictHandler = self.remoteConflict.emit
+            self.showConflicts()
+        self.directoryIndex = DirectoryIndex(self.directory, self)
+        self.filenames = self.directoryIndex.model.filenames
+        self.realpathImages = self.directoryIndex.model.realpathImages
+        self.ui.imageName.setUniformItemSizes(True)
+        # the list shows the images matching the filter below it, all of them without a filter
+        self.listModel = FilteredImageModel(self.directoryIndex.model, self)
+        self.ui.imageName.setModel(self.listModel)
+        annotationIndex.load(imagePolygon.statistics(),
+                             imageArchive.imageStatistics() if imageArchive is not None else ())
+        self.filterRows = None
+        self.filterVersion = None
+        self.filterEdit = QtWidgets.QLineEdit(self.ui.centralwidget)
+        self.filterEdit.setPlaceholderText('Filter, e.g. Arm Box>20')
+        self.filterEdit.setToolTip('Terms that all have to match, ! negates one:\n'
+                                   'Arm, Box>20, Arm.area>=5000, polygons<3, proposals>0,\n'
+                                   'unannotated, annotated, unreviewed, reviewed')
+        self.filterEdit.setClearButtonEnabled(True)
+        self.ui.gridLayout.replaceWidget(self.ui.label_5, self.filterEdit)
+        self.ui.label_5.hide()
+        self.filterTimer = QtCore.QTimer(self)
+        self.filterTimer.setSingleShot(True)
+        self.filterTimer.setInterval(250)
+        self.filterTimer.timeout.connect(self.applyFilter)
+        self.filterEdit.textChanged.connect(self.filterTimer.start)
+        self.filterEdit.returnPressed.connect(self.applyFilter)
+        # the image list is a filmstrip of cached thumbnails with the polygon count of each class
+        self.thumbnailDelegate = ThumbnailDelegate(self.countsFor, classRegistry, 120, self.ui.imageName)
+        self.ui.imageName.setItemDelegate(self.thumbnailDelegate)
+        self.ui.imageName.clicked.connect(self.onImageClicked)
+        self.directoryIndex.model.rowsInserted.connect(self.onImagesIndexed)
+        self.directoryIndex.start()
+        # model proposals are only computed when a backend is configured in $PARCEL_PREANNOTATE
+        self.preannotator = Preannotator.fromEnvironment(self.directory, self)
+        if self.preannotator is not None:
+            self.preannotator.ready.connect(self.onPreannotationReady)
+        # the annotations of a frame are carried forward to the next frame as proposals
+        self.propagator = Propagator(self)
+        self.propagator.ready.connect(self.onPropagationReady)
         self.ui.nextImageButton.clicked.connect(partial(self.load_image, Instructions.NextItem.value))
         self.ui.backButton.clicked.connect(partial(self.load_image, Instructions.BackItem.value))
-        self.ui.removeButton.clicked.connect(self.mScene.removePolygon)
+        self.ui.removeButton.clicked.connect(self.mScene.deletePolygons)
+        self.ui.saveTruthButton.clicked.connect(self.saveTruth)
         QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Right), self.mView,
                             activated=partial(self.load_image, Instructions.NextItem.value))
         QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Left), self.mView,
                             activated=partial(self.load_image, Instructions.BackItem.value))
+        self.exportProcess = None
+        profiler.registerSource('images', self.imagePrefetcher.stats)
+        profiler.registerSource('tiles', self.mScene.tiledItem.tiles.stats)
+        # $PARCEL_TRACE names a Chrome trace file that is written on exit
+        self.tracePath = os.environ.get('PARCEL_TRACE')
+        profiler.tracing = bool(self.tracePath)
 
 
         # self.files = self.menuBar().addMenu("File").addAction("Open")
         # self.files.triggered.connect(self.getDirectory)
 
 #-----------------------------------------------------------------------------------------------------------------------
-#   Set Color of Buttons with colorcode
+#   Category buttons, generated from the class registry
 # -----------------------------------------------------------------------------------------------------------------------
 
-        self.ui.boxButton.setStyleSheet("color: #FF0000")# Red 255, 0, 0
-        self.ui.bagButton.setStyleSheet("color: #0000FF")# blue 0, 0, 255
-        self.ui.pouchButton.setStyleSheet("color: #00FF00")# Green 0, 255, 0
-        self.ui.unknownButton.setStyleSheet("color: #FF7F24")# orange 255, 127, 36
-        self.ui.restButton.setStyleSheet("color: #9B30FF")# purple 155, 48, 255
-        self.ui.flatButton.setStyleSheet("color: #00BFFF")# Lightblue 0, 191, 255
-        self.ui.armButton.setStyleSheet("color: #FF00FF")# pink 255, 0 ,255
-
-        self.ui.boxButton.clicked.connect(partial(self.setColorCode, Categorization.Red.value))
-        self.ui.bagButton.clicked.connect(partial(self.setColorCode, Categorization.Blue.value))
-        self.ui.pouchButton.clicked.connect(partial(self.setColorCode, Categorization.Green.value))
-        self.ui.unknownButton.clicked.connect(partial(self.setColorCode, Categorization.Orange.value))
-        self.ui.restButton.clicked.connect(partial(self.setColorCode, Categorization.Purple.value))
-        self.ui.flatButton.clicked.connect(partial(self.setColorCode, Categorization.LightBlue.value))
-        self.ui.armButton.clicked.connect(partial(self.setColorCode, Categorization.Pink.value))
+        self.categoryButtons = {}
+        for index, category in enumerate(classRegistry):
+            button = QPushButton(category.name, self.ui.centralwidget)
+            button.setStyleSheet(category.styleSheet())
+            button.clicked.connect(partial(self.setColorCode, category.id))
+            if category.shortcut:
+                button.setToolTip('%s (%s)' % (category.name, category.shortcut))
+                QtWidgets.QShortcut(QtGui.QKeySequence(category.shortcut), self.mView,
+                                    activated=partial(self.setColorCode, category.id))
+            # between the two spacer labels of the categories column
+            self.ui.verticalLayout.insertWidget(1 + index, button)
+            self.categoryButtons[category.id] = button
 
         QtWidgets.QShortcut(QtGui.QKeySequence.ZoomIn, self.mView, self.zoomIn)
         QtWidgets.QShortcut(QtGui.QKeySequence.ZoomOut, self.mView, self.zoomOut)
@@ -358,16 +1037,79 @@ class MainWindow(QMainWindow):
                             activated=partial(self.mScene.setCurrentInstruction, Instructions.NoInstruction,
                                               self.colorNum))
 
-        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_X), self.mView, self.mScene.removePolygon)
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_X), self.mView, self.mScene.deletePolygons)
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_R), self.mView, self.mScene.acceptProposals)
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_F3), self.mView, self.mScene.toggleOverlay)
+        QtWidgets.QShortcut(QtGui.QKeySequence.Undo, self.mView, self.mScene.undoStack.undo)
+        QtWidgets.QShortcut(QtGui.QKeySequence.Redo, self.mView, self.mScene.undoStack.redo)
 
         QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_A), self.mView,
                             activated=partial(self.mScene.setCurrentInstruction, Instructions.PolygonInstruction,
                                               self.colorNum))
 
+#-----------------------------------------------------------------------------------------------------------------------
+#   Rapid mode: class keys pick the class of the polygon being drawn, Enter closes it and drawing goes on
+# -----------------------------------------------------------------------------------------------------------------------
+
+        self.rapidMode = False
+        self.rapidCount = 0
+        self.rapidStart = 0.0
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_F2), self.mView, self.toggleRapidMode)
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Return), self.mView, self.mScene.closePolygon)
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Enter), self.mView, self.mScene.closePolygon)
+        self.mScene.polygonCommitted.connect(self.onPolygonCommitted)
+
+    def setupViewport(self):
+        # items repaint their own bounding rect, the polygon layer is antialiased when it is rasterized
+        self.mView.setViewportUpdateMode(QtWidgets.QGraphicsView.MinimalViewportUpdate)
+        self.mView.setOptimizationFlag(QtWidgets.QGraphicsView.DontAdjustForAntialiasing, True)
+        # $PARCEL_OPENGL=1 paints through OpenGL, Mesa's llvmpipe does in software what a GPU would do
+        if os.environ.get('PARCEL_OPENGL') == '1':
+            try:
+                from PySide2.QtWidgets import QOpenGLWidget
+            except ImportError as error:
+                log.warning('OpenGL viewport unavailable: %s', error)
+            else:
+                self.mView.setViewport(QOpenGLWidget())
+                # a GL viewport is redrawn as a whole anyway, partial updates only add bookkeeping
+                self.mView.setViewportUpdateMode(QtWidgets.QGraphicsView.FullViewportUpdate)
+        QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_F5), self.mView, self.mScene.toggleLayerMode)
+
     def setColorCode(self, code):
+        if self.mScene.changeSelectedClass(code):
+            return
         self.colorNum = code
         # print(self.colorNum)
-        self.mScene.setCurrentInstruction(Instructions.PolygonInstruction, self.colorNum)
+        if self.rapidMode:
+            self.mScene.setDrawClass(self.colorNum)
+            self.showRapidStatus()
+        else:
+            self.mScene.setCurrentInstruction(Instructions.PolygonInstruction, self.colorNum)
+
+    @QtCore.Slot()
+    def toggleRapidMode(self):
+        self.rapidMode = not self.rapidMode
+        if self.rapidMode:
+            self.rapidCount = 0
+            self.rapidStart = time.perf_counter()
+            self.mScene.setDrawClass(self.colorNum)
+            self.showRapidStatus()
+        else:
+            self.mScene.setCurrentInstruction(Instructions.NoInstruction, self.colorNum)
+            self.ui.statusbar.clearMessage()
+
+    @QtCore.Slot(int)
+    def onPolygonCommitted(self, classId):
+        self.rapidCount += 1
+        if self.rapidMode:
+            self.showRapidStatus()
+
+    def showRapidStatus(self):
+        category = classRegistry.get(self.colorNum)
+        hours = (time.perf_counter() - self.rapidStart) / 3600.0
+        self.ui.statusbar.showMessage('Rapid mode: %s  -  %d parcels, %.0f per hour' % (
+            category.name if category is not None else '-', self.rapidCount,
+            self.rapidCount / hours if hours > 0 else 0.0))
 
     # def getDirectory(self):
     #     self.directory = QtWidgets.QFileDialog.getExistingDirectory(self, "Open directory",
@@ -387,6 +1129,32 @@ class MainWindow(QMainWindow):
     #     QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Left), self.mView,
     #                         activated=partial(self.load_image, Instructions.BackItem.value))
 
+    @QtCore.Slot()
+    def saveTruth(self):
+        if self.exportProcess is not None:
+            return
+        addToImagePoly(self.mScene.colorCodeDictonary, self.mScene.imageName, self.mScene.proposalDictonary)
+        # the exporter reads the store from another process, queued writes have to be in it first
+        imagePolygon.flush()
+        # the exporter runs headless in its own process pool, the GUI stays responsive while it rasterizes
+        self.exportProcess = QtCore.QProcess(self)
+        self.exportProcess.setProcessChannelMode(QtCore.QProcess.ForwardedChannels)
+        self.exportProcess.finished.connect(self.onExportFinished)
+        self.ui.saveTruthButton.setEnabled(False)
+        self.ui.statusbar.showMessage('Exporting truth data ...')
+        self.exportProcess.start(sys.executable, [join(os.path.dirname(os.path.abspath(__file__)), 'exporter.py'),
+                                                  self.directory])
+
+    @QtCore.Slot(int, QtCore.QProcess.ExitStatus)
+    def onExportFinished(self, exitCode, exitStatus):
+        self.ui.saveTruthButton.setEnabled(True)
+        if exitStatus == QtCore.QProcess.NormalExit and exitCode == 0:
+            self.ui.statusbar.showMessage('Truth data exported to ' + join(self.directory, 'truth'))
+        else:
+            self.ui.statusbar.showMessage('Truth data export failed')
+        self.exportProcess.deleteLater()
+        self.exportProcess = None
+
     @QtCore.Slot()
     def zoomIn(self):
         self.zoom(2)
@@ -398,29 +1166,205 @@ class MainWindow(QMainWindow):
     def zoom(self, f):
         self.mView.scale(f, f)
         if self.mView.scene() is not None:
-            self.mView.centerOn(self.mView.scene().imageItem)
+            self.mView.centerOn(self.mView.scene().sceneRect().center())
 
     def showEvent(self, event: QtGui.QShowEvent):
         self.mView.fitInView(self.mScene.sceneRect(), QtCore.Qt.KeepAspectRatio)
 
+    def closeEvent(self, event: QtGui.QCloseEvent):
+        self.directoryIndex.stop()
+        self.imagePrefetcher.shutdown()
+        self.thumbnailDelegate.shutdown()
+        self.mScene.tiledItem.shutdown()
+        if self.preannotator is not None:
+            self.preannotator.shutdown()
+        self.propagator.shutdown()
+        addToImagePoly(self.mScene.colorCodeDictonary, self.mScene.imageName, self.mScene.proposalDictonary)
+        imagePolygon.close()
+        if imageArchive is not None:
+            imageArchive.close()
+        closeSources()
+        if self.tracePath:
+            profiler.dumpTrace(self.tracePath)
+            log.info('trace written to %s', self.tracePath)
+        super(MainWindow, self).closeEvent(event)
+
+
+    @QtCore.Slot(QtCore.QModelIndex, int, int)
+    def onImagesIndexed(self, parent, first, last):
+        annotationIndex.insertImages(first, self.filenames[first:last + 1])
+        # show the first frame as soon as the scanner finds it, the rest of the directory keeps streaming in
+        if not self.mScene.imageName:
+            self.load_image(Instructions.BackItem)
+            return
+        # the rows are inserted in name order, the current image may move down
+        if first <= self.counterImages:
+            self.counterImages += last - first + 1
+        else:
+            self.imagePrefetcher.prefetch(self.realpathImages, self.counterImages)
+            if self.preannotator is not None:
+                self.preannotator.prefetch(self.realpathImages, self.counterImages)
+
+    @QtCore.Slot(str)
+    def onPreannotationReady(self, filename):
+        if filename == self.mScene.imageName:
+            self.applyPreannotations(filename)
+
+    def applyPreannotations(self, filename):
+        # proposals are added once per image, on an image that has no annotations yet
+        if self.preannotator is None or imagePolygon.isPreannotated(filename):
+            return
+        polygons = self.preannotator.result(filename)
+        if polygons is None:
+            self.preannotator.schedule(filename)
+            return
+        if not self.mScene.colorCodeDictonary and not self.mScene.proposalDictonary:
+            self.mScene.addProposals(polygons)
+            addToImagePoly(self.mScene.colorCodeDictonary, filename, self.mScene.proposalDictonary)
+            self.ui.statusbar.showMessage('%d unreviewed proposals, R accepts them' % len(polygons))
+        imagePolygon.setPreannotated(filename, self.preannotator.modelName())
+
+    @QtCore.Slot(str)
+    def onPropagationReady(self, filename):
+        if filename != self.mScene.imageName:
+            return
+        polygons = self.propagator.result(filename)
+        # only onto a frame nobody has touched, the operator may have started on it in the meantime
+        if polygons and not self.mScene.colorCodeDictonary and not self.mScene.proposalDictonary:
+            self.mScene.addProposals(polygons)
+            addToImagePoly(self.mScene.colorCodeDictonary, filename, self.mScene.proposalDictonary)
+            imagePolygon.setPreannotated(filename, self.propagator.modelName)
+            self.ui.statusbar.showMessage('%d polygons carried forward, R accepts them' % len(polygons))
+
+    def countsFor(self, filename):
+        return annotationIndex.classCounts(imagePolygon.key(filename))
+
+    # #-------------------------------------------------------------------------------------------------------------------
+    # #   Filter: restricts the image list and next/back to the images matching an annotation query
+    # # -----------------------------------------------------------------------------------------------------------------
+
+    @QtCore.Slot()
+    def applyFilter(self):
+        self.filterTimer.stop()
+        text = self.filterEdit.text().strip()
+        if not text:
+            self.filterRows = None
+            self.filterVersion = None
+            self.listModel.setRows(None)
+        else:
+            try:
+                with profiler.timer('filter.query'):
+                    rows = annotationIndex.query(text)
+            except ValueError as error:
+                self.ui.statusbar.showMessage('Filter: %s' % error)
+                return
+            self.filterRows = rows
+            self.filterVersion = annotationIndex.version
+            self.listModel.setRows(rows)
+            self.ui.statusbar.showMessage('%d of %d images match' % (len(rows), len(annotationIndex)))
+        self.ui.imageName.setCurrentIndex(self.listModel.mapFromSource(
+            self.directoryIndex.model.index(self.counterImages)))
+
+    def refreshFilter(self):
+        # commits and new frames since the last query are picked up on the next step
+        if self.filterRows is not None and self.filterVersion != annotationIndex.version:
+            self.applyFilter()
+
+    def neighbour(self, index, step):
+        # the next image in the navigation direction that the filter lets through, None past the end
+        if self.filterRows is None:
+            index += step
+            return index if 0 <= index < len(self.realpathImages) else None
+        position = int(np.searchsorted(self.filterRows, index, side='right' if step > 0 else 'left'))
+        position = position if step > 0 else position - 1
+        return int(self.filterRows[position]) if 0 <= position < len(self.filterRows) else None
+
+    @QtCore.Slot(str, str)
+    def onRemoteConflict(self, key, reason):
+        self.ui.statusbar.showMessage('The server refused the changes to %s: %s' % (key, reason))
+        self.showConflicts()
+
+    def showConflicts(self):
+        conflicts = self.remoteStore.conflicts()
+        self.conflictLabel.setVisible(bool(conflicts))
+        self.conflictLabel.setText('%d refused changes' % len(conflicts))
+        self.conflictLabel.setToolTip('Kept in the conflicts table of %s:\n%s' % (
+            AnnotationStore.fileName, '\n'.join('%s: %s' % conflict for conflict in conflicts[-20:])))
+
+    def leaseImage(self, index, step):
+        # the first image from index on in the navigation direction that no other annotator holds
+        while index is not None and 0 <= index < len(self.realpathImages):
+            filename = self.realpathImages[index]
+            if filename == self.mScene.imageName:
+                return index
+            granted, holder = self.remoteStore.lease(filename)
+            if granted:
+                return index
+            log.info('%s is leased by %s', filename, holder)
+            index = self.neighbour(index, step)
+        return None
 
     @QtCore.Slot()
     def load_image(self, imageNavigation):
+        if not self.realpathImages:
+            return
+        self.refreshFilter()
+        index = None
+        if imageNavigation == 1 or imageNavigation == 0:
+            index = self.neighbour(self.counterImages, -1 if imageNavigation == 0 else 1)
+        if index is None:
+            # past either end it starts over at the first image
+            index = self.neighbour(-1, 1)
+        if index is None:
+            self.ui.statusbar.showMessage('No image matches the filter')
+            return
+        self.showImage(index, -1 if imageNavigation == 0 else 1)
+
+    @QtCore.Slot(QtCore.QModelIndex)
+    def onImageClicked(self, index):
+        row = self.listModel.mapToSource(index).row()
+        if index.isValid() and row != self.counterImages:
+            self.showImage(row)
+
+    def showImage(self, index, step=1):
+        if self.remoteStore is not None:
+            index = self.leaseImage(index, step)
+            if index is None:
+                self.ui.statusbar.showMessage('All further images are being annotated by others')
+                return
+        self.counterImages = index
+        previousName = self.mScene.imageName
+        carried = None
+        # only a frame that follows the previous one inherits its polygons, neighbouring rows need not be
+        if previousName and isNextFrame(previousName, self.realpathImages[index]) and self.mScene.colorCodeDictonary:
+            carried = copyPolygons(self.mScene.colorCodeDictonary)
         self.mScene.removePolygon()
-        if imageNavigation == 1 and self.counterImages < self.realpathImages.__len__() - 1:
-            self.counterImages = self.counterImages + 1
-        elif imageNavigation == 0 and self.counterImages > 0:
-            self.counterImages = self.counterImages - 1
-        else:
-            self.counterImages = 0
+        if self.remoteStore is not None and previousName != self.realpathImages[self.counterImages]:
+            self.remoteStore.release(previousName)
+        self.ui.imageName.setCurrentIndex(self.listModel.mapFromSource(
+            self.directoryIndex.model.index(self.counterImages)))
 
         if self.realpathImages[self.counterImages]:
-            self.mScene.load_image(self.realpathImages[self.counterImages])
-            self.mView.fitInView(self.mScene.imageItem, QtCore.Qt.KeepAspectRatio)
-            self.mView.centerOn(self.mScene.imageItem)
+            filename = self.realpathImages[self.counterImages]
+            with profiler.timer('load_image'):
+                with profiler.timer('load_image.decode'):
+                    image = self.imagePrefetcher.image(filename)
+                self.mScene.load_image(filename, image)
+                self.imagePrefetcher.prefetch(self.realpathImages, self.counterImages)
+                if carried and not imagePolygon.isPreannotated(filename) and not self.mScene.colorCodeDictonary:
+                    self.propagator.schedule(previousName, filename, carried)
+                if self.preannotator is not None:
+                    self.applyPreannotations(filename)
+                    self.preannotator.prefetch(self.realpathImages, self.counterImages)
+                with profiler.timer('load_image.fitInView'):
+                    self.mView.fitInView(self.mScene.sceneRect(), QtCore.Qt.KeepAspectRatio)
+                    self.mView.centerOn(self.mScene.sceneRect().center())
+            if self.rapidMode:
+                self.mScene.setDrawClass(self.colorNum)
 
 
 if __name__ == '__main__':
+    configureLogging()
     app = QtWidgets.QApplication(sys.argv)
     w = MainWindow()
     w.show()
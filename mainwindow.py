@@ -87,7 +87,7 @@ class Ui_MainWindow(object):
 
         self.gridLayout.addWidget(self.label_5, 2, 0, 1, 1)
 
-        self.imageName = QListWidget(self.centralwidget)
+        self.imageName = QListView(self.centralwidget)
         self.imageName.setObjectName(u"imageName")
         sizePolicy2.setHeightForWidth(self.imageName.sizePolicy().hasHeightForWidth())
         self.imageName.setSizePolicy(sizePolicy2)
@@ -140,42 +140,6 @@ class Ui_MainWindow(object):
 
         self.verticalLayout.addWidget(self.label)
 
-        self.armButton = QPushButton(self.centralwidget)
-        self.armButton.setObjectName(u"armButton")
-
-        self.verticalLayout.addWidget(self.armButton)
-
-        self.unknownButton = QPushButton(self.centralwidget)
-        self.unknownButton.setObjectName(u"unknownButton")
-        self.unknownButton.setFlat(False)
-
-        self.verticalLayout.addWidget(self.unknownButton)
-
-        self.restButton = QPushButton(self.centralwidget)
-        self.restButton.setObjectName(u"restButton")
-
-        self.verticalLayout.addWidget(self.restButton)
-
-        self.flatButton = QPushButton(self.centralwidget)
-        self.flatButton.setObjectName(u"flatButton")
-
-        self.verticalLayout.addWidget(self.flatButton)
-
-        self.pouchButton = QPushButton(self.centralwidget)
-        self.pouchButton.setObjectName(u"pouchButton")
-
-        self.verticalLayout.addWidget(self.pouchButton)
-
-        self.bagButton = QPushButton(self.centralwidget)
-        self.bagButton.setObjectName(u"bagButton")
-
-        self.verticalLayout.addWidget(self.bagButton)
-
-        self.boxButton = QPushButton(self.centralwidget)
-        self.boxButton.setObjectName(u"boxButton")
-
-        self.verticalLayout.addWidget(self.boxButton)
-
         self.label_2 = QLabel(self.centralwidget)
         self.label_2.setObjectName(u"label_2")
         sizePolicy5.setHeightForWidth(self.label_2.sizePolicy().hasHeightForWidth())
@@ -222,8 +186,6 @@ class Ui_MainWindow(object):
 
         self.retranslateUi(MainWindow)
 
-        self.unknownButton.setDefault(False)
-
 
         QMetaObject.connectSlotsByName(MainWindow)
     # setupUi
@@ -242,13 +204,6 @@ class Ui_MainWindow(object):
         self.directoryName.setText(QCoreApplication.translate("MainWindow", u"<<Directory Name>>", None))
         self.info.setText(QCoreApplication.translate("MainWindow", u"Categories", None))
         self.label.setText("")
-        self.armButton.setText(QCoreApplication.translate("MainWindow", u"Arm", None))
-        self.unknownButton.setText(QCoreApplication.translate("MainWindow", u"Unkown", None))
-        self.restButton.setText(QCoreApplication.translate("MainWindow", u"Rest (Trash)", None))
-        self.flatButton.setText(QCoreApplication.translate("MainWindow", u"Flat", None))
-        self.pouchButton.setText(QCoreApplication.translate("MainWindow", u"Pouch", None))
-        self.bagButton.setText(QCoreApplication.translate("MainWindow", u"Bag", None))
-        self.boxButton.setText(QCoreApplication.translate("MainWindow", u"Box", None))
         self.label_2.setText("")
         self.imageName_2.setText(QCoreApplication.translate("MainWindow", u"<<Image Name>>", None))
         self.amountParcels.setText(QCoreApplication.translate("MainWindow", u"<<Amount Parcels>>", None))
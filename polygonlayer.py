@@ -0,0 +1,125 @@
+import math
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from instrumentation import profiler
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   PolygonLayerItem, the committed polygons of an image rasterized into one pixmap
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class PolygonLayerItem(QtWidgets.QGraphicsItem):
+    # pans and repaints only blit the pixmap; added polygons are painted into it, it is rasterized again
+    # when a polygon in it changes or leaves it, when the zoom crosses a power of two, when the vertex
+    # handles appear or disappear at handleScale and when a pan leaves the region it covers: images too
+    # large for maxPixels at the view scale are rasterized around the visible part only, at full resolution;
+    # polygons being edited are left out and painted live
+    maxPixels = 4096 * 4096
+
+    def __init__(self, handleScale, parent=None):
+        super(PolygonLayerItem, self).__init__(parent)
+        self.handleScale = handleScale
+        self.handles = False
+        # the PolygonAnnotation items in the layer, in painting order
+        self.items = {}
+        self.rect = QtCore.QRectF()
+        self.pixmap = None
+        self.level = None
+        # the part of rect the pixmap covers
+        self.region = QtCore.QRectF()
+        # between the image and the polygon items, never hit by the mouse
+        self.setZValue(9)
+        self.setAcceptedMouseButtons(QtCore.Qt.NoButton)
+
+    def setRect(self, rect):
+        self.prepareGeometryChange()
+        self.rect = QtCore.QRectF(rect)
+        self.invalidate()
+
+    def boundingRect(self):
+        return self.rect
+
+    def invalidate(self):
+        self.pixmap = None
+        self.update()
+
+    def clear(self):
+        self.items = {}
+        self.invalidate()
+
+    def addPolygons(self, items):
+        self.items.update(dict.fromkeys(items))
+        if self.pixmap is None:
+            self.update()
+            return
+        painter = QtGui.QPainter(self.pixmap)
+        self.drawPolygons(painter, items)
+        painter.end()
+        exposed = QtCore.QRectF()
+        for item in items:
+            exposed = exposed.united(item.sceneBoundingRect())
+        self.update(exposed)
+
+    def removePolygon(self, item):
+        if self.items.pop(item, False) is None:
+            self.invalidate()
+
+    def levelForScale(self, scale):
+        # pixmap pixels per scene unit: the next power of two at or above the view scale, never upscaled
+        return 2.0 ** math.ceil(math.log2(scale)) if scale > 0 else 1.0
+
+    def regionFor(self, visible, level):
+        # the whole image while it fits into maxPixels at this level, otherwise the visible part with as much
+        # margin around it as fits (up to half a view on every side), so pans do not rasterize every frame
+        if self.rect.width() * self.rect.height() * level * level <= self.maxPixels:
+            return QtCore.QRectF(self.rect)
+        area = visible.width() * visible.height() * level * level
+        margin = min(0.5, max(0.0, (math.sqrt(self.maxPixels / area) - 1.0) / 2.0)) if area > 0 else 0.0
+        region = visible.adjusted(-margin * visible.width(), -margin * visible.height(),
+                                  margin * visible.width(), margin * visible.height()).intersected(self.rect)
+        # on the pixel grid of the level, the pixmap maps onto whole pixels
+        left, top = math.floor(region.left() * level) / level, math.floor(region.top() * level) / level
+        right, bottom = math.ceil(region.right() * level) / level, math.ceil(region.bottom() * level) / level
+        return QtCore.QRectF(left, top, right - left, bottom - top)
+
+    def paint(self, painter, option, widget=None):
+        if self.rect.isEmpty() or not self.items:
+            return
+        scale = QtWidgets.QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.levelForScale(scale)
+        handles = scale >= self.handleScale
+        visible = QtCore.QRectF(self.rect)
+        if widget is not None:
+            inverted, invertible = painter.worldTransform().inverted()
+            if invertible:
+                visible = inverted.mapRect(QtCore.QRectF(widget.rect())).intersected(self.rect)
+        if visible.isEmpty():
+            return
+        if (self.pixmap is None or level != self.level or handles != self.handles
+                or not self.region.contains(visible)):
+            self.handles = handles
+            self.rasterize(level, self.regionFor(visible, level))
+        painter.drawPixmap(self.region, self.pixmap, QtCore.QRectF(self.pixmap.rect()))
+
+    def rasterize(self, level, region):
+        with profiler.timer('polygonLayer.rasterize'):
+            image = QtGui.QImage(max(1, int(round(region.width() * level))),
+                                 max(1, int(round(region.height() * level))),
+                                 QtGui.QImage.Format_ARGB32_Premultiplied)
+            image.fill(QtCore.Qt.transparent)
+            self.level = level
+            self.region = region
+            painter = QtGui.QPainter(image)
+            self.drawPolygons(painter, self.items)
+            painter.end()
+            self.pixmap = QtGui.QPixmap.fromImage(image)
+        profiler.count('polygonLayer.rasterize')
+
+    def drawPolygons(self, painter, items):
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        base = QtGui.QTransform.fromScale(self.level, self.level)
+        base.translate(-self.region.left(), -self.region.top())
+        for item in items:
+            painter.setTransform(item.sceneTransform() * base)
+            item.paintLayer(painter, self.level, self.handles)
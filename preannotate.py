@@ -0,0 +1,306 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from PySide2 import QtCore, QtGui
+
+from framesource import readImage, imageSize, splitFrame
+from geometry import polygonArea, simplifyPolygon
+
+log = logging.getLogger('preannotate')
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Inference backends, predict() maps an (h, w, 3) uint8 RGB array to an (h, w) class id map, -1 is background
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class InferenceBackend(object):
+    name = 'base'
+    # longest image side fed to the model, images are decoded directly at that size
+    inputSize = 512
+
+    def __init__(self, model=None):
+        self.model = model
+
+    def key(self):
+        # part of the cache key, a different model never reuses cached polygons
+        if not self.model:
+            return self.name
+        stat = os.stat(self.model)
+        return '%s-%s-%d' % (self.name, os.path.splitext(os.path.basename(self.model))[0], int(stat.st_mtime))
+
+    def predict(self, rgb):
+        raise NotImplementedError
+
+
+class StubBackend(InferenceBackend):
+    # deterministic stand-in without a model: dark regions become parcels of class 0
+    name = 'stub'
+    threshold = 64
+    classId = 0
+
+    def predict(self, rgb):
+        labels = np.full(rgb.shape[:2], -1, dtype=np.int32)
+        labels[rgb.mean(axis=2) < self.threshold] = self.classId
+        return labels
+
+
+class OnnxBackend(InferenceBackend):
+    # semantic segmentation model with a (1, 3, h, w) float input in [0, 1] and (1, classes + 1, h, w) logits,
+    # channel 0 is background and channel k is class id k - 1
+    name = 'onnx'
+
+    def __init__(self, model):
+        super(OnnxBackend, self).__init__(model)
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        # the process pool already uses every core, one thread per session avoids oversubscription
+        options.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(model, options, providers=['CPUExecutionProvider'])
+        self.inputName = self.session.get_inputs()[0].name
+
+    def predict(self, rgb):
+        tensor = np.ascontiguousarray(rgb.transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+        logits = self.session.run(None, {self.inputName: tensor})[0][0]
+        return logits.argmax(axis=0).astype(np.int32) - 1
+
+
+backends = {StubBackend.name: StubBackend, OnnxBackend.name: OnnxBackend}
+
+
+def parseBackend(spec):
+    # "stub" or "onnx:/path/to/model.onnx", as given in $PARCEL_PREANNOTATE
+    name, _, model = spec.partition(':')
+    if name not in backends:
+        raise ValueError('unknown inference backend %r' % name)
+    return name, model or None
+
+
+_loadedBackends = {}
+
+
+def createBackend(name, model=None):
+    # one instance per worker process, so the model is only loaded once
+    backend = _loadedBackends.get((name, model))
+    if backend is None:
+        backend = backends[name](model) if model else backends[name]()
+        _loadedBackends[(name, model)] = backend
+    return backend
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Masks to polygons
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def labelComponents(mask):
+    # 4-connected components from horizontal runs, runs of adjacent rows that overlap are merged
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    steps = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(steps == 1)
+    ends = np.nonzero(steps == -1)[1]
+    parent = list(range(len(rows)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rowStart = np.searchsorted(rows, np.arange(height + 1))
+    for y in range(1, height):
+        i, iEnd = rowStart[y - 1], rowStart[y]
+        j, jEnd = rowStart[y], rowStart[y + 1]
+        while i < iEnd and j < jEnd:
+            if starts[i] < ends[j] and starts[j] < ends[i]:
+                a, b = find(i), find(j)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+            if ends[i] < ends[j]:
+                i += 1
+            else:
+                j += 1
+    components = {}
+    for run in range(len(rows)):
+        components.setdefault(find(run), []).append(run)
+    return rows, starts, ends, list(components.values())
+
+
+# clockwise with y pointing down: W, NW, N, NE, E, SE, S, SW
+_directions = ((0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1))
+
+
+def traceBoundary(mask, start):
+    # Moore neighbour tracing of the outer boundary, mask has a background border and start is the
+    # topmost, leftmost pixel of the component; returns (x, y) pixel positions
+    y, x = start
+    boundary = [(x, y)]
+    search = 0
+    firstDirection = None
+    for _ in range(4 * mask.size):
+        for i in range(8):
+            direction = (search + i) % 8
+            dy, dx = _directions[direction]
+            if mask[y + dy, x + dx]:
+                break
+        else:
+            return boundary
+        if (y, x) == start and direction == firstDirection:
+            break
+        if firstDirection is None:
+            firstDirection = direction
+        y, x = y + dy, x + dx
+        boundary.append((x, y))
+        # continue from the background pixel checked just before the one that was found
+        search = (direction + 6) % 8 if direction % 2 == 0 else (direction + 5) % 8
+    return boundary[:-1]
+
+
+def maskToPolygons(labels, tolerance=1.0, minArea=16.0):
+    # outer outlines of every connected region per class, holes are filled
+    polygons = []
+    for classId in np.unique(labels[labels >= 0]):
+        rows, starts, ends, components = labelComponents(labels == classId)
+        for runs in components:
+            runs = np.array(runs)
+            top, bottom = rows[runs].min(), rows[runs].max() + 1
+            left, right = starts[runs].min(), ends[runs].max()
+            region = np.zeros((bottom - top + 2, right - left + 2), dtype=bool)
+            for run in runs:
+                region[rows[run] - top + 1, starts[run] - left + 1:ends[run] - left + 1] = True
+            first = runs[np.lexsort((starts[runs], rows[runs]))[0]]
+            boundary = traceBoundary(region, (rows[first] - top + 1, starts[first] - left + 1))
+            if len(boundary) < 3:
+                continue
+            # pixel centers in label map coordinates
+            xy = np.array(boundary, dtype=np.float64) + (left - 0.5, top - 0.5)
+            xy = simplifyPolygon(xy, tolerance)
+            if len(xy) >= 3 and polygonArea(xy) >= minArea:
+                polygons.append((int(classId), xy))
+    return polygons
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Worker, one image per call, results are cached under the image content hash
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def imageHash(filename):
+    source, index = splitFrame(filename)
+    if index is not None:
+        # hashing a whole video per frame is out of the question, frames are identified by container and index
+        stat = os.stat(source)
+        return hashlib.sha1(('%s:%d:%d:%d' % (os.path.realpath(source), stat.st_mtime_ns, stat.st_size,
+                                              index)).encode()).hexdigest()
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def imageToArray(image):
+    image = image.convertToFormat(QtGui.QImage.Format_RGB888)
+    width, height, stride = image.width(), image.height(), image.bytesPerLine()
+    buffer = np.frombuffer(image.constBits(), dtype=np.uint8, count=stride * height)
+    return buffer.reshape(height, stride)[:, :width * 3].reshape(height, width, 3).copy()
+
+
+def preannotateImage(filename, backendName, model, cacheDirectory, tolerance=1.0, minArea=16.0):
+    # returns (filename, [(classId, [x0, y0, x1, y1, ...]), ...]) in image coordinates
+    backend = createBackend(backendName, model)
+    cachePath = os.path.join(cacheDirectory, '%s-%s.json' % (imageHash(filename), backend.key()))
+    if os.path.exists(cachePath):
+        with open(cachePath) as f:
+            return filename, [(classId, points) for classId, points in json.load(f)]
+    size = imageSize(filename)
+    scale = min(1.0, backend.inputSize / float(max(size.width(), size.height(), 1)))
+    scaledSize = None
+    if scale < 1.0:
+        scaledSize = QtCore.QSize(max(1, round(size.width() * scale)), max(1, round(size.height() * scale)))
+    image = readImage(filename, scaledSize)
+    polygons = []
+    if not image.isNull():
+        labels = backend.predict(imageToArray(image))
+        factor = (size.width() / float(labels.shape[1]), size.height() / float(labels.shape[0]))
+        # simplification and the area limit apply in image pixels
+        for classId, xy in maskToPolygons(labels, tolerance / max(factor), minArea / (factor[0] * factor[1])):
+            polygons.append((classId, [round(float(v), 2) for v in (xy * factor).ravel()]))
+    os.makedirs(cacheDirectory, exist_ok=True)
+    temporary = cachePath + '.%d.tmp' % os.getpid()
+    with open(temporary, 'w') as f:
+        json.dump(polygons, f)
+    os.replace(temporary, cachePath)
+    return filename, polygons
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Preannotator, schedules the image queue on a process pool from the GUI
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class Preannotator(QtCore.QObject):
+    ready = QtCore.Signal(str)
+    finished = QtCore.Signal(str, object)
+    cacheDirectoryName = '.preannotations'
+
+    def __init__(self, spec, directory, window=3, workers=None, parent=None):
+        super(Preannotator, self).__init__(parent)
+        self.backendName, self.model = parseBackend(spec)
+        self.cacheDirectory = os.path.join(directory, self.cacheDirectoryName)
+        self.window = window
+        self.results = {}
+        self.pending = set()
+        self.finished.connect(self.onFinished)
+        # spawned workers, forking a process that runs a Qt GUI is not safe
+        self.executor = ProcessPoolExecutor(max_workers=workers or max(1, (os.cpu_count() or 2) - 1),
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    @classmethod
+    def fromEnvironment(cls, directory, parent=None):
+        spec = os.environ.get('PARCEL_PREANNOTATE')
+        return cls(spec, directory, parent=parent) if spec else None
+
+    def modelName(self):
+        return self.backendName + (':' + os.path.basename(self.model) if self.model else '')
+
+    def result(self, filename):
+        return self.results.get(filename)
+
+    def schedule(self, filename):
+        if filename in self.results or filename in self.pending or self.executor is None:
+            return
+        self.pending.add(filename)
+        future = self.executor.submit(preannotateImage, filename, self.backendName, self.model, self.cacheDirectory)
+        # the callback runs on the executor's thread, the queued signal hands the result to the GUI thread
+        future.add_done_callback(partial(self.onDone, filename))
+
+    def prefetch(self, filenames, index):
+        for i in range(index, min(index + self.window + 1, len(filenames))):
+            self.schedule(filenames[i])
+
+    def onDone(self, filename, future):
+        try:
+            polygons = None if future.cancelled() else future.result()[1]
+        except Exception as error:
+            log.warning('pre-annotation of %s failed: %s', filename, error)
+            polygons = None
+        self.finished.emit(filename, polygons)
+
+    @QtCore.Slot(str, object)
+    def onFinished(self, filename, polygons):
+        self.pending.discard(filename)
+        if polygons is None:
+            return
+        self.results[filename] = polygons
+        self.ready.emit(filename)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
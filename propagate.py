@@ -0,0 +1,153 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PySide2 import QtCore, QtGui
+
+from framesource import readImage, imageSize
+
+log = logging.getLogger('propagate')
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Block matching on downscaled grayscale frames
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def grayscale(filename, workSize):
+    # (array, factor): the frame decoded at workSize on its longest side, factor maps back to image pixels
+    size = imageSize(filename)
+    scale = min(1.0, workSize / float(max(size.width(), size.height(), 1)))
+    scaledSize = None
+    if scale < 1.0:
+        scaledSize = QtCore.QSize(max(1, round(size.width() * scale)), max(1, round(size.height() * scale)))
+    image = readImage(filename, scaledSize)
+    if image.isNull():
+        return None, 1.0
+    image = image.convertToFormat(QtGui.QImage.Format_Grayscale8)
+    width, height, stride = image.width(), image.height(), image.bytesPerLine()
+    buffer = np.frombuffer(image.constBits(), dtype=np.uint8, count=stride * height)
+    return buffer.reshape(height, stride)[:, :width].astype(np.float32), size.width() / float(width)
+
+
+def matchBlock(previous, current, box, radius, maxPixels=4096):
+    # (dx, dy, confident) moving the block box = (x0, y0, x1, y1) of previous to its best match in current;
+    # zero mean absolute differences for every offset in [-radius, radius] at once, refined to sub-pixel
+    x0, y0, x1, y1 = box
+    block = previous[y0:y1, x0:x1]
+    # large blocks are compared on a regular subset of their pixels
+    step = max(1, int(np.ceil(np.sqrt(block.size / float(maxPixels)))))
+    padded = np.pad(current, radius, mode='edge')
+    window = padded[y0:y1 + 2 * radius, x0:x1 + 2 * radius]
+    candidates = sliding_window_view(window, block.shape)[:, :, ::step, ::step]
+    block = block[::step, ::step]
+    block = block - block.mean()
+    candidates = candidates - candidates.mean(axis=(2, 3), keepdims=True)
+    costs = np.abs(candidates - block).mean(axis=(2, 3))
+    row, column = np.unravel_index(np.argmin(costs), costs.shape)
+    best = costs[row, column]
+    # a flat or repetitive block has no distinct minimum
+    confident = best < 0.8 * costs.mean()
+    dx, dy = float(column - radius), float(row - radius)
+    if 0 < column < costs.shape[1] - 1:
+        dx += parabolaVertex(costs[row, column - 1], best, costs[row, column + 1])
+    if 0 < row < costs.shape[0] - 1:
+        dy += parabolaVertex(costs[row - 1, column], best, costs[row + 1, column])
+    return dx, dy, confident
+
+
+def parabolaVertex(left, center, right):
+    denominator = left - 2.0 * center + right
+    if denominator <= 0:
+        return 0.0
+    return float(np.clip(0.5 * (left - right) / denominator, -0.5, 0.5))
+
+
+def propagateFrame(previousName, filename, polygons, workSize=480, radius=12, margin=4):
+    # polygons: [(classId, float32 bytes)] of previousName; returns (filename, [(classId, [x0, y0, ...])])
+    previous, factor = grayscale(previousName, workSize)
+    current, _ = grayscale(filename, workSize)
+    if previous is None or current is None or previous.shape != current.shape:
+        return filename, []
+    height, width = previous.shape
+    shifts = []
+    for classId, data in polygons:
+        xy = np.frombuffer(data, dtype=np.float32).reshape(-1, 2)
+        if len(xy) < 3:
+            shifts.append(None)
+            continue
+        minimum = np.floor(xy.min(axis=0) / factor).astype(int) - margin
+        maximum = np.ceil(xy.max(axis=0) / factor).astype(int) + margin
+        x0, y0 = max(0, minimum[0]), max(0, minimum[1])
+        x1, y1 = min(width, maximum[0]), min(height, maximum[1])
+        if x1 - x0 < 4 or y1 - y0 < 4:
+            shifts.append((0.0, 0.0, False))
+            continue
+        shifts.append(matchBlock(previous, current, (x0, y0, x1, y1), radius))
+    # parcels ride the same belt: polygons without a reliable match move like the reliable ones
+    reliable = [shift[:2] for shift in shifts if shift is not None and shift[2]]
+    fallback = tuple(np.median(reliable, axis=0)) if reliable else (0.0, 0.0)
+    result = []
+    for (classId, data), shift in zip(polygons, shifts):
+        if shift is None:
+            continue
+        dx, dy = shift[:2] if shift[2] else fallback
+        xy = np.frombuffer(data, dtype=np.float32).reshape(-1, 2) + (dx * factor, dy * factor)
+        xy = np.clip(xy, 0, (width * factor, height * factor))
+        result.append((classId, [round(float(v), 2) for v in xy.ravel()]))
+    return filename, result
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Propagator, carries the annotations of a frame forward to the next one in a worker process
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class Propagator(QtCore.QObject):
+    ready = QtCore.Signal(str)
+    finished = QtCore.Signal(str, object)
+    modelName = 'carry-forward'
+
+    def __init__(self, parent=None):
+        super(Propagator, self).__init__(parent)
+        self.results = {}
+        self.pending = set()
+        self.finished.connect(self.onFinished)
+        # frames are propagated one after the other, a single spawned worker keeps up
+        self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+    def result(self, filename):
+        return self.results.pop(filename, None)
+
+    def schedule(self, previousName, filename, colorDict):
+        if filename in self.pending or self.executor is None:
+            return
+        polygons = [(classId, points.tobytes()) for classId in sorted(colorDict) for points in colorDict[classId]
+                    if len(points) >= 6]
+        if not polygons:
+            return
+        self.pending.add(filename)
+        future = self.executor.submit(propagateFrame, previousName, filename, polygons)
+        future.add_done_callback(partial(self.onDone, filename))
+
+    def onDone(self, filename, future):
+        try:
+            polygons = None if future.cancelled() else future.result()[1]
+        except Exception as error:
+            log.warning('propagation to %s failed: %s', filename, error)
+            polygons = None
+        self.finished.emit(filename, polygons)
+
+    @QtCore.Slot(str, object)
+    def onFinished(self, filename, polygons):
+        self.pending.discard(filename)
+        if not polygons:
+            return
+        self.results[filename] = polygons
+        self.ready.emit(filename)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
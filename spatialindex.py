@@ -0,0 +1,85 @@
+import math
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   UniformGrid
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class UniformGrid(object):
+    # buckets bounding boxes into square cells, so proximity queries only look at a handful of entries
+    def __init__(self, cellSize=32.0):
+        self.cellSize = float(cellSize)
+        self.cells = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def cellRange(self, x0, y0, x1, y1):
+        size = self.cellSize
+        return (int(math.floor(x0 / size)), int(math.floor(y0 / size)),
+                int(math.floor(x1 / size)), int(math.floor(y1 / size)))
+
+    def insert(self, key, x0, y0, x1, y1):
+        cells = self.cellRange(x0, y0, x1, y1)
+        old = self.entries.get(key)
+        if old is not None:
+            if old[1] == cells:
+                self.entries[key] = ((x0, y0, x1, y1), cells)
+                return
+            self.remove(key)
+        self.entries[key] = ((x0, y0, x1, y1), cells)
+        cx0, cy0, cx1, cy1 = cells
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        cx0, cy0, cx1, cy1 = entry[1]
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self.cells[(cx, cy)]
+
+    def clear(self):
+        self.cells.clear()
+        self.entries.clear()
+
+    def query(self, x0, y0, x1, y1):
+        found = set()
+        cx0, cy0, cx1, cy1 = self.cellRange(x0, y0, x1, y1)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket:
+                    found.update(bucket)
+        return [key for key in found if self.intersects(self.entries[key][0], x0, y0, x1, y1)]
+
+    def bounds(self, key):
+        return self.entries[key][0]
+
+    @staticmethod
+    def intersects(box, x0, y0, x1, y1):
+        return box[0] <= x1 and box[2] >= x0 and box[1] <= y1 and box[3] >= y0
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Geometry helpers
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def projectOnSegment(px, py, ax, ay, bx, by):
+    # closest point to p on the segment a-b and its squared distance
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length))
+    x, y = ax + t * dx, ay + t * dy
+    return x, y, (px - x) * (px - x) + (py - y) * (py - y)
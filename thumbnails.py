@@ -0,0 +1,131 @@
+import hashlib
+import os
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from framesource import readImage, imageSize, statPath
+from imagecache import ImageCache
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Thumbnails on disk, keyed by path + mtime + size like the tile pyramids
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def thumbnailPath(filename, size):
+    stat = statPath(filename)
+    digest = hashlib.sha1(('%s:%d:%d:%d' % (os.path.realpath(filename), stat.st_mtime_ns, stat.st_size,
+                                            size)).encode()).hexdigest()
+    cache = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.CacheLocation)
+    return os.path.join(cache or os.path.expanduser('~/.cache'), 'thumbnails', digest[:2], digest + '.jpg')
+
+
+class ThumbnailSignals(QtCore.QObject):
+    loaded = QtCore.Signal(str, QtGui.QImage)
+
+
+class ThumbnailLoader(QtCore.QRunnable):
+    def __init__(self, filename, size, signals):
+        super(ThumbnailLoader, self).__init__()
+        self.filename = filename
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        try:
+            path = thumbnailPath(self.filename, self.size)
+        except OSError:
+            self.signals.loaded.emit(self.filename, QtGui.QImage())
+            return
+        image = QtGui.QImage(path) if os.path.exists(path) else QtGui.QImage()
+        if image.isNull():
+            size = imageSize(self.filename)
+            # JPEG decodes directly at a fraction of the resolution, other formats are scaled after decoding
+            image = readImage(self.filename, size.scaled(self.size, self.size, QtCore.Qt.KeepAspectRatio)
+                              if size.isValid() else None)
+            if not image.isNull():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                image.save(path + '.tmp', 'JPG', 85)
+                os.replace(path + '.tmp', path)
+        self.signals.loaded.emit(self.filename, image)
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   ThumbnailDelegate, paints the rows of the image list as a filmstrip
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class ThumbnailDelegate(QtWidgets.QStyledItemDelegate):
+    # only rows that get painted request a thumbnail, the list view does the virtualization
+    def __init__(self, counts, classes, size=128, parent=None):
+        super(ThumbnailDelegate, self).__init__(parent)
+        self.counts = counts
+        self.classes = classes
+        self.size = size
+        self.cache = ImageCache(64 * 1024 * 1024)
+        self.pending = set()
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.onThumbnailLoaded)
+        self.font = QtGui.QFont()
+        self.font.setPointSize(7)
+
+    def sizeHint(self, option, index):
+        return QtCore.QSize(self.size + 8, self.size * 3 // 4 + 22)
+
+    def thumbnail(self, filename):
+        image = self.cache.get(filename)
+        if image is None and filename not in self.pending:
+            self.pending.add(filename)
+            self.pool.start(ThumbnailLoader(filename, self.size, self.signals))
+        return image
+
+    @QtCore.Slot(str, QtGui.QImage)
+    def onThumbnailLoaded(self, filename, image):
+        self.pending.discard(filename)
+        if image.isNull():
+            return
+        self.cache.put(filename, image)
+        view = self.parent()
+        if view is not None:
+            view.viewport().update()
+
+    def paint(self, painter, option, index):
+        filename = index.data(QtCore.Qt.ToolTipRole)
+        rect = option.rect.adjusted(4, 2, -4, -2)
+        view = self.parent()
+        selected = view is not None and view.selectionModel().isSelected(index)
+        painter.save()
+        if selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        imageRect = QtCore.QRect(rect.left(), rect.top(), rect.width(), rect.height() - 14)
+        image = self.thumbnail(filename)
+        if image is None:
+            painter.fillRect(imageRect, QtGui.QColor(60, 60, 60))
+        else:
+            size = image.size().scaled(imageRect.size(), QtCore.Qt.KeepAspectRatio)
+            target = QtCore.QRect(QtCore.QPoint(0, 0), size)
+            target.moveCenter(imageRect.center())
+            painter.drawImage(target, image)
+        # per class polygon counts as colored badges in the top left corner
+        painter.setFont(self.font)
+        metrics = painter.fontMetrics()
+        x = imageRect.left() + 2
+        for classId, count in sorted(self.counts(filename).items()):
+            category = self.classes.get(classId)
+            if category is None or not count:
+                continue
+            text = str(count)
+            badge = QtCore.QRect(x, imageRect.top() + 2, metrics.horizontalAdvance(text) + 6, metrics.height())
+            painter.fillRect(badge, QtGui.QColor(*category.color[:3]))
+            painter.setPen(QtGui.QColor('white'))
+            painter.drawText(badge, QtCore.Qt.AlignCenter, text)
+            x = badge.right() + 2
+        painter.setPen(option.palette.color(QtGui.QPalette.HighlightedText if selected else QtGui.QPalette.Text))
+        painter.drawText(QtCore.QRect(rect.left(), imageRect.bottom() + 1, rect.width(), 13),
+                         QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                         metrics.elidedText(index.data(QtCore.Qt.DisplayRole), QtCore.Qt.ElideMiddle, rect.width()))
+        painter.restore()
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -0,0 +1,286 @@
+import hashlib
+import math
+import os
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from imagecache import ImageCache
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Pyramid on disk
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def pyramidDirectory(filename):
+    stat = os.stat(filename)
+    digest = hashlib.sha1(('%s:%d:%d' % (os.path.realpath(filename), stat.st_mtime_ns, stat.st_size)).encode()).hexdigest()
+    cache = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.CacheLocation)
+    return os.path.join(cache or os.path.expanduser('~/.cache'), 'pyramids', digest)
+
+
+def levelSizes(width, height, tileSize):
+    # finest level first, each level halves the previous one with the rounding PyramidBuilder uses
+    sizes = [QtCore.QSize(width, height)]
+    while max(sizes[-1].width(), sizes[-1].height()) > tileSize:
+        sizes.append(QtCore.QSize(max(1, sizes[-1].width() // 2), max(1, sizes[-1].height() // 2)))
+    return sizes
+
+
+def levelCount(width, height, tileSize):
+    return len(levelSizes(width, height, tileSize))
+
+
+def tilePath(directory, level, tx, ty):
+    return os.path.join(directory, str(level), '%d_%d.png' % (tx, ty))
+
+
+class PyramidSignals(QtCore.QObject):
+    levelReady = QtCore.Signal(str, int)
+    pyramidDone = QtCore.Signal(str)
+    tileLoaded = QtCore.Signal(str, object, QtGui.QImage)
+
+
+class PyramidBuilder(QtCore.QRunnable):
+    # the only place the full resolution image is ever decoded. Readers that can clip (JPEG) decode the
+    # largest level that fits into stripPixels once, halve it down to the coarser levels and write the levels
+    # coarsest first, so an overview can be shown long before the finest level is on disk; only the levels
+    # above stripPixels are decoded in strips. Other formats are decoded once and written finest first,
+    # halving the level just written, so at most two levels are in memory
+    stripPixels = 64 * 1024 * 1024
+
+    def __init__(self, filename, directory, tileSize, signals):
+        super(PyramidBuilder, self).__init__()
+        self.filename = filename
+        self.directory = directory
+        self.tileSize = tileSize
+        self.signals = signals
+        self.cancelled = False
+
+    def cancel(self):
+        # checked between tiles, a cancelled level is never marked done
+        self.cancelled = True
+
+    def run(self):
+        try:
+            reader = QtGui.QImageReader(self.filename)
+            size = reader.size()
+            if size.isEmpty():
+                return
+            sizes = levelSizes(size.width(), size.height(), self.tileSize)
+            if reader.supportsOption(QtGui.QImageIOHandler.ScaledClipRect):
+                self.buildFromStrips(sizes)
+            else:
+                self.buildFromImage(sizes)
+        finally:
+            self.signals.pyramidDone.emit(self.filename)
+
+    def buildFromStrips(self, sizes):
+        # the coarsest level is a single tile, so some level always fits
+        first = next(level for level, levelSize in enumerate(sizes)
+                     if levelSize.width() * levelSize.height() <= self.stripPixels)
+        reader = QtGui.QImageReader(self.filename)
+        reader.setScaledSize(sizes[first])
+        images = [reader.read()]
+        if images[0].isNull():
+            return
+        for levelSize in sizes[first + 1:]:
+            images.append(images[-1].scaled(levelSize, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation))
+        for level in range(len(sizes) - 1, first - 1, -1):
+            if self.cancelled:
+                return
+            self.writeTiles(level, images.pop(), 0)
+            self.finishLevel(level)
+        for level in range(first - 1, -1, -1):
+            levelSize = sizes[level]
+            # whole rows of tiles, as many as fit into stripPixels
+            stripHeight = max(1, self.stripPixels // (levelSize.width() * self.tileSize)) * self.tileSize
+            for top in range(0, levelSize.height(), stripHeight):
+                if self.cancelled:
+                    return
+                # a reader reads once; scaled to the level, then clipped to the strip
+                reader = QtGui.QImageReader(self.filename)
+                reader.setScaledSize(levelSize)
+                reader.setScaledClipRect(QtCore.QRect(0, top, levelSize.width(),
+                                                      min(stripHeight, levelSize.height() - top)))
+                strip = reader.read()
+                if strip.isNull():
+                    return
+                self.writeTiles(level, strip, top)
+            self.finishLevel(level)
+
+    def buildFromImage(self, sizes):
+        image = QtGui.QImage(self.filename)
+        if image.isNull():
+            return
+        for level, levelSize in enumerate(sizes):
+            if level:
+                image = image.scaled(levelSize, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+            self.writeTiles(level, image, 0)
+            self.finishLevel(level)
+
+    def writeTiles(self, level, image, top):
+        # image: the rows of the level starting at top, a multiple of tileSize
+        os.makedirs(os.path.join(self.directory, str(level)), exist_ok=True)
+        for y in range(0, image.height(), self.tileSize):
+            if self.cancelled:
+                return
+            for x in range(0, image.width(), self.tileSize):
+                tile = image.copy(x, y, self.tileSize, self.tileSize)
+                # light compression, tiles are read back far more often than written
+                tile.save(tilePath(self.directory, level, x // self.tileSize, (top + y) // self.tileSize), 'PNG', 90)
+
+    def finishLevel(self, level):
+        if self.cancelled:
+            return
+        open(os.path.join(self.directory, str(level), 'done'), 'w').close()
+        self.signals.levelReady.emit(self.filename, level)
+
+
+class TileLoader(QtCore.QRunnable):
+    def __init__(self, filename, key, path, signals):
+        super(TileLoader, self).__init__()
+        self.filename = filename
+        self.key = key
+        self.path = path
+        self.signals = signals
+
+    def run(self):
+        self.signals.tileLoaded.emit(self.filename, self.key, QtGui.QImage(self.path))
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   TiledImageItem
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+class TiledImageItem(QtWidgets.QGraphicsObject):
+    # images above this many pixels are shown through the pyramid instead of one QPixmap
+    pixelThreshold = 8192 * 8192
+
+    def __init__(self, tileSize=512, maxBytes=256 * 1024 * 1024, parent=None):
+        super(TiledImageItem, self).__init__(parent)
+        self.tileSize = tileSize
+        self.filename = ''
+        self.directory = ''
+        self.imageSize = QtCore.QSize()
+        self.levels = 0
+        self.readyLevels = set()
+        # filename -> PyramidBuilder queued or running
+        self.building = {}
+        self.tiles = ImageCache(maxBytes)
+        self.pending = set()
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(max(2, QtCore.QThread.idealThreadCount() - 1))
+        # builders are never dropped from their queue when the image changes, one pyramid at a time as each
+        # may hold a whole level in memory
+        self.builders = QtCore.QThreadPool()
+        self.builders.setMaxThreadCount(1)
+        self.signals = PyramidSignals()
+        self.signals.levelReady.connect(self.onLevelReady)
+        self.signals.pyramidDone.connect(self.onPyramidDone)
+        self.signals.tileLoaded.connect(self.onTileLoaded)
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption, True)
+
+    @classmethod
+    def isLarge(cls, filename):
+        size = QtGui.QImageReader(filename).size()
+        return size.width() * size.height() > cls.pixelThreshold
+
+    def setSource(self, filename):
+        self.prepareGeometryChange()
+        self.pool.clear()
+        self.tiles.clear()
+        self.pending.clear()
+        self.filename = filename
+        self.imageSize = QtGui.QImageReader(filename).size() if filename else QtCore.QSize()
+        if not filename or self.imageSize.isEmpty():
+            self.filename = ''
+            self.levels = 0
+            self.readyLevels = set()
+            return
+        self.directory = pyramidDirectory(filename)
+        self.levels = levelCount(self.imageSize.width(), self.imageSize.height(), self.tileSize)
+        self.readyLevels = {level for level in range(self.levels)
+                            if os.path.exists(os.path.join(self.directory, str(level), 'done'))}
+        if len(self.readyLevels) < self.levels and filename not in self.building:
+            builder = self.building[filename] = PyramidBuilder(filename, self.directory, self.tileSize, self.signals)
+            self.builders.start(builder)
+        self.update()
+
+    def clear(self):
+        self.setSource('')
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self.imageSize.width(), self.imageSize.height())
+
+    def levelForScale(self, scale):
+        if scale <= 0:
+            return self.levels - 1
+        return max(0, min(self.levels - 1, int(math.floor(math.log2(1.0 / scale))) if scale < 1 else 0))
+
+    def paint(self, painter, option, widget=None):
+        if not self.filename:
+            return
+        scale = QtWidgets.QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.levelForScale(scale)
+        span = self.tileSize << level
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+        for ty in range(int(exposed.top()) // span, int(math.ceil(exposed.bottom())) // span + 1):
+            for tx in range(int(exposed.left()) // span, int(math.ceil(exposed.right())) // span + 1):
+                self.paintTile(painter, level, tx, ty)
+
+    def paintTile(self, painter, level, tx, ty):
+        span = self.tileSize << level
+        target = QtCore.QRectF(tx * span, ty * span, span, span).intersected(self.boundingRect())
+        if target.isEmpty():
+            return
+        # the wanted tile, otherwise the best coarser tile that is already resident while it loads
+        for coarser in range(level, self.levels):
+            shift = coarser - level
+            key = (coarser, tx >> shift, ty >> shift)
+            image = self.tiles.get(key)
+            if image is None and coarser in (level, self.levels - 1):
+                self.requestTile(key)
+            if image is None:
+                continue
+            coarseSpan = self.tileSize << coarser
+            factor = float(1 << coarser)
+            source = QtCore.QRectF((target.left() - key[1] * coarseSpan) / factor,
+                                   (target.top() - key[2] * coarseSpan) / factor,
+                                   target.width() / factor, target.height() / factor)
+            painter.drawImage(target, image, source)
+            return
+
+    def requestTile(self, key):
+        if key in self.pending or key[0] not in self.readyLevels:
+            return
+        self.pending.add(key)
+        self.pool.start(TileLoader(self.filename, key, tilePath(self.directory, *key), self.signals))
+
+    @QtCore.Slot(str, int)
+    def onLevelReady(self, filename, level):
+        if filename == self.filename:
+            self.readyLevels.add(level)
+            self.update()
+
+    @QtCore.Slot(str)
+    def onPyramidDone(self, filename):
+        self.building.pop(filename, None)
+
+    @QtCore.Slot(str, object, QtGui.QImage)
+    def onTileLoaded(self, filename, key, image):
+        if filename != self.filename:
+            return
+        self.pending.discard(key)
+        self.tiles.put(key, image)
+        span = self.tileSize << key[0]
+        self.update(QtCore.QRectF(key[1] * span, key[2] * span, span, span))
+
+    def shutdown(self):
+        self.pool.clear()
+        self.builders.clear()
+        for builder in self.building.values():
+            builder.cancel()
+        self.pool.waitForDone()
+        self.builders.waitForDone()
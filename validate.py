@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from annotationstore import AnnotationStore
+from categories import classRegistry
+from exporter import boundedMap
+from geometry import toPolygon, polygonArea, selfIntersects, duplicateVertices, polygonsOverlap
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Per image checks, run in the worker processes
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def validateImage(key, polygons):
+    issues = []
+    counts = {}
+    areas = {}
+    shapes = []
+    for classId, index, blob in polygons:
+        xy = toPolygon(blob)
+        counts[classId] = counts.get(classId, 0) + 1
+        consecutive, repeated = duplicateVertices(xy) if len(xy) else (0, 0)
+        if consecutive:
+            issues.append({'class': classId, 'polygon': index, 'type': 'duplicate-vertex', 'count': consecutive})
+        elif repeated:
+            issues.append({'class': classId, 'polygon': index, 'type': 'repeated-vertex', 'count': repeated})
+        if len(xy) - consecutive < 3:
+            issues.append({'class': classId, 'polygon': index, 'type': 'degenerate'})
+            continue
+        if selfIntersects(xy):
+            issues.append({'class': classId, 'polygon': index, 'type': 'self-intersection'})
+        area = polygonArea(xy)
+        if area <= 1e-6:
+            issues.append({'class': classId, 'polygon': index, 'type': 'degenerate'})
+            continue
+        areas.setdefault(classId, []).append(area)
+        shapes.append((classId, index, xy))
+    for i in range(len(shapes)):
+        for j in range(i + 1, len(shapes)):
+            classA, indexA, a = shapes[i]
+            classB, indexB, b = shapes[j]
+            if classA != classB and polygonsOverlap(a, b):
+                issues.append({'class': classA, 'polygon': indexA, 'type': 'class-overlap',
+                               'otherClass': classB, 'otherPolygon': indexB})
+    return {'image': key,
+            'polygons': sum(counts.values()),
+            'classes': {str(classId): count for classId, count in sorted(counts.items())},
+            'area': {str(classId): round(sum(values), 2) for classId, values in sorted(areas.items())},
+            'issues': issues}, areas
+
+# #-----------------------------------------------------------------------------------------------------------------------
+# #   Dataset run
+# # -----------------------------------------------------------------------------------------------------------------------
+
+
+def validateDataset(directory, out, workers=None, summaryOnly=False):
+    store = AnnotationStore.forDirectory(directory)
+
+    def tasks():
+        for key, colorDict in store.items():
+            yield key, [(classId, index, points.tobytes())
+                        for classId in sorted(colorDict) for index, points in enumerate(colorDict[classId])]
+
+    images = 0
+    classStats = {}
+    issueCounts = {}
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for record, areas in boundedMap(executor, validateImage, tasks(), 4 * workers):
+            images += 1
+            for issue in record['issues']:
+                issueCounts[issue['type']] = issueCounts.get(issue['type'], 0) + 1
+            for classId, values in areas.items():
+                stats = classStats.setdefault(classId, {'count': 0, 'area': 0.0,
+                                                        'minArea': float('inf'), 'maxArea': 0.0})
+                stats['count'] += len(values)
+                stats['area'] += sum(values)
+                stats['minArea'] = min(stats['minArea'], min(values))
+                stats['maxArea'] = max(stats['maxArea'], max(values))
+            if not summaryOnly:
+                out.write(json.dumps(record) + '\n')
+    store.close()
+    summary = {'summary': True, 'images': images, 'issues': issueCounts, 'classes': {}}
+    for classId, stats in sorted(classStats.items()):
+        summary['classes'][classRegistry.name(classId)] = {'id': classId,
+                                                  'count': stats['count'],
+                                                  'area': round(stats['area'], 2),
+                                                  'meanArea': round(stats['area'] / stats['count'], 2),
+                                                  'minArea': round(stats['minArea'], 2),
+                                                  'maxArea': round(stats['maxArea'], 2)}
+    out.write(json.dumps(summary) + '\n')
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Validate parcel annotations and print statistics as JSON lines')
+    parser.add_argument('directory', help='image directory containing the annotation store')
+    parser.add_argument('--workers', type=int, default=None, help='number of validation processes')
+    parser.add_argument('--output', default='-', help='JSON lines output file (default: stdout)')
+    parser.add_argument('--summary-only', action='store_true', help='only write the final summary line')
+    args = parser.parse_args(argv)
+    if args.output == '-':
+        summary = validateDataset(args.directory, sys.stdout, args.workers, args.summary_only)
+    else:
+        with open(args.output, 'w') as out:
+            summary = validateDataset(args.directory, out, args.workers, args.summary_only)
+    return 1 if summary['issues'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())